@@ -24,18 +24,22 @@ Designer Clicker Bot — single-file edition (patched)
 from __future__ import annotations
 
 import asyncio
+import hashlib
 import json
 import logging
 import os
 import random
 import time
-from collections import defaultdict, deque
-from contextlib import asynccontextmanager
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, defaultdict
+from contextlib import asynccontextmanager, suppress
+from contextvars import ContextVar
 from dataclasses import dataclass
-from datetime import datetime, timedelta, timezone
-from functools import wraps
+from datetime import datetime, timedelta
+from functools import lru_cache, wraps
+from itertools import chain
 from math import floor, sqrt
-from typing import AsyncIterator, Deque, Dict, List, Literal, Optional, Set, Tuple, Any
+from typing import AsyncIterator, Dict, List, Literal, NamedTuple, Optional, Sequence, Set, Tuple, Any
 
 # --- .env ---
 try:
@@ -44,6 +48,26 @@ try:
 except Exception:
     pass
 
+# --- orjson (необязательно, ускоряет логи и JSON-колонки) ---
+try:
+    import orjson  # type: ignore
+except ImportError:  # pragma: no cover - работаем и на stdlib json
+    orjson = None
+
+
+def _json_dumps(data: Any, *, sort_keys: bool = False) -> str:
+    if orjson is not None:
+        option = orjson.OPT_SORT_KEYS if sort_keys else 0
+        return orjson.dumps(data, default=str, option=option).decode()
+    return json.dumps(data, ensure_ascii=False, sort_keys=sort_keys, default=str)
+
+
+def _json_loads(raw: Any) -> Any:
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
 # --- aiogram ---
 from aiogram import Bot, Dispatcher, Router, F, BaseMiddleware
 from aiogram.filters import CommandStart, Command
@@ -71,15 +95,25 @@ from sqlalchemy import (
     UniqueConstraint,
     Index,
     case,
+    cast,
     and_,
+    bindparam,
     delete,
+    insert,
+    event,
+    exists,
+    inspect,
     select,
     func,
     update,
     text,
+    literal,
+    union_all,
 )
-from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
-from sqlalchemy.orm.attributes import flag_modified
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import DeclarativeBase, Mapped, Session, mapped_column, relationship
+from sqlalchemy.orm.attributes import flag_modified, set_committed_value
 from sqlalchemy.ext.asyncio import (
     AsyncSession,
     async_sessionmaker,
@@ -99,15 +133,28 @@ class Settings:
     DATABASE_URL: str = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./designer.db")
     DAILY_BONUS_RUB: int = int(os.getenv("DAILY_BONUS_RUB", "100"))
     BASE_ADMIN_ID: int = int(os.getenv("BASE_ADMIN_ID", "0"))
+    DYNAMIC_ERROR_MENU: bool = os.getenv("DYNAMIC_ERROR_MENU", "0") == "1"
+    DEBUG: bool = os.getenv("DEBUG", "0") == "1"
 
 
 SETTINGS = Settings()
 
+# Собственный генератор: можно засеять в тестах, а связанные методы
+# экономят поиск атрибутов модуля random на каждом клике.
+_RNG = random.Random()
+_rand = _RNG.random
+_rand_choice = _RNG.choice
+_rand_uniform = _RNG.uniform
+_rand_sample = _RNG.sample
+
 
 ADMIN_USER_IDS: Set[int] = {1468318625}
 
 
 MAX_OFFLINE_SECONDS = 12 * 60 * 60
+OFFLINE_INCOME_MIN_STEP_SECONDS = 1.0
+# На кликах баланс не показывается: пассив копится дольше и начисляется одним шагом.
+OFFLINE_INCOME_CLICK_STEP_SECONDS = 30.0
 BASE_CLICK_LIMIT = 10
 MAX_CLICK_LIMIT = 30
 RANDOM_EVENT_CLICK_INTERVAL = 20
@@ -315,7 +362,55 @@ class IdleIncomeResult:
     order_completion: Optional[OrderCompletionResult] = None
 
 
+# user_id -> monotonic-время последней доп. фразы на клике. Записи старше кулдауна
+# ничем не отличаются от отсутствующих, поэтому раз в кулдаун их выметаем.
 _extra_phrase_last_sent: Dict[int, float] = {}
+_extra_phrase_last_sweep = 0.0
+
+
+def _remember_extra_phrase(user_id: int, now: float) -> None:
+    """Record an extra phrase sent to the user, pruning expired cooldowns."""
+
+    global _extra_phrase_last_sweep
+    if now - _extra_phrase_last_sweep >= CLICK_EXTRA_PHRASE_COOLDOWN:
+        expired = [
+            uid for uid, ts in _extra_phrase_last_sent.items() if now - ts >= CLICK_EXTRA_PHRASE_COOLDOWN
+        ]
+        for uid in expired:
+            del _extra_phrase_last_sent[uid]
+        _extra_phrase_last_sweep = now
+    _extra_phrase_last_sent[user_id] = now
+
+
+_LOG_RESERVED = frozenset(
+    {
+        "args",
+        "created",
+        "exc_info",
+        "exc_text",
+        "filename",
+        "funcName",
+        "levelname",
+        "levelno",
+        "lineno",
+        "module",
+        "msecs",
+        "msg",
+        "name",
+        "pathname",
+        "process",
+        "processName",
+        "relativeCreated",
+        "stack_info",
+        "thread",
+        "threadName",
+        # ключи самого payload
+        "ts",
+        "level",
+        "logger",
+        "message",
+    }
+)
 
 
 class JsonLogFormatter(logging.Formatter):
@@ -323,39 +418,26 @@ class JsonLogFormatter(logging.Formatter):
 
     def format(self, record: logging.LogRecord) -> str:  # noqa: D401 - short implementation
         payload = {
-            "ts": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created))
+            + f".{int(record.msecs):03d}Z",
             "level": record.levelname,
             "logger": record.name,
             "message": record.getMessage(),
         }
         if record.exc_info:
             payload["exc_info"] = self.formatException(record.exc_info)
+        extras = None
         for key, value in record.__dict__.items():
-            if key.startswith("_") or key in payload or key in {
-                "args",
-                "created",
-                "exc_info",
-                "exc_text",
-                "filename",
-                "funcName",
-                "levelname",
-                "levelno",
-                "lineno",
-                "module",
-                "msecs",
-                "msg",
-                "name",
-                "pathname",
-                "process",
-                "processName",
-                "relativeCreated",
-                "stack_info",
-                "thread",
-                "threadName",
-            }:
+            if key in _LOG_RESERVED or key.startswith("_"):
                 continue
-            payload.setdefault("extras", {})[key] = value
-        return json.dumps(payload, ensure_ascii=False)
+            if extras is None:
+                extras = {}
+            extras[key] = value
+        if extras is not None:
+            payload["extras"] = extras
+        if orjson is not None:
+            return orjson.dumps(payload, default=str).decode()
+        return json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
 
 
 _handler = logging.StreamHandler()
@@ -608,21 +690,52 @@ TUTORIAL_STAGE_HINT_BUTTONS: Dict[int, str] = {
     TUTORIAL_STAGE_FINISH: RU.BTN_TUTORIAL_FINISH,
 }
 
-CLICK_EXTRA_PHRASES = [
+
+def _render_tutorial_parts(stage: int, template: Any) -> Tuple[str, str]:
+    if isinstance(template, (list, tuple)):
+        template = "\n".join(template)
+    text = template.format(
+        orders=RU.BTN_ORDERS,
+        click=RU.BTN_CLICK,
+        upgrades=RU.BTN_UPGRADES,
+        take=RU.BTN_TAKE,
+        shop=RU.BTN_SHOP,
+        finish=RU.BTN_TUTORIAL_FINISH,
+        need=TUTORIAL_REQUIRED_CLICKS,
+    )
+    step_index = min(stage, TUTORIAL_STAGE_FINISH)
+    head = f"🧭 Шаг {step_index + 1} из {TUTORIAL_TOTAL_STEPS}\n\n{text}"
+    tail: List[str] = []
+    hint_button = TUTORIAL_STAGE_HINT_BUTTONS.get(stage)
+    if hint_button:
+        tail.append("")
+        tail.append(RU.TUTORIAL_HINT.format(button=hint_button))
+    if stage < TUTORIAL_STAGE_FINISH:
+        tail.append("Если хочешь пропустить — нажми «Пропустить».")
+    return head, "\n".join(tail)
+
+
+# Тексты шагов не зависят от игрока: (шапка, подсказка) собираются один раз.
+TUTORIAL_STAGE_PARTS: Dict[int, Tuple[str, str]] = {
+    stage: _render_tutorial_parts(stage, template)
+    for stage, template in TUTORIAL_STAGE_MESSAGES.items()
+}
+
+CLICK_EXTRA_PHRASES = (
     "🎶 Плейлист вдохновения звучит! Креатив кипит.",
     "🧠 Визуал рождается на лету — продолжай!",
     "☕ Латте на столе, кисти готовы. Работает как часы!",
     "📈 Клиент видит прогресс и улыбается.",
-]
+)
 CLICK_EXTRA_PHRASE_CHANCE = 0.15
 CLICK_EXTRA_PHRASE_COOLDOWN = 60.0
 
-ORDER_DONE_EXTRA = [
+ORDER_DONE_EXTRA = (
     "Клиент в восторге!",
     "Портфолио пополнилось стильной работой.",
     "Ваша репутация растёт.",
     "Команда обсуждает успех за чашкой кофе!",
-]
+)
 
 RANK_THRESHOLDS = [
     (1, "Новичок"),
@@ -654,6 +767,55 @@ DAILY_TASKS = [
         "reward": {"rub": 1000, "xp": 250},
     },
 ]
+# Индексы задач в DAILY_TASKS. Состояние дня упаковано в одно целое:
+# по DAILY_PROGRESS_BITS бит прогресса на задачу, выше — биты «выполнено».
+DAILY_TASK_CLICKS = 0
+DAILY_TASK_ORDERS = 1
+DAILY_TASK_SHOP = 2
+DAILY_TASK_COUNT = len(DAILY_TASKS)
+DAILY_PROGRESS_BITS = 10
+DAILY_PROGRESS_MASK = (1 << DAILY_PROGRESS_BITS) - 1
+DAILY_DONE_SHIFT = DAILY_TASK_COUNT * DAILY_PROGRESS_BITS
+assert all(task["goal"] <= DAILY_PROGRESS_MASK for task in DAILY_TASKS)
+
+
+def unpack_daily_state(packed: int) -> Tuple[List[int], int]:
+    """Return per-task progress and the done bitmask from the packed value."""
+
+    progress = [
+        (packed >> (idx * DAILY_PROGRESS_BITS)) & DAILY_PROGRESS_MASK
+        for idx in range(DAILY_TASK_COUNT)
+    ]
+    return progress, packed >> DAILY_DONE_SHIFT
+
+
+def pack_daily_state(progress: List[int], done_mask: int) -> int:
+    packed = done_mask << DAILY_DONE_SHIFT
+    for idx, value in enumerate(progress):
+        packed |= min(value, DAILY_PROGRESS_MASK) << (idx * DAILY_PROGRESS_BITS)
+    return packed
+
+
+def _daily_packed_from_legacy(state: Any) -> int:
+    """Convert JSON daily state (``{code: {...}}`` or ``[progress, mask]``)."""
+
+    if isinstance(state, list) and len(state) == 2 and isinstance(state[0], list):
+        progress = [int(value) for value in state[0][:DAILY_TASK_COUNT]]
+        progress += [0] * (DAILY_TASK_COUNT - len(progress))
+        return pack_daily_state(progress, int(state[1]))
+    if not isinstance(state, dict):
+        return 0
+    progress = [0] * DAILY_TASK_COUNT
+    done_mask = 0
+    for idx, task in enumerate(DAILY_TASKS):
+        entry = state.get(task["code"])
+        if not isinstance(entry, dict):
+            continue
+        progress[idx] = int(entry.get("progress", 0))
+        if entry.get("done"):
+            done_mask |= 1 << idx
+    return pack_daily_state(progress, done_mask)
+
 
 REFERRAL_BONUS_RUB = 100
 REFERRAL_BONUS_XP = 50
@@ -664,17 +826,26 @@ SPECIAL_ORDER_MIN_LEVEL = 4
 # ----------------------------------------------------------------------------
 # Клавиатуры (только ReplyKeyboard)
 # ----------------------------------------------------------------------------
+# Разметка неизменяема после сборки, поэтому варианты с хешируемыми
+# аргументами кешируются и переиспользуются между сообщениями.
+
+
+@lru_cache(maxsize=512)
+def _keyboard_button(text: str) -> KeyboardButton:
+    # Кнопка неизменяема — валидируем её один раз на текст.
+    return KeyboardButton(text=text)
 
 
 def _reply_keyboard(rows: List[List[str]]) -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(
-        keyboard=[[KeyboardButton(text=cell) for cell in row] for row in rows],
+        keyboard=[[_keyboard_button(cell) for cell in row] for row in rows],
         resize_keyboard=True,
         one_time_keyboard=False,
         selective=False,
     )
 
 
+@lru_cache(maxsize=None)
 def kb_main_menu(has_active_order: bool = False) -> ReplyKeyboardMarkup:
     rows: List[List[str]] = []
     rows.append([RU.BTN_ORDERS])
@@ -684,10 +855,12 @@ def kb_main_menu(has_active_order: bool = False) -> ReplyKeyboardMarkup:
     return _reply_keyboard(rows)
 
 
+@lru_cache(maxsize=None)
 def kb_active_order_controls() -> ReplyKeyboardMarkup:
     return _reply_keyboard([[RU.BTN_CLICK, RU.BTN_TO_MENU]])
 
 
+@lru_cache(maxsize=None)
 def kb_numeric_page(
     show_prev: bool, show_next: bool, add_back: bool = True, *, tutorial: bool = False
 ) -> ReplyKeyboardMarkup:
@@ -708,6 +881,7 @@ def kb_numeric_page(
     return _reply_keyboard(rows)
 
 
+@lru_cache(maxsize=None)
 def kb_confirm(
     confirm_text: str = RU.BTN_CONFIRM, add_menu: bool = False, *, tutorial: bool = False
 ) -> ReplyKeyboardMarkup:
@@ -718,6 +892,7 @@ def kb_confirm(
     return _reply_keyboard(rows)
 
 
+@lru_cache(maxsize=None)
 def kb_upgrades_menu(include_team: bool, *, tutorial: bool = False) -> ReplyKeyboardMarkup:
     if tutorial:
         rows: List[List[str]] = [[RU.BTN_SHOP]]
@@ -730,6 +905,7 @@ def kb_upgrades_menu(include_team: bool, *, tutorial: bool = False) -> ReplyKeyb
     return _reply_keyboard(rows)
 
 
+@lru_cache(maxsize=None)
 def kb_shop_menu(*, tutorial: bool = False) -> ReplyKeyboardMarkup:
     rows: List[List[str]] = [[RU.BTN_BOOSTS, RU.BTN_EQUIPMENT]]
     if not tutorial:
@@ -737,6 +913,8 @@ def kb_shop_menu(*, tutorial: bool = False) -> ReplyKeyboardMarkup:
     _append_tutorial_skip(rows, tutorial)
     return _reply_keyboard(rows)
 
+
+@lru_cache(maxsize=None)
 def kb_boost_categories(*, tutorial: bool = False) -> ReplyKeyboardMarkup:
     rows: List[List[str]] = []
     current_row: List[str] = []
@@ -800,6 +978,7 @@ PROFILE_CATEGORY_PROMPTS: Dict[str, str] = {
 }
 
 
+@lru_cache(maxsize=None)
 def kb_profile_menu(
     has_active_order: bool,
     *,
@@ -820,6 +999,7 @@ def kb_profile_menu(
     return _reply_keyboard(rows)
 
 
+@lru_cache(maxsize=None)
 def tutorial_keyboard(stage: int) -> Optional[ReplyKeyboardMarkup]:
     """Return a minimal keyboard for the current tutorial stage."""
 
@@ -848,17 +1028,20 @@ def tutorial_keyboard(stage: int) -> Optional[ReplyKeyboardMarkup]:
     return _reply_keyboard(rows)
 
 
+@lru_cache(maxsize=None)
 def kb_achievement_prompt() -> ReplyKeyboardMarkup:
     rows = [[RU.BTN_SHOW_ACHIEVEMENTS], [RU.BTN_BACK]]
     return _reply_keyboard(rows)
 
 
+@lru_cache(maxsize=None)
 def kb_skill_choices(count: int) -> ReplyKeyboardMarkup:
     rows = [[str(i + 1) for i in range(count)], [RU.BTN_BACK]]
     return _reply_keyboard(rows)
 
 
-def kb_quest_options(options: List[str]) -> ReplyKeyboardMarkup:
+@lru_cache(maxsize=256)
+def kb_quest_options(options: Tuple[str, ...]) -> ReplyKeyboardMarkup:
     rows = [[opt] for opt in options]
     rows.append([RU.BTN_BACK])
     return _reply_keyboard(rows)
@@ -888,7 +1071,8 @@ async def build_main_menu_markup(
         async with session_scope() as new_session:
             return await build_main_menu_markup(new_session, user=user, tg_id=tg_id)
     if user is None and tg_id is not None:
-        user = await get_user_by_tg(session, tg_id)
+        user, has_active = await get_user_and_has_active(session, tg_id)
+        return kb_main_menu(has_active_order=has_active)
     if user is not None:
         active = await get_active_order(session, user)
         return kb_main_menu(has_active_order=bool(active))
@@ -903,69 +1087,74 @@ async def main_menu_for_message(
     return await build_main_menu_markup(session=session, user=user, tg_id=message.from_user.id)
 
 
+def _json_snapshot(data: Any) -> int:
+    """Cheap fingerprint of a JSON column value to detect in-place changes."""
+
+    return hash(_json_dumps(data, sort_keys=True))
+
+
+def mark_json_changed(user: User, attr: str, snapshot: int) -> bool:
+    """Flag a JSON column dirty only if its content differs from ``snapshot``."""
+
+    if _json_snapshot(getattr(user, attr)) == snapshot:
+        return False
+    flag_modified(user, attr)
+    return True
+
+
 def ensure_tutorial_payload(user: User) -> Dict[str, Any]:
-    """Guarantee that tutorial payload is a mutable dict."""
+    """Return the tutorial payload; User load/init listeners guarantee a dict."""
+
+    return user.tutorial_payload
 
-    payload = user.tutorial_payload or {}
-    if not isinstance(payload, dict):
-        payload = {}
-    user.tutorial_payload = payload
-    return payload
+
+@lru_cache(maxsize=None)
+def _tutorial_static_text(stage: int) -> Optional[str]:
+    """Full text for stages without per-user content (all but the shop step)."""
+
+    parts = TUTORIAL_STAGE_PARTS.get(stage)
+    if not parts:
+        return None
+    head, tail = parts
+    return f"{head}\n{tail}" if tail else head
 
 
 def tutorial_stage_text(user: User, stage: int) -> Optional[str]:
     """Return formatted tutorial text for the given stage."""
 
-    template = TUTORIAL_STAGE_MESSAGES.get(stage)
-    if not template:
+    if stage != TUTORIAL_STAGE_SHOP:
+        return _tutorial_static_text(stage)
+    parts = TUTORIAL_STAGE_PARTS.get(stage)
+    if not parts:
         return None
+    head, tail = parts
+    lines = [head]
     payload = ensure_tutorial_payload(user)
-    name = user.first_name or "дизайнер"
-    if isinstance(template, (list, tuple)):
-        template = "\n".join(template)
-    text = template.format(
-        name=name,
-        orders=RU.BTN_ORDERS,
-        click=RU.BTN_CLICK,
-        upgrades=RU.BTN_UPGRADES,
-        take=RU.BTN_TAKE,
-        shop=RU.BTN_SHOP,
-        finish=RU.BTN_TUTORIAL_FINISH,
-        need=TUTORIAL_REQUIRED_CLICKS,
-    )
-    hint_button = TUTORIAL_STAGE_HINT_BUTTONS.get(stage)
-    step_index = min(stage, TUTORIAL_STAGE_FINISH)
-    step_prefix = f"🧭 Шаг {step_index + 1} из {TUTORIAL_TOTAL_STEPS}"
-    lines = [step_prefix, "", text]
-    if stage == TUTORIAL_STAGE_SHOP:
-        hint = payload.get("shop_hint", {}) if isinstance(payload, dict) else {}
-        lines.append("")
-        if hint.get("kind") == "boost":
-            category_label = hint.get("category_button", RU.BTN_BOOSTS)
-            boost_name = hint.get("name", "улучшение")
-            lines.append(
-                RU.TUTORIAL_SHOP_HINT_BOOST.format(
-                    category=category_label,
-                    name=boost_name,
-                    buy=RU.BTN_BUY,
-                )
+    hint = payload.get("shop_hint", {}) if isinstance(payload, dict) else {}
+    lines.append("")
+    if hint.get("kind") == "boost":
+        category_label = hint.get("category_button", RU.BTN_BOOSTS)
+        boost_name = hint.get("name", "улучшение")
+        lines.append(
+            RU.TUTORIAL_SHOP_HINT_BOOST.format(
+                category=category_label,
+                name=boost_name,
+                buy=RU.BTN_BUY,
             )
-        elif hint.get("kind") == "item":
-            item_name = hint.get("name", "предмет")
-            lines.append(
-                RU.TUTORIAL_SHOP_HINT_ITEM.format(
-                    equipment=RU.BTN_EQUIPMENT,
-                    name=item_name,
-                    buy=RU.BTN_BUY,
-                )
+        )
+    elif hint.get("kind") == "item":
+        item_name = hint.get("name", "предмет")
+        lines.append(
+            RU.TUTORIAL_SHOP_HINT_ITEM.format(
+                equipment=RU.BTN_EQUIPMENT,
+                name=item_name,
+                buy=RU.BTN_BUY,
             )
-        lines.append(RU.TUTORIAL_SHOP_PRICE_HINT.format(price=FREE_UPGRADE_PRICE_LABEL))
-        lines.append(RU.TUTORIAL_SHOP_LOCK)
-    if hint_button:
-        lines.append("")
-        lines.append(RU.TUTORIAL_HINT.format(button=hint_button))
-    if stage < TUTORIAL_STAGE_FINISH:
-        lines.append("Если хочешь пропустить — нажми «Пропустить».")
+        )
+    lines.append(RU.TUTORIAL_SHOP_PRICE_HINT.format(price=FREE_UPGRADE_PRICE_LABEL))
+    lines.append(RU.TUTORIAL_SHOP_LOCK)
+    if tail:
+        lines.append(tail)
     return "\n".join(lines)
 
 
@@ -1036,41 +1225,88 @@ async def tutorial_on_event(
     if user.tutorial_completed_at is not None or user.tutorial_stage >= TUTORIAL_STAGE_DONE:
         return False
     payload = ensure_tutorial_payload(user)
-    now = utcnow()
+    snapshot = _json_snapshot(payload)
+    try:
+        return await _tutorial_apply_event(message, session, user, event, payload)
+    finally:
+        mark_json_changed(user, "tutorial_payload", snapshot)
+
+
+async def _tutorial_to_clicks(session: AsyncSession, user: User, payload: Dict[str, Any]) -> Optional[int]:
+    payload["clicks"] = 0
+    return TUTORIAL_STAGE_CLICKS
+
+
+async def _tutorial_count_click(session: AsyncSession, user: User, payload: Dict[str, Any]) -> Optional[int]:
+    clicks = payload.get("clicks", 0) + 1
+    if clicks < TUTORIAL_REQUIRED_CLICKS:
+        payload["clicks"] = clicks
+        return None
+    payload.pop("clicks", None)
+    return TUTORIAL_STAGE_UPGRADES
+
+
+async def _tutorial_order_done_early(
+    session: AsyncSession, user: User, payload: Dict[str, Any]
+) -> Optional[int]:
+    payload.pop("clicks", None)
+    return TUTORIAL_STAGE_UPGRADES
+
+
+async def _tutorial_to_shop(session: AsyncSession, user: User, payload: Dict[str, Any]) -> Optional[int]:
+    await tutorial_prepare_shop_hint(session, user, payload=payload)
+    return TUTORIAL_STAGE_SHOP
+
+
+async def _tutorial_mark_shop_open(
+    session: AsyncSession, user: User, payload: Dict[str, Any]
+) -> Optional[int]:
+    payload["shop_open"] = True
+    return None
+
+
+def _tutorial_goto(stage: int):
+    async def transition(session: AsyncSession, user: User, payload: Dict[str, Any]) -> Optional[int]:
+        return stage
+
+    return transition
+
+
+# (этап, событие) -> переход; возвращает новый этап или None, если этап не меняется.
+TUTORIAL_TRANSITIONS: Dict[Tuple[int, str], Any] = {
+    (TUTORIAL_STAGE_GO_ORDERS, "orders_opened"): _tutorial_goto(TUTORIAL_STAGE_ORDER_PICK),
+    (TUTORIAL_STAGE_ORDER_PICK, "order_taken"): _tutorial_to_clicks,
+    (TUTORIAL_STAGE_CLICKS, "click"): _tutorial_count_click,
+    (TUTORIAL_STAGE_CLICKS, "order_completed"): _tutorial_order_done_early,
+    (TUTORIAL_STAGE_UPGRADES, "upgrades_open"): _tutorial_to_shop,
+    (TUTORIAL_STAGE_SHOP, "shop_open"): _tutorial_mark_shop_open,
+    (TUTORIAL_STAGE_SHOP, "upgrade_purchase"): _tutorial_goto(TUTORIAL_STAGE_FINISH),
+}
+
+
+async def _tutorial_apply_event(
+    message: Message,
+    session: AsyncSession,
+    user: User,
+    event: str,
+    payload: Dict[str, Any],
+) -> bool:
     stage = user.tutorial_stage
-    advanced = False
-    if stage == TUTORIAL_STAGE_GO_ORDERS and event == "orders_opened":
-        user.tutorial_stage = TUTORIAL_STAGE_ORDER_PICK
-        advanced = True
-    elif stage == TUTORIAL_STAGE_ORDER_PICK and event == "order_taken":
-        payload["clicks"] = 0
-        user.tutorial_stage = TUTORIAL_STAGE_CLICKS
-        advanced = True
-    elif stage == TUTORIAL_STAGE_CLICKS and event == "click":
-        payload["clicks"] = int(payload.get("clicks", 0)) + 1
-        if payload["clicks"] >= TUTORIAL_REQUIRED_CLICKS:
-            payload.pop("clicks", None)
-            user.tutorial_stage = TUTORIAL_STAGE_UPGRADES
-            advanced = True
-    elif stage == TUTORIAL_STAGE_CLICKS and event == "order_completed":
-        payload.pop("clicks", None)
-        user.tutorial_stage = TUTORIAL_STAGE_UPGRADES
-        advanced = True
-    elif event == "order_completed" and TUTORIAL_STAGE_CLICKS < stage < TUTORIAL_STAGE_DONE:
-        user.updated_at = now
+    transition = TUTORIAL_TRANSITIONS.get((stage, event))
+    if transition is not None:
+        next_stage = await transition(session, user, payload)
+        if next_stage is None:
+            return False
+        user.tutorial_stage = next_stage
+        user.updated_at = utcnow()
+        await send_tutorial_prompt(message, user, next_stage)
+        return True
+    if event == "order_completed" and TUTORIAL_STAGE_CLICKS < stage < TUTORIAL_STAGE_DONE:
+        user.updated_at = utcnow()
         await send_tutorial_prompt(message, user, stage)
         return False
-    elif stage == TUTORIAL_STAGE_UPGRADES and event == "upgrades_open":
-        await tutorial_prepare_shop_hint(session, user, payload=payload)
-        user.tutorial_stage = TUTORIAL_STAGE_SHOP
-        advanced = True
-    elif stage == TUTORIAL_STAGE_SHOP:
-        if event == "shop_open":
-            payload["shop_open"] = True
-        if event == "upgrade_purchase":
-            user.tutorial_stage = TUTORIAL_STAGE_FINISH
-            advanced = True
-    elif stage == TUTORIAL_STAGE_FINISH and event == "tutorial_complete":
+    if stage == TUTORIAL_STAGE_FINISH and event == "tutorial_complete":
+        now = utcnow()
         user.tutorial_stage = TUTORIAL_STAGE_DONE
         user.tutorial_completed_at = now
         user.updated_at = now
@@ -1080,79 +1316,78 @@ async def tutorial_on_event(
             reply_markup=await build_main_menu_markup(session=session, user=user),
         )
         return True
-    if advanced:
-        user.updated_at = now
-        await send_tutorial_prompt(message, user, user.tutorial_stage)
-    return advanced
+    return False
 
 
-def ensure_daily_task_state(user: User) -> Dict[str, Any]:
-    """Ensure that daily tasks state is initialized for today."""
+def ensure_daily_task_state(user: User) -> int:
+    """Ensure that daily tasks state is initialized for today; return it packed."""
 
     today = utcnow().date().isoformat()
-    state = user.daily_task_state or {}
     if user.daily_task_date != today:
-        state = {task["code"]: {"progress": 0, "done": False} for task in DAILY_TASKS}
         user.daily_task_date = today
-    elif not isinstance(state, dict):
-        state = {task["code"]: {"progress": 0, "done": False} for task in DAILY_TASKS}
-    user.daily_task_state = state
-    return state
+        user.daily_task_packed = 0
+    elif user.daily_task_packed is None:
+        # Запись ещё в старом JSON-формате — переносим сегодняшний прогресс.
+        user.daily_task_packed = _daily_packed_from_legacy(user.daily_task_state)
+    return user.daily_task_packed
 
 
 async def daily_task_on_event(
     message: Message,
     session: AsyncSession,
     user: User,
-    task_code: str,
+    task_id: int,
     amount: int = 1,
 ) -> None:
     """Increment progress of a daily task and award reward when completed."""
 
-    state = ensure_daily_task_state(user)
-    task_def = next((task for task in DAILY_TASKS if task["code"] == task_code), None)
-    if not task_def:
+    if not 0 <= task_id < DAILY_TASK_COUNT:
         return
-    entry = state.setdefault(task_code, {"progress": 0, "done": False})
-    if entry.get("done"):
+    packed = ensure_daily_task_state(user)
+    if (packed >> (DAILY_DONE_SHIFT + task_id)) & 1:
         return
-    modified = False
-    current_progress = int(entry.get("progress", 0))
-    new_progress = min(task_def["goal"], current_progress + amount)
+    task_def = DAILY_TASKS[task_id]
+    goal = task_def["goal"]
+    shift = task_id * DAILY_PROGRESS_BITS
+    current_progress = (packed >> shift) & DAILY_PROGRESS_MASK
+    new_progress = min(goal, current_progress + amount)
     if new_progress != current_progress:
-        entry["progress"] = new_progress
-        modified = True
-    if entry["progress"] >= task_def["goal"] and not entry.get("done"):
-        entry["done"] = True
-        modified = True
-        reward = task_def.get("reward", {})
-        rub = int(reward.get("rub", 0))
-        xp_reward = int(reward.get("xp", 0))
-        prev_level = user.level
-        levels_gained = 0
-        if rub:
-            user.balance += rub
-            session.add(
-                EconomyLog(
-                    user_id=user.id,
-                    type="daily_task",
-                    amount=rub,
-                    meta={"task": task_code},
-                    created_at=utcnow(),
-                )
-            )
-        if xp_reward:
-            levels_gained = await add_xp_and_levelup(user, xp_reward)
-        user.updated_at = utcnow()
-        await message.answer(
-            RU.DAILIES_DONE_REWARD.format(
-                text=task_def["text"], reward=describe_reward(reward)
-            )
+        packed = (packed & ~(DAILY_PROGRESS_MASK << shift)) | (new_progress << shift)
+    if new_progress >= goal:
+        packed |= 1 << (DAILY_DONE_SHIFT + task_id)
+    if packed != user.daily_task_packed:
+        user.daily_task_packed = packed
+    if new_progress < goal:
+        return
+    reward = task_def.get("reward", {})
+    rub = int(reward.get("rub", 0))
+    xp_reward = int(reward.get("xp", 0))
+    prev_level = user.level
+    levels_gained = 0
+    now = utcnow()
+    if rub:
+        user.balance += rub
+        queue_write(
+            session,
+            EconomyLog(
+                user_id=user.id,
+                type="daily_task",
+                amount=rub,
+                meta=None,
+                meta_task=task_def["code"],
+                created_at=now,
+            ),
         )
-        if levels_gained:
-            await notify_level_up_message(message, session, user, prev_level, levels_gained)
-    if modified:
-        flag_modified(user, "daily_task_state")
+    if xp_reward:
+        levels_gained = await add_xp_and_levelup(user, xp_reward)
+    user.updated_at = now
+    await message.answer(
+        RU.DAILIES_DONE_REWARD.format(
+            text=task_def["text"], reward=describe_reward(reward)
+        )
+    )
+    if levels_gained:
+        await notify_level_up_message(message, session, user, prev_level, levels_gained)
 
 
 async def notify_level_up_message(
@@ -1184,7 +1419,7 @@ async def notify_level_up_message(
     maybe_unlock("quests", 10, RU.UNLOCK_HINT_QUESTS)
     maybe_unlock("studio", 20, RU.UNLOCK_HINT_STUDIO)
     if unlock_messages:
-        user.tutorial_payload = payload
+        flag_modified(user, "tutorial_payload")
         user.updated_at = utcnow()
         for text in unlock_messages:
             await message.answer(text)
@@ -1197,31 +1432,51 @@ async def notify_level_up_message(
 ERROR_MESSAGE = "Произошла ошибка. Попробуйте позже."
 
 
-def safe_handler(func):
-    """Обёртка для обработчиков сообщений, чтобы логировать ошибки и отвечать пользователю."""
+_STATIC_MAIN_MENU = kb_main_menu(has_active_order=False)
 
-    @wraps(func)
-    async def wrapper(message: Message, *args, **kwargs):
-        try:
-            return await func(message, *args, **kwargs)
-        except Exception as exc:  # noqa: BLE001 - важно логировать любые сбои
-            logger.exception("Unhandled error in %s", func.__name__, exc_info=exc)
-            if isinstance(message, Message):
+
+def safe_handler(func=None, *, fallback_kb: Optional[ReplyKeyboardMarkup] = None):
+    """Обёртка для обработчиков сообщений, чтобы логировать ошибки и отвечать пользователю.
+
+    Без лишних запросов к БД: при ошибке отвечаем статической клавиатурой
+    (или ``fallback_kb``); динамическое меню — только при DYNAMIC_ERROR_MENU=1.
+    """
+
+    def decorator(handler):
+        @wraps(handler)
+        async def wrapper(message: Message, *args, **kwargs):
+            now_token = _REQUEST_NOW.set(datetime.utcnow())
+            try:
+                return await handler(message, *args, **kwargs)
+            except Exception as exc:  # noqa: BLE001 - важно логировать любые сбои
+                logger.exception("Unhandled error in %s", handler.__name__, exc_info=exc)
+                if not isinstance(message, Message):
+                    return None
                 try:
-                    await message.answer(
-                        ERROR_MESSAGE,
-                        reply_markup=await build_main_menu_markup(tg_id=message.from_user.id),
-                    )
+                    markup = fallback_kb or _STATIC_MAIN_MENU
+                    if SETTINGS.DYNAMIC_ERROR_MENU and message.from_user:
+                        markup = await build_main_menu_markup(tg_id=message.from_user.id)
+                    await message.answer(ERROR_MESSAGE, reply_markup=markup)
                 except Exception:  # noqa: BLE001
                     logger.exception("Failed to send error notification to user")
+                return None
+            finally:
+                _REQUEST_NOW.reset(now_token)
 
-    return wrapper
+        return wrapper
+
+    if func is not None:
+        return decorator(func)
+    return decorator
 
 
 # ----------------------------------------------------------------------------
 # Утилиты
 # ----------------------------------------------------------------------------
 
+_REQUEST_NOW: ContextVar[Optional[datetime]] = ContextVar("request_now", default=None)
+
+
 def utcnow() -> datetime:
     """Return the current UTC time as naive datetime in UTC zone.
 
@@ -1229,36 +1484,53 @@ def utcnow() -> datetime:
     therefore values loaded back are usually naive. Returning a naive datetime
     keeps arithmetic consistent when we subtract stored values from the current
     timestamp.
+
+    Inside a handler wrapped by ``safe_handler`` this is the request time fixed
+    at handler entry, so all rows written by one update share a timestamp.
     """
 
-    return datetime.utcnow()
+    return _REQUEST_NOW.get() or datetime.utcnow()
 
 
 def ensure_naive(dt: Optional[datetime]) -> Optional[datetime]:
     """Normalize datetime to naive UTC representation."""
 
-    if dt is None:
-        return None
-    if dt.tzinfo is None:
+    # SQLite отдаёт наивные значения — это основной путь, проверяем его первым.
+    if dt is None or dt.tzinfo is None:
         return dt
-    return dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt.replace(tzinfo=None) - dt.utcoffset()
+
+
+_EPOCH = datetime(1970, 1, 1)
+
 
+def to_epoch(dt: datetime) -> int:
+    """Convert a (naive UTC or aware) datetime to integer unix seconds."""
 
-def slice_page(items: List, page: int, page_size: int = 5) -> Tuple[List, bool, bool]:
+    return int((ensure_naive(dt) - _EPOCH).total_seconds())
+
+
+def slice_page(items: Sequence, page: int, page_size: int = 5) -> Tuple[Sequence, bool, bool]:
     """Return sublist for pagination along with availability of prev/next pages."""
 
+    total = len(items)
     start = page * page_size
     end = start + page_size
-    sub = items[start:end]
-    has_prev = page > 0
-    has_next = end < len(items)
-    return sub, has_prev, has_next
+    if start == 0 and end >= total:
+        # Всё помещается на первую страницу — копия не нужна.
+        return items, False, False
+    return items[start:end], page > 0, end < total
 
 
 # ----------------------------------------------------------------------------
 # ORM модели
 # ----------------------------------------------------------------------------
 
+# Ленивые связи в отладке падают при скрытом SELECT (N+1 виден сразу);
+# в проде остаётся обычная ленивая загрузка, чтобы не ронять пользователей.
+RELATIONSHIP_LAZY = "raise_on_sql" if SETTINGS.DEBUG else "select"
+
+
 class Base(DeclarativeBase):
     pass
 
@@ -1289,11 +1561,29 @@ class User(Base):
     daily_bonus_claims: Mapped[int] = mapped_column(Integer, default=0)
     last_special_order_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), default=None)
     daily_task_date: Mapped[Optional[str]] = mapped_column(String(16), default=None)
-    daily_task_state: Mapped[dict] = mapped_column(JSON, default=dict)
+    # Устаревший JSON-формат; читается только для переноса в daily_task_packed.
+    daily_task_state: Mapped[Any] = mapped_column(JSON, default=None, nullable=True)
+    daily_task_packed: Mapped[Optional[int]] = mapped_column(Integer, default=0, nullable=True)
     referrals_count: Mapped[int] = mapped_column(Integer, default=0)
     referred_by: Mapped[Optional[int]] = mapped_column(Integer, default=None)
 
-    orders: Mapped[List["UserOrder"]] = relationship(back_populates="user")
+    orders: Mapped[List["UserOrder"]] = relationship(back_populates="user", lazy=RELATIONSHIP_LAZY)
+
+
+@event.listens_for(User, "load")
+@event.listens_for(User, "refresh")
+def _coerce_user_json(target: User, *_args) -> None:
+    """Validate JSON payload once per load instead of on every access."""
+
+    state = target.__dict__
+    if "tutorial_payload" in state and not isinstance(state["tutorial_payload"], dict):
+        set_committed_value(target, "tutorial_payload", {})
+
+
+@event.listens_for(User, "init")
+def _init_user_json(target: User, args, kwargs) -> None:
+    if not isinstance(kwargs.get("tutorial_payload"), dict):
+        kwargs["tutorial_payload"] = {}
 
 
 class Order(Base):
@@ -1317,7 +1607,8 @@ class UserOrder(Base):
     __tablename__ = "user_orders"
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"), index=True)
+    # Все выборки по user_id — «активный заказ», их обслуживает частичный индекс ниже.
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"))
     order_id: Mapped[int] = mapped_column(ForeignKey("orders.id", ondelete="CASCADE"))
     progress_clicks: Mapped[int] = mapped_column(Integer, default=0)
     required_clicks: Mapped[int] = mapped_column(Integer)
@@ -1330,10 +1621,17 @@ class UserOrder(Base):
     trend_multiplier: Mapped[float] = mapped_column(Float, default=1.0)
     auto_progress_buffer: Mapped[float] = mapped_column(Float, default=0.0)
 
-    user: Mapped["User"] = relationship(back_populates="orders")
-    order: Mapped["Order"] = relationship()
+    user: Mapped["User"] = relationship(back_populates="orders", lazy=RELATIONSHIP_LAZY)
+    order: Mapped["Order"] = relationship(lazy=RELATIONSHIP_LAZY)
     __table_args__ = (
-        Index("ix_user_orders_active", "user_id", "finished", "canceled"),
+        # Частичный индекс: не больше одной строки на игрока — один seek по B-дереву.
+        # Он же покрывает выборку всех активных заказов по системе (SCAN по индексу
+        # только живых строк), поэтому отдельный индекс (finished, user_id) не нужен.
+        Index(
+            "ix_user_orders_user_active",
+            "user_id",
+            sqlite_where=text("finished IS 0 AND canceled IS 0"),
+        ),
     )
 
 
@@ -1354,7 +1652,8 @@ class UserBoost(Base):
     __tablename__ = "user_boosts"
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"), index=True)
+    # Отдельный индекс не нужен: user_id — ведущая колонка uq_user_boost.
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"))
     boost_id: Mapped[int] = mapped_column(ForeignKey("boosts.id", ondelete="CASCADE"))
     level: Mapped[int] = mapped_column(Integer, default=0)
 
@@ -1390,7 +1689,7 @@ class UserPassiveSource(Base):
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"), index=True)
     source_code: Mapped[str] = mapped_column(String(50))
     level: Mapped[int] = mapped_column(Integer, default=1)  # уровни пригодятся, когда появятся апгрейды
-    purchased_at: Mapped[datetime] = mapped_column(DateTime(timezone=True))
+    purchased_at: Mapped[datetime] = mapped_column(DateTime())
 
     __table_args__ = (UniqueConstraint("user_id", "source_code", name="uq_user_passive_source"),)
 
@@ -1400,7 +1699,7 @@ class Item(Base):
 
     id: Mapped[int] = mapped_column(primary_key=True)
     code: Mapped[str] = mapped_column(String(50), unique=True, index=True)
-    name: Mapped[str] = mapped_column(String(120))
+    name: Mapped[str] = mapped_column(String(60))
     slot: Mapped[Literal["laptop", "phone", "tablet", "monitor", "chair", "charm"]] = mapped_column(String(20))
     tier: Mapped[int] = mapped_column(Integer)
     bonus_type: Mapped[Literal["passive_pct", "req_clicks_pct", "reward_pct"]] = mapped_column(String(30))
@@ -1424,7 +1723,8 @@ class UserEquipment(Base):
     __tablename__ = "user_equipment"
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"), index=True)
+    # Отдельный индекс не нужен: user_id — ведущая колонка uq_user_slot.
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"))
     slot: Mapped[Literal["laptop", "phone", "tablet", "monitor", "chair", "charm"]] = mapped_column(String(20))
     item_id: Mapped[Optional[int]] = mapped_column(ForeignKey("items.id", ondelete="SET NULL"), nullable=True)
     __table_args__ = (UniqueConstraint("user_id", "slot", name="uq_user_slot"),)
@@ -1434,11 +1734,15 @@ class EconomyLog(Base):
     __tablename__ = "economy_log"
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"), index=True)
+    # Отдельный индекс не нужен: user_id — ведущая колонка ix_economy_user_created.
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"))
     type: Mapped[str] = mapped_column(String(30))
     amount: Mapped[float] = mapped_column(Float, default=0.0)
-    meta: Mapped[Optional[dict]] = mapped_column(JSON)
-    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True))
+    # none_as_null: meta=None пишется как SQL NULL, а не JSON-строка 'null'.
+    meta: Mapped[Optional[dict]] = mapped_column(JSON(none_as_null=True))
+    # Код ежедневного задания вынесен из meta: самая частая форма, без JSON.
+    meta_task: Mapped[Optional[str]] = mapped_column(String(32), default=None, index=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime())
     __table_args__ = (Index("ix_economy_user_created", "user_id", "created_at"),)
 
 
@@ -1447,8 +1751,8 @@ class Achievement(Base):
 
     id: Mapped[int] = mapped_column(primary_key=True)
     code: Mapped[str] = mapped_column(String(50), unique=True, index=True)
-    name: Mapped[str] = mapped_column(String(150))
-    description: Mapped[str] = mapped_column(String(300))
+    name: Mapped[str] = mapped_column(String(60))
+    description: Mapped[str] = mapped_column(String(120))
     trigger: Mapped[str] = mapped_column(String(30))
     threshold: Mapped[int] = mapped_column(Integer)
     icon: Mapped[str] = mapped_column(String(8), default="🏆")
@@ -1472,7 +1776,7 @@ class RandomEvent(Base):
 
     id: Mapped[int] = mapped_column(primary_key=True)
     code: Mapped[str] = mapped_column(String(50), unique=True, index=True)
-    title: Mapped[str] = mapped_column(String(200))
+    title: Mapped[str] = mapped_column(String(80))
     kind: Mapped[Literal["bonus", "penalty", "buff"]] = mapped_column(String(20))
     amount: Mapped[float] = mapped_column(Float)
     duration_sec: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
@@ -1485,16 +1789,34 @@ class UserBuff(Base):
     __tablename__ = "user_buffs"
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"), index=True)
+    # Отдельный индекс не нужен: user_id — ведущая колонка ix_user_buffs_active.
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"))
     code: Mapped[str] = mapped_column(String(50))
-    title: Mapped[str] = mapped_column(String(200))
+    # Колонка оставлена ради старых БД (NOT NULL); название берётся из каталога событий.
+    stored_title: Mapped[str] = mapped_column("title", String(80), default="")
     expires_at: Mapped[datetime] = mapped_column(DateTime(timezone=True))
+    # Копия expires_at в unix-секундах: фильтр «активен» сравнивает целые, а не ISO-строки.
+    expires_at_ts: Mapped[int] = mapped_column(Integer, default=0)
+    # Бафф события — одна пара «стат → прибавка»; JSON остаётся для ожидающих событий.
+    effect_key: Mapped[Optional[str]] = mapped_column(String(32), default=None)
+    effect_value: Mapped[float] = mapped_column(Float, default=0.0)
     payload: Mapped[dict] = mapped_column(JSON)
 
     __table_args__ = (
-        Index("ix_user_buffs_active", "user_id", "expires_at"),
+        Index("ix_user_buffs_active", "user_id", "expires_at_ts"),
     )
 
+    @property
+    def title(self) -> str:
+        event_code = self.code.removeprefix(PENDING_EVENT_PREFIX)
+        event = catalog_by_code(RandomEvent, event_code)
+        return event.title if event is not None else self.stored_title
+
+
+@event.listens_for(UserBuff.expires_at, "set")
+def _sync_buff_expiry_ts(target: UserBuff, value: Optional[datetime], *_args) -> None:
+    target.expires_at_ts = to_epoch(value) if value is not None else 0
+
 
 class UserQuest(Base):
     __tablename__ = "user_quests"
@@ -1526,7 +1848,7 @@ class Skill(Base):
 
     id: Mapped[int] = mapped_column(primary_key=True)
     code: Mapped[str] = mapped_column(String(50), unique=True, index=True)
-    name: Mapped[str] = mapped_column(String(120))
+    name: Mapped[str] = mapped_column(String(60))
     branch: Mapped[Literal["web", "brand", "art"]] = mapped_column(String(20))
     effect: Mapped[dict] = mapped_column(JSON)
     min_level: Mapped[int] = mapped_column(Integer, default=1)
@@ -1536,9 +1858,10 @@ class UserSkill(Base):
     __tablename__ = "user_skills"
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"), index=True)
+    # Отдельный индекс не нужен: user_id — ведущая колонка uq_user_skill.
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"))
     skill_code: Mapped[str] = mapped_column(ForeignKey("skills.code", ondelete="CASCADE"))
-    taken_at: Mapped[datetime] = mapped_column(DateTime(timezone=True))
+    taken_at: Mapped[datetime] = mapped_column(DateTime())
 
     __table_args__ = (UniqueConstraint("user_id", "skill_code", name="uq_user_skill"),)
 
@@ -1550,7 +1873,7 @@ class UserPrestige(Base):
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"), index=True)
     reputation: Mapped[int] = mapped_column(Integer, default=0)
     resets: Mapped[int] = mapped_column(Integer, default=0)
-    last_reset_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), default=None)
+    last_reset_at: Mapped[Optional[datetime]] = mapped_column(DateTime(), default=None)
 
     __table_args__ = (UniqueConstraint("user_id", name="uq_user_prestige"),)
 
@@ -1563,13 +1886,154 @@ class GlobalState(Base):
     updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True))
 
 
+# ----------------------------------------------------------------------------
+# Запросы горячего пути
+# ----------------------------------------------------------------------------
+# Собраны один раз с bindparam: на каждый вызов не строится новое дерево select(),
+# а ключ кэша компиляции SQLAlchemy остаётся одним и тем же.
+
+SELECT_USER_BY_TG = select(User).where(User.tg_id == bindparam("tg_id"))
+SELECT_ACTIVE_ORDER = select(UserOrder).where(
+    UserOrder.user_id == bindparam("uid"),
+    UserOrder.finished.is_(False),
+    UserOrder.canceled.is_(False),
+)
+# Игрок вместе с активным заказом (или NULL) — один запрос на клик вместо двух.
+SELECT_USER_WITH_ACTIVE_ORDER = (
+    select(User, UserOrder)
+    .outerjoin(
+        UserOrder,
+        and_(
+            UserOrder.user_id == User.id,
+            UserOrder.finished.is_(False),
+            UserOrder.canceled.is_(False),
+        ),
+    )
+    .where(User.tg_id == bindparam("tg_id"))
+    .limit(1)
+)
+# Атомарные приращения клика: параллельные хендлеры одного игрока не теряют клики.
+# keeps_session_memos — DML не трогает ни статы, ни признак активного заказа.
+ADD_USER_CLICKS = (
+    update(User)
+    .where(User.id == bindparam("uid"))
+    .values(clicks_total=User.clicks_total + bindparam("cp"))
+    .returning(User.clicks_total)
+    .execution_options(synchronize_session=False, keeps_session_memos=True)
+)
+ADD_ORDER_PROGRESS = (
+    update(UserOrder)
+    .where(UserOrder.id == bindparam("order_row_id"))
+    .values(
+        progress_clicks=func.min(UserOrder.required_clicks, UserOrder.progress_clicks + bindparam("cp"))
+    )
+    .returning(UserOrder.progress_clicks)
+    .execution_options(synchronize_session=False, keeps_session_memos=True)
+)
+SELECT_USER_BOOST_LEVELS = select(UserBoost.boost_id, UserBoost.level).where(
+    UserBoost.user_id == bindparam("uid")
+)
+# Баффы для статов — только нужные колонки, без сборки ORM-объектов; флаг истечения считает SQLite.
+SELECT_USER_BUFF_EFFECTS = select(
+    UserBuff.id,
+    UserBuff.expires_at_ts,
+    (UserBuff.expires_at_ts <= bindparam("now_ts")).label("expired"),
+    UserBuff.effect_key,
+    UserBuff.effect_value,
+    UserBuff.payload,
+).where(UserBuff.user_id == bindparam("uid"))
+# Сумма team_income_per_min по нанятым сотрудникам игрока — одним скаляром на стороне БД.
+SELECT_TEAM_INCOME_PER_MIN = (
+    select(
+        func.coalesce(
+            func.sum(TeamMember.base_income_per_min * (1 + 0.25 * (UserTeam.level - 1))),
+            0.0,
+        )
+    )
+    .join(UserTeam, TeamMember.id == UserTeam.member_id)
+    .where(UserTeam.user_id == bindparam("uid"), UserTeam.level > 0)
+)
+# Источники статов игрока одним запросом: (вид, id из справочника, код навыка, уровень).
+# Сами бусты, предметы и навыки берутся из каталога в памяти, без JOIN.
+SELECT_USER_STAT_SOURCES = union_all(
+    select(
+        literal("boost").label("kind"),
+        UserBoost.boost_id.label("ref_id"),
+        literal(None, String).label("ref_code"),
+        UserBoost.level.label("level"),
+    ).where(UserBoost.user_id == bindparam("uid"), UserBoost.level > 0),
+    select(
+        literal("item"),
+        UserEquipment.item_id,
+        literal(None, String),
+        literal(0),
+    ).where(UserEquipment.user_id == bindparam("uid"), UserEquipment.item_id.is_not(None)),
+    select(
+        literal("skill"),
+        literal(None, Integer),
+        UserSkill.skill_code,
+        literal(0),
+    ).where(UserSkill.user_id == bindparam("uid")),
+)
+
+
 # ----------------------------------------------------------------------------
 # Подключение к БД
 # ----------------------------------------------------------------------------
 
-engine = create_async_engine(SETTINGS.DATABASE_URL, echo=False, future=True)
+def engine_pool_options(database_url: str) -> Dict[str, Any]:
+    """Connection pool settings for the configured backend."""
+
+    url = make_url(database_url)
+    if url.get_backend_name() == "sqlite":
+        # :memory: работает на одном статическом соединении — пул не настраивается.
+        if url.database in (None, "", ":memory:"):
+            return {}
+        # Локальный файл не рвёт соединения, pre_ping/recycle не нужны; в WAL читатели
+        # идут параллельно, поэтому держим открытыми больше соединений, чем 5 по умолчанию.
+        return {"pool_size": 10, "max_overflow": 10}
+    # Сетевая БД: тёплый пул и проверка соединения перед выдачей.
+    return {
+        "pool_size": 20,
+        "max_overflow": 10,
+        "pool_timeout": 30,
+        "pool_pre_ping": True,
+        "pool_recycle": 1800,
+    }
+
+
+engine = create_async_engine(
+    SETTINGS.DATABASE_URL,
+    echo=False,
+    future=True,
+    json_serializer=_json_dumps,
+    json_deserializer=_json_loads,
+    **engine_pool_options(SETTINGS.DATABASE_URL),
+)
 async_session_maker = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
 
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-65536",
+)
+
+
+if engine.dialect.name == "sqlite":
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def _apply_sqlite_pragmas(dbapi_connection, _connection_record) -> None:
+        """WAL + synchronous=NORMAL: one fsync per checkpoint instead of per commit."""
+
+        cursor = dbapi_connection.cursor()
+        try:
+            for pragma in SQLITE_PRAGMAS:
+                cursor.execute(pragma)
+        finally:
+            cursor.close()
+
 
 async def init_models() -> None:
     """Create database tables if they do not exist."""
@@ -1577,6 +2041,90 @@ async def init_models() -> None:
         await conn.run_sync(Base.metadata.create_all)
 
 
+# Кэши сущностей на время сессии (get_user_by_tg, get_prestige_entry, get_user_stats,
+# get_active_order) и незакоммиченные изменения статов (stats_changed_uids).
+_SESSION_ENTITY_CACHES = ("users_by_tg", "prestige", "user_stats", "active_order", "stats_changed_uids")
+
+
+@event.listens_for(Session, "after_rollback")
+def _drop_session_entity_caches(session: Session) -> None:
+    """After rollback cached ORM objects may be expunged or stale — forget them."""
+
+    for key in _SESSION_ENTITY_CACHES:
+        session.info.pop(key, None)
+
+
+def queue_write(session: AsyncSession, entity: Any) -> None:
+    """Defer an insert-only entity (e.g. EconomyLog) until the scope commits.
+
+    Keeps append-only rows out of the autoflushes triggered by later SELECTs
+    inside the same handler. Other entities are written in the final commit;
+    economy logs go to the process buffer after a successful commit and are
+    inserted by ``economy_log_flusher``.
+    Code that reads EconomyLog must call ``flush_queued_writes`` first, and its
+    handler must ``await drain_economy_log_buffer()`` before opening the session.
+    """
+
+    session.info.setdefault("write_buffer", []).append(entity)
+
+
+_ECONOMY_LOG_FIELDS = ("user_id", "type", "amount", "meta", "meta_task", "created_at")
+ECONOMY_LOG_FLUSH_SECONDS = 0.25
+# Буфер не обрезаем (это аудит), но громко сообщаем, если БД долго не принимает записи.
+ECONOMY_LOG_BUFFER_WARN_ROWS = 10_000
+
+# Строки economy_log из уже закоммиченных запросов, ждущие фоновой записи.
+# Журнал — аудит, а не баланс: при падении процесса теряется не больше ~250 мс записей.
+# Буфер принадлежит только drain_economy_log_buffer; лок держится, пока пачка в полёте.
+_ECONOMY_LOG_BUFFER: List[Dict[str, Any]] = []
+_ECONOMY_LOG_DRAIN_LOCK = asyncio.Lock()
+
+
+async def flush_queued_writes(
+    session: AsyncSession, *, defer_logs: bool = False
+) -> List[Dict[str, Any]]:
+    """Write buffered rows: economy logs as one multi-row INSERT, the rest via the ORM.
+
+    With ``defer_logs`` the economy log rows are returned instead of inserted,
+    so the caller can hand them to the process buffer after commit. Otherwise
+    they are inserted in this session. The process buffer is never touched here:
+    rows of other, already committed requests must not share this transaction.
+    """
+
+    pending = session.info.pop("write_buffer", None)
+    if not pending:
+        pending = ()
+    log_rows: List[Dict[str, Any]] = []
+    others: List[Any] = []
+    for entity in pending:
+        if isinstance(entity, EconomyLog):
+            log_rows.append({field: getattr(entity, field) for field in _ECONOMY_LOG_FIELDS})
+        else:
+            others.append(entity)
+    if others:
+        session.add_all(others)
+    if defer_logs:
+        return log_rows
+    if log_rows:
+        await session.execute(insert(EconomyLog), log_rows)
+    return []
+
+
+EQUIPMENT_SLOTS: Tuple[str, ...] = ("laptop", "phone", "tablet", "monitor", "chair", "charm")
+
+
+async def init_user_equipment(session: AsyncSession, user_id: int) -> None:
+    """Create or clear all equipment slots of a user with a single multi-row upsert."""
+
+    stmt = sqlite_insert(UserEquipment).values(
+        [{"user_id": user_id, "slot": slot, "item_id": None} for slot in EQUIPMENT_SLOTS]
+    )
+    await session.execute(
+        stmt.on_conflict_do_update(index_elements=["user_id", "slot"], set_={"item_id": None}),
+        execution_options={"user_id": user_id},
+    )
+
+
 @asynccontextmanager
 async def session_scope() -> AsyncIterator[AsyncSession]:
     """Provide a transactional scope for database work with automatic commit/rollback."""
@@ -1584,397 +2132,555 @@ async def session_scope() -> AsyncIterator[AsyncSession]:
         try:
             async with session.begin():
                 yield session
+                deferred_logs = await flush_queued_writes(session, defer_logs=True)
         except Exception:
             logger.exception("Session rollback due to error.")
             raise
+    _ECONOMY_LOG_BUFFER.extend(deferred_logs)
 
 
-async def prepare_database() -> None:
-    """Ensure that database schema and seed data are initialized exactly once."""
-    async with session_scope() as session:
-        await ensure_schema(session)
-        await seed_if_needed(session)
-
+async def drain_economy_log_buffer() -> None:
+    """Insert all buffered economy log rows with one executemany.
 
-async def ensure_schema(session: AsyncSession) -> None:
-    """Add missing columns/tables for backward compatibility without full migrations."""
+    Runs under a lock, so after it returns every row buffered before the call
+    (including a batch the flusher had in flight) is committed. Readers of
+    EconomyLog await it before opening their own session: SQLite has a single
+    writer, so draining from inside a session that already wrote would block.
+    """
 
-    async def _existing_columns(table: str) -> Set[str]:
-        rows = await session.execute(text(f"PRAGMA table_info({table})"))
-        return {row[1] for row in rows}
-
-    user_columns = await _existing_columns("users")
-    if "tutorial_stage" not in user_columns:
-        await session.execute(text("ALTER TABLE users ADD COLUMN tutorial_stage INTEGER NOT NULL DEFAULT 0"))
-    if "tutorial_completed_at" not in user_columns:
-        await session.execute(text("ALTER TABLE users ADD COLUMN tutorial_completed_at DATETIME"))
-    if "tutorial_payload" not in user_columns:
-        await session.execute(text("ALTER TABLE users ADD COLUMN tutorial_payload JSON DEFAULT '{}'"))
-    if "tutorial_free_boost_used" not in user_columns:
-        await session.execute(
-            text("ALTER TABLE users ADD COLUMN tutorial_free_boost_used BOOLEAN NOT NULL DEFAULT 0")
-        )
-    if "clicks_total" not in user_columns:
-        await session.execute(text("ALTER TABLE users ADD COLUMN clicks_total INTEGER NOT NULL DEFAULT 0"))
-    if "orders_completed" not in user_columns:
-        await session.execute(text("ALTER TABLE users ADD COLUMN orders_completed INTEGER NOT NULL DEFAULT 0"))
-    if "passive_income_collected" not in user_columns:
-        await session.execute(text("ALTER TABLE users ADD COLUMN passive_income_collected INTEGER NOT NULL DEFAULT 0"))
-    if "daily_bonus_claims" not in user_columns:
-        await session.execute(text("ALTER TABLE users ADD COLUMN daily_bonus_claims INTEGER NOT NULL DEFAULT 0"))
-    if "last_special_order_at" not in user_columns:
-        await session.execute(text("ALTER TABLE users ADD COLUMN last_special_order_at DATETIME"))
-    if "daily_task_date" not in user_columns:
-        await session.execute(text("ALTER TABLE users ADD COLUMN daily_task_date TEXT"))
-    if "daily_task_state" not in user_columns:
-        await session.execute(text("ALTER TABLE users ADD COLUMN daily_task_state JSON DEFAULT '{}'"))
-    if "referrals_count" not in user_columns:
-        await session.execute(text("ALTER TABLE users ADD COLUMN referrals_count INTEGER NOT NULL DEFAULT 0"))
-    if "referred_by" not in user_columns:
-        await session.execute(text("ALTER TABLE users ADD COLUMN referred_by INTEGER"))
-
-    order_columns = await _existing_columns("orders")
-    if "is_special" not in order_columns:
-        await session.execute(text("ALTER TABLE orders ADD COLUMN is_special BOOLEAN NOT NULL DEFAULT 0"))
-
-    user_order_columns = await _existing_columns("user_orders")
-    if "is_special" not in user_order_columns:
-        await session.execute(text("ALTER TABLE user_orders ADD COLUMN is_special BOOLEAN NOT NULL DEFAULT 0"))
-    if "trend_applied" not in user_order_columns:
-        await session.execute(text("ALTER TABLE user_orders ADD COLUMN trend_applied BOOLEAN NOT NULL DEFAULT 0"))
-    if "trend_multiplier" not in user_order_columns:
-        await session.execute(text("ALTER TABLE user_orders ADD COLUMN trend_multiplier FLOAT NOT NULL DEFAULT 1.0"))
-    if "auto_progress_buffer" not in user_order_columns:
-        await session.execute(
-            text("ALTER TABLE user_orders ADD COLUMN auto_progress_buffer FLOAT NOT NULL DEFAULT 0.0")
-        )
+    async with _ECONOMY_LOG_DRAIN_LOCK:
+        if not _ECONOMY_LOG_BUFFER:
+            return
+        batch = _ECONOMY_LOG_BUFFER[:]
+        _ECONOMY_LOG_BUFFER.clear()
+        try:
+            async with session_scope() as session:
+                await session.execute(insert(EconomyLog), batch)
+        except BaseException as exc:
+            # Вернём строки в начало буфера — повторим на следующем тике. BaseException:
+            # отмена фонового таска посреди INSERT не должна терять пачку.
+            _ECONOMY_LOG_BUFFER[:0] = batch
+            if not isinstance(exc, Exception):
+                raise
+            if len(_ECONOMY_LOG_BUFFER) >= ECONOMY_LOG_BUFFER_WARN_ROWS:
+                logger.warning(
+                    "Economy log buffer is backing up",
+                    extra={"rows": len(_ECONOMY_LOG_BUFFER)},
+                )
 
-    order_columns = await _existing_columns("orders")
-    if "reward_multiplier" not in order_columns:
-        await session.execute(
-            text("ALTER TABLE orders ADD COLUMN reward_multiplier FLOAT NOT NULL DEFAULT 1.0")
-        )
-    if "reward_preview" not in order_columns:
-        await session.execute(
-            text("ALTER TABLE orders ADD COLUMN reward_preview INTEGER NOT NULL DEFAULT 0")
-        )
-    if "difficulty" not in order_columns:
-        await session.execute(
-            text("ALTER TABLE orders ADD COLUMN difficulty TEXT NOT NULL DEFAULT 'normal'")
-        )
-    if "estimated_minutes" not in order_columns:
+
+async def economy_log_flusher() -> None:
+    """Background task: periodically drain the economy log buffer."""
+
+    while True:
+        await asyncio.sleep(ECONOMY_LOG_FLUSH_SECONDS)
+        await drain_economy_log_buffer()
+
+
+async def prepare_database() -> None:
+    """Ensure that database schema and seed data are initialized exactly once."""
+    async with session_scope() as session:
+        # Всё в одной транзакции; без автофлаша правки существующих сидов уходят
+        # одним flush при коммите, а не перед каждым SELECT/INSERT.
+        with session.no_autoflush:
+            await ensure_schema(session)
+            await seed_if_needed(session)
+            await load_catalog(session)
+
+
+# Версия схемы в PRAGMA user_version; повышать при любом изменении ensure_schema.
+SCHEMA_VERSION = 10
+
+# Колонки, добавленные после первых релизов: таблица -> ((колонка, DDL), ...).
+SCHEMA_ADDED_COLUMNS: Dict[str, Tuple[Tuple[str, str], ...]] = {
+    "users": (
+        ("tutorial_stage", "INTEGER NOT NULL DEFAULT 0"),
+        ("tutorial_completed_at", "DATETIME"),
+        ("tutorial_payload", "JSON DEFAULT '{}'"),
+        ("tutorial_free_boost_used", "BOOLEAN NOT NULL DEFAULT 0"),
+        ("clicks_total", "INTEGER NOT NULL DEFAULT 0"),
+        ("orders_completed", "INTEGER NOT NULL DEFAULT 0"),
+        ("passive_income_collected", "INTEGER NOT NULL DEFAULT 0"),
+        ("daily_bonus_claims", "INTEGER NOT NULL DEFAULT 0"),
+        ("last_special_order_at", "DATETIME"),
+        ("daily_task_date", "TEXT"),
+        ("daily_task_state", "JSON DEFAULT '{}'"),
+        # NULL = ещё не перенесено из daily_task_state (см. ensure_daily_task_state).
+        ("daily_task_packed", "INTEGER"),
+        ("referrals_count", "INTEGER NOT NULL DEFAULT 0"),
+        ("referred_by", "INTEGER"),
+    ),
+    "orders": (
+        ("is_special", "BOOLEAN NOT NULL DEFAULT 0"),
+        ("reward_multiplier", "FLOAT NOT NULL DEFAULT 1.0"),
+        ("reward_preview", "INTEGER NOT NULL DEFAULT 0"),
+        ("difficulty", "TEXT NOT NULL DEFAULT 'normal'"),
+        ("estimated_minutes", "INTEGER NOT NULL DEFAULT 30"),
+        ("rarity", "TEXT NOT NULL DEFAULT 'common'"),
+        ("appearance_weight", "FLOAT NOT NULL DEFAULT 0.0"),
+    ),
+    "user_orders": (
+        ("is_special", "BOOLEAN NOT NULL DEFAULT 0"),
+        ("trend_applied", "BOOLEAN NOT NULL DEFAULT 0"),
+        ("trend_multiplier", "FLOAT NOT NULL DEFAULT 1.0"),
+        ("auto_progress_buffer", "FLOAT NOT NULL DEFAULT 0.0"),
+    ),
+    "boosts": (("min_level", "INTEGER NOT NULL DEFAULT 1"),),
+    "items": (("obtain", "TEXT"),),
+    "team_members": (("min_level", "INTEGER NOT NULL DEFAULT 1"),),
+    "economy_log": (("meta_task", "VARCHAR(32)"),),
+    "random_events": (("interactive", "BOOLEAN NOT NULL DEFAULT 0"),),
+    "user_buffs": (
+        ("effect_key", "VARCHAR(32)"),
+        ("effect_value", "FLOAT NOT NULL DEFAULT 0.0"),
+        ("expires_at_ts", "INTEGER NOT NULL DEFAULT 0"),
+    ),
+}
+
+# Индексы, которые перекрыты другими (составными или частичными) и только тормозят запись.
+SCHEMA_REDUNDANT_INDEXES: Tuple[str, ...] = (
+    "ix_user_orders_user_id",
+    "ix_user_orders_active",
+    "ix_economy_log_user_id",
+    "ix_user_buffs_user_id",
+    "ix_user_boosts_user_id",
+    "ix_user_equipment_user_id",
+    "ix_user_skills_user_id",
+)
+
+# Одним запросом получаем все пары (таблица, колонка) вместо PRAGMA на каждую таблицу.
+_SCHEMA_COLUMNS_SQL = (
+    "SELECT m.name, p.name FROM sqlite_master AS m "
+    "JOIN pragma_table_info(m.name) AS p WHERE m.type = 'table'"
+)
+
+
+async def ensure_schema(session: AsyncSession) -> None:
+    """Add missing columns/tables for backward compatibility without full migrations."""
+    version = (await session.execute(text("PRAGMA user_version"))).scalar()
+    if version == SCHEMA_VERSION:
+        return
+
+    existing: Dict[str, Set[str]] = defaultdict(set)
+    for table, column in (await session.execute(text(_SCHEMA_COLUMNS_SQL))).all():
+        existing[table].add(column)
+
+    added: Set[Tuple[str, str]] = set()
+    for table, columns in SCHEMA_ADDED_COLUMNS.items():
+        present = existing.get(table)
+        if present is None:
+            # Таблицы ещё нет — её целиком создаст create_all.
+            continue
+        for column, ddl in columns:
+            if column not in present:
+                await session.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+                added.add((table, column))
+
+    if ("economy_log", "meta_task") in added:
         await session.execute(
             text(
-                "ALTER TABLE orders ADD COLUMN estimated_minutes INTEGER NOT NULL DEFAULT 30"
+                "UPDATE economy_log SET meta_task = json_extract(meta, '$.task') "
+                "WHERE type = 'daily_task' AND meta IS NOT NULL"
             )
         )
-    if "rarity" not in order_columns:
+    await session.execute(
+        text("CREATE INDEX IF NOT EXISTS ix_economy_log_meta_task ON economy_log (meta_task)")
+    )
+    # Строки, записанные до none_as_null с JSON 'null' вместо NULL.
+    await session.execute(text("UPDATE economy_log SET meta = NULL WHERE meta = 'null'"))
+    if ("user_buffs", "effect_key") in added:
+        # Одноключевые баффы переносим из JSON в типизированные колонки.
         await session.execute(
-            text("ALTER TABLE orders ADD COLUMN rarity TEXT NOT NULL DEFAULT 'common'")
+            text(
+                "UPDATE user_buffs SET "
+                "effect_key = (SELECT key FROM json_each(payload)), "
+                "effect_value = (SELECT value FROM json_each(payload)), "
+                "payload = '{}' "
+                "WHERE json_valid(payload) AND json_type(payload) = 'object' "
+                "AND (SELECT count(*) FROM json_each(payload)) = 1 "
+                "AND (SELECT type FROM json_each(payload)) IN ('integer', 'real')"
+            )
         )
-    if "appearance_weight" not in order_columns:
+
+    if ("user_buffs", "expires_at_ts") in added:
         await session.execute(
-            text("ALTER TABLE orders ADD COLUMN appearance_weight FLOAT NOT NULL DEFAULT 0.0")
+            text("UPDATE user_buffs SET expires_at_ts = CAST(strftime('%s', expires_at) AS INTEGER)")
         )
-
-    boost_columns = await _existing_columns("boosts")
-    if "min_level" not in boost_columns:
+        # Индекс активных баффов переезжает на целочисленную колонку.
+        await session.execute(text("DROP INDEX IF EXISTS ix_user_buffs_active"))
         await session.execute(
-            text("ALTER TABLE boosts ADD COLUMN min_level INTEGER NOT NULL DEFAULT 1")
+            text("CREATE INDEX ix_user_buffs_active ON user_buffs (user_id, expires_at_ts)")
         )
 
-    item_columns = await _existing_columns("items")
-    if "obtain" not in item_columns:
-        await session.execute(text("ALTER TABLE items ADD COLUMN obtain TEXT"))
-
-    team_columns = await _existing_columns("team_members")
-    if "min_level" not in team_columns:
-        await session.execute(text("ALTER TABLE team_members ADD COLUMN min_level INTEGER NOT NULL DEFAULT 1"))
+    # Названия баффов берутся из каталога событий — дубли в строках больше не нужны.
+    await session.execute(
+        text(
+            "UPDATE user_buffs SET title = '' WHERE title != '' AND ("
+            "code IN (SELECT code FROM random_events) OR "
+            "substr(code, :skip) IN (SELECT code FROM random_events))"
+        ),
+        {"skip": len(PENDING_EVENT_PREFIX) + 1},
+    )
 
-    random_event_columns = await _existing_columns("random_events")
-    if "interactive" not in random_event_columns:
-        await session.execute(text("ALTER TABLE random_events ADD COLUMN interactive BOOLEAN NOT NULL DEFAULT 0"))
+    for index_name in SCHEMA_REDUNDANT_INDEXES:
+        await session.execute(text(f"DROP INDEX IF EXISTS {index_name}"))
 
-    tables = {
-        row[0]
-        for row in (await session.execute(text("SELECT name FROM sqlite_master WHERE type='table'"))).all()
-    }
-    if "global_state" not in tables:
+    if "global_state" not in existing:
         await session.execute(
             text(
                 "CREATE TABLE IF NOT EXISTS global_state ("
                 "key TEXT PRIMARY KEY, value JSON, updated_at DATETIME)"
             )
         )
+    await session.execute(
+        text(
+            "CREATE INDEX IF NOT EXISTS ix_user_orders_user_active "
+            "ON user_orders (user_id) WHERE finished IS 0 AND canceled IS 0"
+        )
+    )
+    await session.execute(text(f"PRAGMA user_version = {SCHEMA_VERSION}"))
 
 
 # ----------------------------------------------------------------------------
 # Сиды данных (встроенные)
 # ----------------------------------------------------------------------------
 
-SEED_ORDERS = [
-    {
-        "title": "Аватар для соцсетей",
-        "base_clicks": 80,
-        "min_level": 1,
-        "difficulty": "easy",
-        "estimated_minutes": 5,
-    },
-    {
-        "title": "Визитка для фрилансера",
-        "base_clicks": 100,
-        "min_level": 1,
-        "difficulty": "easy",
-        "estimated_minutes": 7,
-    },
-    {
-        "title": "Серия сторис для Instagram",
-        "base_clicks": 200,
-        "min_level": 1,
-        "difficulty": "easy",
-        "estimated_minutes": 10,
-        "reward_multiplier": 1.05,
-    },
-    {
-        "title": "Обложка для VK",
-        "base_clicks": 180,
-        "min_level": 1,
-        "difficulty": "normal",
-        "estimated_minutes": 12,
-    },
-    {
-        "title": "Логотип для кафе",
-        "base_clicks": 300,
-        "min_level": 2,
-        "difficulty": "normal",
-        "estimated_minutes": 20,
-        "reward_multiplier": 1.1,
-    },
-    {
-        "title": "Презентация для стартапа",
-        "base_clicks": 420,
-        "min_level": 2,
-        "difficulty": "normal",
-        "estimated_minutes": 25,
-        "reward_multiplier": 1.15,
-    },
-    {
-        "title": "Пакет баннеров для рекламы",
-        "base_clicks": 900,
-        "min_level": 3,
-        "difficulty": "normal",
-        "estimated_minutes": 40,
-        "reward_multiplier": 1.05,
-    },
-    {
-        "title": "Лендинг (1 экран)",
-        "base_clicks": 600,
-        "min_level": 3,
-        "difficulty": "normal",
-        "estimated_minutes": 35,
-    },
-    {
-        "title": "Контент-план для рассылки",
-        "base_clicks": 1400,
-        "min_level": 4,
-        "difficulty": "normal",
-        "estimated_minutes": 45,
-        "reward_multiplier": 1.05,
-    },
-    {
-        "title": "Редизайн логотипа",
-        "base_clicks": 800,
-        "min_level": 4,
-        "difficulty": "hard",
-        "estimated_minutes": 45,
-        "reward_multiplier": 1.1,
-    },
-    {
-        "title": "Новогодний мерч для подписчиков",
-        "base_clicks": 1600,
-        "min_level": 4,
-        "difficulty": "normal",
-        "estimated_minutes": 50,
-        "reward_multiplier": 1.3,
-        "rarity": "holiday",
-        "appearance_weight": 0.15,
-    },
-    {
-        "title": "Хэллоуинская промо-страница",
-        "base_clicks": 1900,
-        "min_level": 5,
-        "difficulty": "hard",
-        "estimated_minutes": 55,
-        "reward_multiplier": 1.2,
-        "rarity": "holiday",
-        "appearance_weight": 0.12,
-    },
-    {
-        "title": "Брендбук (мини)",
-        "base_clicks": 1200,
-        "min_level": 5,
-        "difficulty": "hard",
-        "estimated_minutes": 60,
-    },
-    {
-        "title": "UX-аудит мобильного приложения",
-        "base_clicks": 2200,
-        "min_level": 6,
-        "difficulty": "hard",
-        "estimated_minutes": 75,
-    },
-    {
-        "title": "Коллекционный NFT-дроп",
-        "base_clicks": 2600,
-        "min_level": 7,
-        "difficulty": "hard",
-        "estimated_minutes": 90,
-        "reward_multiplier": 1.35,
-        "rarity": "rare",
-        "appearance_weight": 0.25,
-    },
-    {
-        "title": "Редизайн приложения (ядро)",
-        "base_clicks": 3000,
-        "min_level": 8,
-        "difficulty": "hard",
-        "estimated_minutes": 110,
-    },
-    {
-        "title": "Виртуальный шоурум в VR",
-        "base_clicks": 4800,
-        "min_level": 11,
-        "difficulty": "expert",
-        "estimated_minutes": 130,
-        "reward_multiplier": 1.4,
-        "rarity": "rare",
-        "appearance_weight": 0.2,
-    },
-    {
-        "title": "Брендинг для корпорации",
-        "base_clicks": 4200,
-        "min_level": 10,
-        "difficulty": "expert",
-        "estimated_minutes": 140,
-        "reward_multiplier": 1.15,
-    },
-    {
-        "title": "Сайт компании 5 экранов",
-        "base_clicks": 5500,
-        "min_level": 12,
-        "difficulty": "expert",
-        "estimated_minutes": 160,
-    },
-    {
-        "title": "Международная кампания бренда",
-        "base_clicks": 8000,
-        "min_level": 15,
-        "difficulty": "expert",
-        "estimated_minutes": 210,
-        "reward_multiplier": 1.2,
-    },
-    {
-        "title": "Глобальный ребрендинг",
-        "base_clicks": 12000,
-        "min_level": 18,
-        "difficulty": "expert",
-        "estimated_minutes": 280,
-        "reward_multiplier": 1.25,
-    },
-    {
-        "title": "Особый заказ: Айдентика фестиваля",
-        "base_clicks": 1800,
-        "min_level": SPECIAL_ORDER_MIN_LEVEL,
-        "is_special": True,
-        "difficulty": "hard",
-        "estimated_minutes": 90,
-        "reward_multiplier": 1.8,
-    },
-]
+# Сиды справочников — неизменяемые кортежи NamedTuple; _asdict() даёт строку для INSERT.
+
+
+class OrderSeed(NamedTuple):
+    title: str
+    base_clicks: int
+    min_level: int
+    difficulty: str = "normal"
+    estimated_minutes: int = 30
+    reward_multiplier: float = 1.0
+    is_special: bool = False
+    rarity: str = "common"
+    appearance_weight: float = 0.0
+
+
+class BoostSeed(NamedTuple):
+    code: str
+    name: str
+    type: str
+    base_cost: int
+    growth: float
+    step_value: float
+    min_level: int = 1
+
+
+class TeamSeed(NamedTuple):
+    code: str
+    name: str
+    base_income_per_min: int
+    base_cost: int
+    min_level: int = 1
+
+
+class ItemSeed(NamedTuple):
+    code: str
+    name: str
+    slot: str
+    tier: int
+    bonus_type: str
+    bonus_value: float
+    price: int
+    min_level: int
+    obtain: Optional[str] = None
+
+
+class AchievementSeed(NamedTuple):
+    code: str
+    name: str
+    description: str
+    trigger: str
+    threshold: int
+    icon: str
+
+
+class RandomEventSeed(NamedTuple):
+    code: str
+    title: str
+    kind: str
+    amount: float
+    duration_sec: Optional[int]
+    weight: int
+    min_level: int
+    interactive: bool = False
+
+
+class SkillSeed(NamedTuple):
+    code: str
+    name: str
+    branch: str
+    effect: Dict[str, float]
+    min_level: int
+
+
+SEED_ORDERS = (
+    OrderSeed(
+        title="Аватар для соцсетей",
+        base_clicks=80,
+        min_level=1,
+        difficulty="easy",
+        estimated_minutes=5,
+    ),
+    OrderSeed(
+        title="Визитка для фрилансера",
+        base_clicks=100,
+        min_level=1,
+        difficulty="easy",
+        estimated_minutes=7,
+    ),
+    OrderSeed(
+        title="Серия сторис для Instagram",
+        base_clicks=200,
+        min_level=1,
+        difficulty="easy",
+        estimated_minutes=10,
+        reward_multiplier=1.05,
+    ),
+    OrderSeed(
+        title="Обложка для VK",
+        base_clicks=180,
+        min_level=1,
+        difficulty="normal",
+        estimated_minutes=12,
+    ),
+    OrderSeed(
+        title="Логотип для кафе",
+        base_clicks=300,
+        min_level=2,
+        difficulty="normal",
+        estimated_minutes=20,
+        reward_multiplier=1.1,
+    ),
+    OrderSeed(
+        title="Презентация для стартапа",
+        base_clicks=420,
+        min_level=2,
+        difficulty="normal",
+        estimated_minutes=25,
+        reward_multiplier=1.15,
+    ),
+    OrderSeed(
+        title="Пакет баннеров для рекламы",
+        base_clicks=900,
+        min_level=3,
+        difficulty="normal",
+        estimated_minutes=40,
+        reward_multiplier=1.05,
+    ),
+    OrderSeed(
+        title="Лендинг (1 экран)",
+        base_clicks=600,
+        min_level=3,
+        difficulty="normal",
+        estimated_minutes=35,
+    ),
+    OrderSeed(
+        title="Контент-план для рассылки",
+        base_clicks=1400,
+        min_level=4,
+        difficulty="normal",
+        estimated_minutes=45,
+        reward_multiplier=1.05,
+    ),
+    OrderSeed(
+        title="Редизайн логотипа",
+        base_clicks=800,
+        min_level=4,
+        difficulty="hard",
+        estimated_minutes=45,
+        reward_multiplier=1.1,
+    ),
+    OrderSeed(
+        title="Новогодний мерч для подписчиков",
+        base_clicks=1600,
+        min_level=4,
+        difficulty="normal",
+        estimated_minutes=50,
+        reward_multiplier=1.3,
+        rarity="holiday",
+        appearance_weight=0.15,
+    ),
+    OrderSeed(
+        title="Хэллоуинская промо-страница",
+        base_clicks=1900,
+        min_level=5,
+        difficulty="hard",
+        estimated_minutes=55,
+        reward_multiplier=1.2,
+        rarity="holiday",
+        appearance_weight=0.12,
+    ),
+    OrderSeed(
+        title="Брендбук (мини)",
+        base_clicks=1200,
+        min_level=5,
+        difficulty="hard",
+        estimated_minutes=60,
+    ),
+    OrderSeed(
+        title="UX-аудит мобильного приложения",
+        base_clicks=2200,
+        min_level=6,
+        difficulty="hard",
+        estimated_minutes=75,
+    ),
+    OrderSeed(
+        title="Коллекционный NFT-дроп",
+        base_clicks=2600,
+        min_level=7,
+        difficulty="hard",
+        estimated_minutes=90,
+        reward_multiplier=1.35,
+        rarity="rare",
+        appearance_weight=0.25,
+    ),
+    OrderSeed(
+        title="Редизайн приложения (ядро)",
+        base_clicks=3000,
+        min_level=8,
+        difficulty="hard",
+        estimated_minutes=110,
+    ),
+    OrderSeed(
+        title="Виртуальный шоурум в VR",
+        base_clicks=4800,
+        min_level=11,
+        difficulty="expert",
+        estimated_minutes=130,
+        reward_multiplier=1.4,
+        rarity="rare",
+        appearance_weight=0.2,
+    ),
+    OrderSeed(
+        title="Брендинг для корпорации",
+        base_clicks=4200,
+        min_level=10,
+        difficulty="expert",
+        estimated_minutes=140,
+        reward_multiplier=1.15,
+    ),
+    OrderSeed(
+        title="Сайт компании 5 экранов",
+        base_clicks=5500,
+        min_level=12,
+        difficulty="expert",
+        estimated_minutes=160,
+    ),
+    OrderSeed(
+        title="Международная кампания бренда",
+        base_clicks=8000,
+        min_level=15,
+        difficulty="expert",
+        estimated_minutes=210,
+        reward_multiplier=1.2,
+    ),
+    OrderSeed(
+        title="Глобальный ребрендинг",
+        base_clicks=12000,
+        min_level=18,
+        difficulty="expert",
+        estimated_minutes=280,
+        reward_multiplier=1.25,
+    ),
+    OrderSeed(
+        title="Особый заказ: Айдентика фестиваля",
+        base_clicks=1800,
+        min_level=SPECIAL_ORDER_MIN_LEVEL,
+        is_special=True,
+        difficulty="hard",
+        estimated_minutes=90,
+        reward_multiplier=1.8,
+    ),
+)
 
-SEED_BOOSTS = [
-    {
-        "code": "reward_mastery",
-        "name": "🎯 Мастерство гонораров",
-        "type": "reward",
-        "base_cost": 320,
-        "growth": BOOST_COST_GROWTH,
-        "step_value": 0.15,
-        "min_level": 1,
-    },
-    {
-        "code": "accelerated_learning",
-        "name": "📚 Спринт обучения",
-        "type": "xp",
-        "base_cost": 560,
-        "growth": BOOST_COST_GROWTH,
-        "step_value": 0.12,
-        "min_level": 1,
-    },
-    {
-        "code": "requirement_relief",
-        "name": "🧭 Мягкие брифы",
-        "type": "req_clicks",
-        "base_cost": 980,
-        "growth": BOOST_COST_GROWTH,
-        "step_value": 0.04,
-        "min_level": 5,
-    },
-    {
-        "code": "quick_briefs",
-        "name": "📦 Быстрый старт",
-        "type": "free_order",
-        "base_cost": 1040,
-        "growth": BOOST_COST_GROWTH,
-        "step_value": 0.05,
-        "min_level": 5,
-    },
-    {
-        "code": "contractor_discount",
-        "name": "🧾 Лояльные подрядчики",
-        "type": "team_discount",
-        "base_cost": 1080,
-        "growth": BOOST_COST_GROWTH,
-        "step_value": 0.06,
-        "min_level": 5,
-    },
-    {
-        "code": "tight_deadlines",
-        "name": "⏱️ Бонус за скорость",
-        "type": "rush_reward",
-        "base_cost": 1200,
-        "growth": BOOST_COST_GROWTH,
-        "step_value": 0.07,
-        "min_level": 5,
-    },
-    {
-        "code": "gear_tuning",
-        "name": "🧰 Тюнинг студии",
-        "type": "equipment_eff",
-        "base_cost": 1280,
-        "growth": BOOST_COST_GROWTH,
-        "step_value": 0.06,
-        "min_level": 5,
-    },
-    {
-        "code": "shop_wholesale",
-        "name": "🛍️ Оптовые закупки",
-        "type": "shop_discount",
-        "base_cost": 1420,
-        "growth": BOOST_COST_GROWTH,
-        "step_value": 0.05,
-        "min_level": 5,
-    },
-    {
-        "code": "premium_projects",
-        "name": "🎯 Премиум-проекты",
-        "type": "high_order_reward",
-        "base_cost": 1500,
-        "growth": BOOST_COST_GROWTH,
-        "step_value": 0.10,
-        "min_level": 5,
-    },
-]
+SEED_BOOSTS = (
+    BoostSeed(
+        code="reward_mastery",
+        name="🎯 Мастерство гонораров",
+        type="reward",
+        base_cost=320,
+        growth=BOOST_COST_GROWTH,
+        step_value=0.15,
+        min_level=1,
+    ),
+    BoostSeed(
+        code="accelerated_learning",
+        name="📚 Спринт обучения",
+        type="xp",
+        base_cost=560,
+        growth=BOOST_COST_GROWTH,
+        step_value=0.12,
+        min_level=1,
+    ),
+    BoostSeed(
+        code="requirement_relief",
+        name="🧭 Мягкие брифы",
+        type="req_clicks",
+        base_cost=980,
+        growth=BOOST_COST_GROWTH,
+        step_value=0.04,
+        min_level=5,
+    ),
+    BoostSeed(
+        code="quick_briefs",
+        name="📦 Быстрый старт",
+        type="free_order",
+        base_cost=1040,
+        growth=BOOST_COST_GROWTH,
+        step_value=0.05,
+        min_level=5,
+    ),
+    BoostSeed(
+        code="contractor_discount",
+        name="🧾 Лояльные подрядчики",
+        type="team_discount",
+        base_cost=1080,
+        growth=BOOST_COST_GROWTH,
+        step_value=0.06,
+        min_level=5,
+    ),
+    BoostSeed(
+        code="tight_deadlines",
+        name="⏱️ Бонус за скорость",
+        type="rush_reward",
+        base_cost=1200,
+        growth=BOOST_COST_GROWTH,
+        step_value=0.07,
+        min_level=5,
+    ),
+    BoostSeed(
+        code="gear_tuning",
+        name="🧰 Тюнинг студии",
+        type="equipment_eff",
+        base_cost=1280,
+        growth=BOOST_COST_GROWTH,
+        step_value=0.06,
+        min_level=5,
+    ),
+    BoostSeed(
+        code="shop_wholesale",
+        name="🛍️ Оптовые закупки",
+        type="shop_discount",
+        base_cost=1420,
+        growth=BOOST_COST_GROWTH,
+        step_value=0.05,
+        min_level=5,
+    ),
+    BoostSeed(
+        code="premium_projects",
+        name="🎯 Премиум-проекты",
+        type="high_order_reward",
+        base_cost=1500,
+        growth=BOOST_COST_GROWTH,
+        step_value=0.10,
+        min_level=5,
+    ),
+)
 
 BOOST_EXTRA_META: Dict[str, Dict[str, Any]] = {
     "reward_mastery": {
@@ -2018,96 +2724,96 @@ BOOST_PURCHASE_FEEDBACK: Dict[str, str] = {
     "high_order_reward": "🎯 Премиальные заказы стали прибыльнее.",
 }
 
-SEED_TEAM = [
-    {"code": "junior", "name": "Junior Designer", "base_income_per_min": 4, "base_cost": 100, "min_level": 2},
-    {"code": "middle", "name": "Middle Designer", "base_income_per_min": 10, "base_cost": 300, "min_level": 3},
-    {"code": "senior", "name": "Senior Designer", "base_income_per_min": 22, "base_cost": 800, "min_level": 4},
-    {"code": "pm", "name": "Project Manager", "base_income_per_min": 35, "base_cost": 1200, "min_level": 5},
-    {"code": "director", "name": "Creative Director", "base_income_per_min": 60, "base_cost": 2500, "min_level": 12},
-]
-
-SEED_ITEMS = [
-    {"code": "phone_t1", "name": "Смартфон «City Lite»", "slot": "phone", "tier": 1, "bonus_type": "passive_pct", "bonus_value": 0.03, "price": 200, "min_level": 1},
-    {"code": "phone_t2", "name": "Смартфон «Pulse Max»", "slot": "phone", "tier": 2, "bonus_type": "passive_pct", "bonus_value": 0.06, "price": 400, "min_level": 2},
-    {"code": "phone_t3", "name": "Смартфон «Nova Edge»", "slot": "phone", "tier": 3, "bonus_type": "passive_pct", "bonus_value": 0.10, "price": 750, "min_level": 3},
-
-    {"code": "tablet_t1", "name": "Планшет «TabFlow»", "slot": "tablet", "tier": 1, "bonus_type": "req_clicks_pct", "bonus_value": 0.02, "price": 300, "min_level": 1},
-    {"code": "tablet_t2", "name": "Планшет «SketchWave»", "slot": "tablet", "tier": 2, "bonus_type": "req_clicks_pct", "bonus_value": 0.04, "price": 600, "min_level": 2},
-    {"code": "tablet_t3", "name": "Планшет «FrameMaster»", "slot": "tablet", "tier": 3, "bonus_type": "req_clicks_pct", "bonus_value": 0.06, "price": 950, "min_level": 3},
-
-    {"code": "monitor_t1", "name": "Монитор «PixelWide»", "slot": "monitor", "tier": 1, "bonus_type": "reward_pct", "bonus_value": 0.04, "price": 350, "min_level": 1},
-    {"code": "monitor_t2", "name": "Монитор «VisionGrid»", "slot": "monitor", "tier": 2, "bonus_type": "reward_pct", "bonus_value": 0.08, "price": 700, "min_level": 2},
-    {"code": "monitor_t3", "name": "Монитор «UltraCanvas»", "slot": "monitor", "tier": 3, "bonus_type": "reward_pct", "bonus_value": 0.12, "price": 1050, "min_level": 3},
+SEED_TEAM = (
+    TeamSeed(code="junior", name="Junior Designer", base_income_per_min=4, base_cost=100, min_level=2),
+    TeamSeed(code="middle", name="Middle Designer", base_income_per_min=10, base_cost=300, min_level=3),
+    TeamSeed(code="senior", name="Senior Designer", base_income_per_min=22, base_cost=800, min_level=4),
+    TeamSeed(code="pm", name="Project Manager", base_income_per_min=35, base_cost=1200, min_level=5),
+    TeamSeed(code="director", name="Creative Director", base_income_per_min=60, base_cost=2500, min_level=12),
+)
 
-    {"code": "client_contract", "name": "Талисман клиента", "slot": "charm", "tier": 1, "bonus_type": "req_clicks_pct", "bonus_value": 0.03, "price": 0, "min_level": 2},
-    {
-        "code": "talent_badge",
-        "name": "Значок таланта",
-        "slot": "charm",
-        "tier": 1,
-        "bonus_type": "reward_pct",
-        "bonus_value": 0.02,
-        "price": 0,
-        "min_level": 1,
-        "obtain": "achievement",
-    },
-    {
-        "code": "poster_art",
-        "name": "Арт-постер вдохновения",
-        "slot": "charm",
-        "tier": 2,
-        "bonus_type": "reward_pct",
-        "bonus_value": 0.03,
-        "price": 900,
-        "min_level": 8,
-    },
-    {
-        "code": "art_director_trophy",
-        "name": "Трофей арт-директора",
-        "slot": "charm",
-        "tier": 2,
-        "bonus_type": "passive_pct",
-        "bonus_value": 0.04,
-        "price": 0,
-        "min_level": 5,
-        "obtain": "quest",
-    },
-    {
-        "code": "desk_printer",
-        "name": "Командный принтер",
-        "slot": "charm",
-        "tier": 3,
-        "bonus_type": "passive_pct",
-        "bonus_value": 0.05,
-        "price": 1500,
-        "min_level": 12,
-    },
-]
+SEED_ITEMS = (
+    ItemSeed(code="phone_t1", name="Смартфон «City Lite»", slot="phone", tier=1, bonus_type="passive_pct", bonus_value=0.03, price=200, min_level=1),
+    ItemSeed(code="phone_t2", name="Смартфон «Pulse Max»", slot="phone", tier=2, bonus_type="passive_pct", bonus_value=0.06, price=400, min_level=2),
+    ItemSeed(code="phone_t3", name="Смартфон «Nova Edge»", slot="phone", tier=3, bonus_type="passive_pct", bonus_value=0.10, price=750, min_level=3),
+
+    ItemSeed(code="tablet_t1", name="Планшет «TabFlow»", slot="tablet", tier=1, bonus_type="req_clicks_pct", bonus_value=0.02, price=300, min_level=1),
+    ItemSeed(code="tablet_t2", name="Планшет «SketchWave»", slot="tablet", tier=2, bonus_type="req_clicks_pct", bonus_value=0.04, price=600, min_level=2),
+    ItemSeed(code="tablet_t3", name="Планшет «FrameMaster»", slot="tablet", tier=3, bonus_type="req_clicks_pct", bonus_value=0.06, price=950, min_level=3),
+
+    ItemSeed(code="monitor_t1", name="Монитор «PixelWide»", slot="monitor", tier=1, bonus_type="reward_pct", bonus_value=0.04, price=350, min_level=1),
+    ItemSeed(code="monitor_t2", name="Монитор «VisionGrid»", slot="monitor", tier=2, bonus_type="reward_pct", bonus_value=0.08, price=700, min_level=2),
+    ItemSeed(code="monitor_t3", name="Монитор «UltraCanvas»", slot="monitor", tier=3, bonus_type="reward_pct", bonus_value=0.12, price=1050, min_level=3),
+
+    ItemSeed(code="client_contract", name="Талисман клиента", slot="charm", tier=1, bonus_type="req_clicks_pct", bonus_value=0.03, price=0, min_level=2),
+    ItemSeed(
+        code="talent_badge",
+        name="Значок таланта",
+        slot="charm",
+        tier=1,
+        bonus_type="reward_pct",
+        bonus_value=0.02,
+        price=0,
+        min_level=1,
+        obtain="achievement",
+    ),
+    ItemSeed(
+        code="poster_art",
+        name="Арт-постер вдохновения",
+        slot="charm",
+        tier=2,
+        bonus_type="reward_pct",
+        bonus_value=0.03,
+        price=900,
+        min_level=8,
+    ),
+    ItemSeed(
+        code="art_director_trophy",
+        name="Трофей арт-директора",
+        slot="charm",
+        tier=2,
+        bonus_type="passive_pct",
+        bonus_value=0.04,
+        price=0,
+        min_level=5,
+        obtain="quest",
+    ),
+    ItemSeed(
+        code="desk_printer",
+        name="Командный принтер",
+        slot="charm",
+        tier=3,
+        bonus_type="passive_pct",
+        bonus_value=0.05,
+        price=1500,
+        min_level=12,
+    ),
+)
 
-SEED_ACHIEVEMENTS = [
-    {"code": "click_100", "name": "Разогрев пальцев", "description": "Совершите 100 кликов.", "trigger": "clicks", "threshold": 100, "icon": "🖱️"},
-    {"code": "click_1000", "name": "Мастер клика", "description": "Совершите 1000 кликов.", "trigger": "clicks", "threshold": 1000, "icon": "⚡"},
-    {"code": "order_first", "name": "Первый заказ", "description": "Закончите первый заказ.", "trigger": "orders", "threshold": 1, "icon": "📋"},
-    {"code": "order_20", "name": "Портфолио растёт", "description": "Завершите 20 заказов.", "trigger": "orders", "threshold": 20, "icon": "🗂️"},
-    {"code": "level_5", "name": "Ученик", "description": "Достигните 5 уровня.", "trigger": "level", "threshold": 5, "icon": "📈"},
-    {"code": "level_10", "name": "Легенда студии", "description": "Достигните 10 уровня.", "trigger": "level", "threshold": 10, "icon": "🏅"},
-    {"code": "balance_5000", "name": "Капиталист", "description": "Накопите 5000 ₽ на счету.", "trigger": "balance", "threshold": 5000, "icon": "💰"},
-    {"code": "passive_2000", "name": "Доход во сне", "description": "Получите 2000 ₽ пассивного дохода.", "trigger": "passive_income", "threshold": 2000, "icon": "💤"},
-    {"code": "team_3", "name": "Своя студия", "description": "Нанимайте или прокачайте 3 членов команды.", "trigger": "team", "threshold": 3, "icon": "👥"},
-    {"code": "wardrobe_5", "name": "Коллекционер", "description": "Соберите 5 предметов экипировки.", "trigger": "items", "threshold": 5, "icon": "🎽"},
-]
+SEED_ACHIEVEMENTS = (
+    AchievementSeed(code="click_100", name="Разогрев пальцев", description="Совершите 100 кликов.", trigger="clicks", threshold=100, icon="🖱️"),
+    AchievementSeed(code="click_1000", name="Мастер клика", description="Совершите 1000 кликов.", trigger="clicks", threshold=1000, icon="⚡"),
+    AchievementSeed(code="order_first", name="Первый заказ", description="Закончите первый заказ.", trigger="orders", threshold=1, icon="📋"),
+    AchievementSeed(code="order_20", name="Портфолио растёт", description="Завершите 20 заказов.", trigger="orders", threshold=20, icon="🗂️"),
+    AchievementSeed(code="level_5", name="Ученик", description="Достигните 5 уровня.", trigger="level", threshold=5, icon="📈"),
+    AchievementSeed(code="level_10", name="Легенда студии", description="Достигните 10 уровня.", trigger="level", threshold=10, icon="🏅"),
+    AchievementSeed(code="balance_5000", name="Капиталист", description="Накопите 5000 ₽ на счету.", trigger="balance", threshold=5000, icon="💰"),
+    AchievementSeed(code="passive_2000", name="Доход во сне", description="Получите 2000 ₽ пассивного дохода.", trigger="passive_income", threshold=2000, icon="💤"),
+    AchievementSeed(code="team_3", name="Своя студия", description="Нанимайте или прокачайте 3 членов команды.", trigger="team", threshold=3, icon="👥"),
+    AchievementSeed(code="wardrobe_5", name="Коллекционер", description="Соберите 5 предметов экипировки.", trigger="items", threshold=5, icon="🎽"),
+)
 
-SEED_RANDOM_EVENTS = [
-    {"code": "idea_spark", "title": "💡 Озарение! Клиент в восторге — +200₽.", "kind": "bonus", "amount": 200, "duration_sec": None, "weight": 5, "min_level": 1},
-    {"code": "coffee_spill", "title": "☕ Кот пролил кофе на ноут — −150₽. Ну бывает…", "kind": "penalty", "amount": 150, "duration_sec": None, "weight": 4, "min_level": 1},
-    {"code": "spill_choice", "title": "☕ Кофе пролился — что делать?", "kind": "penalty", "amount": 0, "duration_sec": None, "weight": 1, "min_level": 1, "interactive": True},
-    {"code": "viral_post", "title": "📈 Вирусный пост! +10% к наградам на 10 мин.", "kind": "buff", "amount": 0.10, "duration_sec": 600, "weight": 3, "min_level": 3},
-    {"code": "client_tip", "title": "🧾 Клиент оставил чаевые — +350₽.", "kind": "bonus", "amount": 350, "duration_sec": None, "weight": 2, "min_level": 2},
-    {"code": "deadline_crunch", "title": "🔥 Горящий дедлайн! −10% к наградам на 5 мин.", "kind": "buff", "amount": -0.10, "duration_sec": 300, "weight": 2, "min_level": 4},
-    {"code": "agency_feature", "title": "🎤 Про вас написали в блоге — +5% к пассивному доходу на 15 мин.", "kind": "buff", "amount": 0.05, "duration_sec": 900, "weight": 2, "min_level": 5},
-    {"code": "software_crash", "title": "💥 Софт упал! −100 XP.", "kind": "penalty", "amount": 100, "duration_sec": None, "weight": 1, "min_level": 3},
-    {"code": "mentor_call", "title": "📞 Ментор подсказал лайфхак — +150 XP.", "kind": "bonus", "amount": 150, "duration_sec": None, "weight": 2, "min_level": 2},
-]
+SEED_RANDOM_EVENTS = (
+    RandomEventSeed(code="idea_spark", title="💡 Озарение! Клиент в восторге — +200₽.", kind="bonus", amount=200, duration_sec=None, weight=5, min_level=1),
+    RandomEventSeed(code="coffee_spill", title="☕ Кот пролил кофе на ноут — −150₽. Ну бывает…", kind="penalty", amount=150, duration_sec=None, weight=4, min_level=1),
+    RandomEventSeed(code="spill_choice", title="☕ Кофе пролился — что делать?", kind="penalty", amount=0, duration_sec=None, weight=1, min_level=1, interactive=True),
+    RandomEventSeed(code="viral_post", title="📈 Вирусный пост! +10% к наградам на 10 мин.", kind="buff", amount=0.10, duration_sec=600, weight=3, min_level=3),
+    RandomEventSeed(code="client_tip", title="🧾 Клиент оставил чаевые — +350₽.", kind="bonus", amount=350, duration_sec=None, weight=2, min_level=2),
+    RandomEventSeed(code="deadline_crunch", title="🔥 Горящий дедлайн! −10% к наградам на 5 мин.", kind="buff", amount=-0.10, duration_sec=300, weight=2, min_level=4),
+    RandomEventSeed(code="agency_feature", title="🎤 Про вас написали в блоге — +5% к пассивному доходу на 15 мин.", kind="buff", amount=0.05, duration_sec=900, weight=2, min_level=5),
+    RandomEventSeed(code="software_crash", title="💥 Софт упал! −100 XP.", kind="penalty", amount=100, duration_sec=None, weight=1, min_level=3),
+    RandomEventSeed(code="mentor_call", title="📞 Ментор подсказал лайфхак — +150 XP.", kind="bonus", amount=150, duration_sec=None, weight=2, min_level=2),
+)
 
 RANDOM_EVENT_EFFECTS = {
     "idea_spark": {"balance": 200},
@@ -2126,15 +2832,15 @@ RANDOM_EVENT_EFFECTS = {
     },
 }
 
-SEED_SKILLS = [
-    {"code": "web_master", "name": "Web-мастер", "branch": "web", "effect": {"reward_pct": 0.05}, "min_level": 5},
-    {"code": "brand_evangelist", "name": "Бренд-евангелист", "branch": "brand", "effect": {"reward_pct": 0.03, "passive_pct": 0.02}, "min_level": 10},
-    {"code": "art_director", "name": "Арт-директор", "branch": "art", "effect": {"passive_pct": 0.05}, "min_level": 5},
-    {"code": "speed_runner", "name": "Спидранер", "branch": "web", "effect": {"req_clicks_pct": 0.03}, "min_level": 10},
-    {"code": "team_leader", "name": "Лидер команды", "branch": "brand", "effect": {"passive_pct": 0.04}, "min_level": 15},
-    {"code": "sales_guru", "name": "Sales-гуру", "branch": "brand", "effect": {"reward_pct": 0.06}, "min_level": 15},
-    {"code": "brand_storyteller", "name": "Сторителлер", "branch": "brand", "effect": {"reward_pct": 0.04, "xp_pct": 0.05}, "min_level": 20},
-]
+SEED_SKILLS = (
+    SkillSeed(code="web_master", name="Web-мастер", branch="web", effect={"reward_pct": 0.05}, min_level=5),
+    SkillSeed(code="brand_evangelist", name="Бренд-евангелист", branch="brand", effect={"reward_pct": 0.03, "passive_pct": 0.02}, min_level=10),
+    SkillSeed(code="art_director", name="Арт-директор", branch="art", effect={"passive_pct": 0.05}, min_level=5),
+    SkillSeed(code="speed_runner", name="Спидранер", branch="web", effect={"req_clicks_pct": 0.03}, min_level=10),
+    SkillSeed(code="team_leader", name="Лидер команды", branch="brand", effect={"passive_pct": 0.04}, min_level=15),
+    SkillSeed(code="sales_guru", name="Sales-гуру", branch="brand", effect={"reward_pct": 0.06}, min_level=15),
+    SkillSeed(code="brand_storyteller", name="Сторителлер", branch="brand", effect={"reward_pct": 0.04, "xp_pct": 0.05}, min_level=20),
+)
 
 CAMPAIGN_CHAPTERS = [
     {"chapter": 1, "title": "Первые заказы", "min_level": 1, "goal": {"orders_total": 3}, "reward": {"rub": 400, "xp": 150, "reward_pct": 0.01}},
@@ -2263,68 +2969,9 @@ QUEST_DEFINITIONS: Dict[str, Dict[str, Any]] = {
 }
 
 
-async def seed_if_needed(session: AsyncSession) -> None:
-    """Идемпотентная загрузка сидов при первом старте."""
-    # Заказы
-    existing_orders = {
-        order.title: order for order in (await session.execute(select(Order))).scalars()
-    }
-    for d in SEED_ORDERS:
-        base_clicks = d["base_clicks"]
-        min_level = d["min_level"]
-        reward_mul = float(d.get("reward_multiplier", 1.0))
-        # Обновлено: автоматически рассчитываем предпросмотр награды.
-        preview = int(
-            d.get(
-                "reward_preview",
-                base_reward_from_required(required_clicks(base_clicks, min_level), reward_mul),
-            )
-        )
-        payload = {
-            "title": d["title"],
-            "base_clicks": base_clicks,
-            "min_level": min_level,
-            "is_special": d.get("is_special", False),
-            "reward_multiplier": reward_mul,
-            "reward_preview": preview,
-            "difficulty": d.get("difficulty", "normal"),
-            "estimated_minutes": int(d.get("estimated_minutes", 30)),
-            "rarity": d.get("rarity", "common"),
-            "appearance_weight": float(d.get("appearance_weight", 0.0)),
-        }
-        order = existing_orders.get(d["title"])
-        if not order:
-            session.add(Order(**payload))
-        else:
-            for key, value in payload.items():
-                setattr(order, key, value)
-    # Усиления
-    existing_boosts = {
-        boost.code: boost for boost in (await session.execute(select(Boost))).scalars()
-    }
-    seed_codes = {d["code"] for d in SEED_BOOSTS}
-    for d in SEED_BOOSTS:
-        boost = existing_boosts.get(d["code"])
-        if not boost:
-            session.add(
-                Boost(
-                    code=d["code"],
-                    name=d["name"],
-                    type=d["type"],
-                    base_cost=d["base_cost"],
-                    growth=d["growth"],
-                    step_value=d["step_value"],
-                    min_level=d.get("min_level", 1),
-                )
-            )
-        else:
-            boost.name = d["name"]
-            boost.type = d["type"]
-            boost.base_cost = d["base_cost"]
-            boost.growth = d["growth"]
-            boost.step_value = d["step_value"]
-            boost.min_level = d.get("min_level", boost.min_level or 1)
-    removed_boost_codes = {
+# Коды усилений, выведенных из игры: удаляются из БД при сидировании.
+REMOVED_BOOST_CODES = frozenset(
+    {
         "finger_training",
         "click_overdrive",
         "coffee_break",
@@ -2342,107 +2989,203 @@ async def seed_if_needed(session: AsyncSession) -> None:
         "deep_offline",
         "night_flow",
     }
-    for obsolete_code in removed_boost_codes:
-        if obsolete_code in existing_boosts and obsolete_code not in seed_codes:
-            await session.execute(delete(Boost).where(Boost.code == obsolete_code))
+)
+
+
+async def _seed_insert_missing(session: AsyncSession, model: Any, rows: List[dict]) -> None:
+    """Insert seed rows in one executemany, skipping codes that already exist."""
+    if not rows:
+        return
+    stmt = sqlite_insert(model).on_conflict_do_nothing(index_elements=["code"])
+    await session.execute(stmt, rows)
+
+
+def _seed_order_rows() -> List[Dict[str, Any]]:
+    """Build full Order rows from SEED_ORDERS, filling defaults and reward previews."""
+
+    rows: List[Dict[str, Any]] = []
+    for d in SEED_ORDERS:
+        # Обновлено: автоматически рассчитываем предпросмотр награды.
+        preview = base_reward_from_required(
+            required_clicks(d.base_clicks, d.min_level), d.reward_multiplier
+        )
+        rows.append({**d._asdict(), "reward_preview": int(preview)})
+    return rows
+
+
+SEED_FINGERPRINT_KEY = "seed_fingerprint"
+
+
+def seed_fingerprint() -> str:
+    """Hash of everything seeding writes; an unchanged hash means seeding can be skipped."""
+
+    payload = {
+        "orders": _seed_order_rows(),
+        "boosts": [d._asdict() for d in SEED_BOOSTS],
+        "removed_boosts": sorted(REMOVED_BOOST_CODES),
+        "team": [d._asdict() for d in SEED_TEAM],
+        "items": [d._asdict() for d in SEED_ITEMS],
+        "achievements": [d._asdict() for d in SEED_ACHIEVEMENTS],
+        "random_events": [d._asdict() for d in SEED_RANDOM_EVENTS],
+        "skills": [d._asdict() for d in SEED_SKILLS],
+    }
+    return hashlib.sha1(_json_dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+async def seed_if_needed(session: AsyncSession) -> None:
+    """Идемпотентная загрузка сидов: при неизменных сидах — один SELECT отпечатка."""
+    fingerprint = seed_fingerprint()
+    state = await session.get(GlobalState, SEED_FINGERPRINT_KEY)
+    if state is None or (state.value or {}).get("hash") != fingerprint:
+        await _apply_seeds(session)
+        now = utcnow()
+        if state is None:
+            session.add(
+                GlobalState(key=SEED_FINGERPRINT_KEY, value={"hash": fingerprint}, updated_at=now)
+            )
+        else:
+            state.value = {"hash": fingerprint}
+            state.updated_at = now
+    # Санируем старые записи user_orders без снимка множителя
+    await session.execute(
+        update(UserOrder)
+        .where(UserOrder.reward_snapshot_mul <= 0)
+        .values(reward_snapshot_mul=1.0)
+    )
+
+
+async def _apply_seeds(session: AsyncSession) -> None:
+    """Insert missing seed rows and refresh the fields of existing ones."""
+    # Заказы
+    existing_orders = {
+        order.title: order for order in (await session.execute(select(Order))).scalars()
+    }
+    new_orders: List[dict] = []
+    for payload in _seed_order_rows():
+        order = existing_orders.get(payload["title"])
+        if not order:
+            new_orders.append(payload)
+        else:
+            for key, value in payload.items():
+                setattr(order, key, value)
+    if new_orders:
+        # У заказов нет уникального ключа — вставляем только отсутствующие по title.
+        await session.execute(insert(Order), new_orders)
+    # Усиления
+    existing_boosts = {
+        boost.code: boost for boost in (await session.execute(select(Boost))).scalars()
+    }
+    seed_codes = {d.code for d in SEED_BOOSTS}
+    new_boosts: List[dict] = []
+    for d in SEED_BOOSTS:
+        boost = existing_boosts.get(d.code)
+        if not boost:
+            new_boosts.append(d._asdict())
+        else:
+            boost.name = d.name
+            boost.type = d.type
+            boost.base_cost = d.base_cost
+            boost.growth = d.growth
+            boost.step_value = d.step_value
+            boost.min_level = d.min_level
+    await _seed_insert_missing(session, Boost, new_boosts)
+    obsolete_codes = [
+        code for code in REMOVED_BOOST_CODES if code in existing_boosts and code not in seed_codes
+    ]
+    if obsolete_codes:
+        await session.execute(delete(Boost).where(Boost.code.in_(obsolete_codes)))
     # Команда
     team_existing = {
-        code: member
-        for member, code in (
-            await session.execute(select(TeamMember, TeamMember.code))
-        ).all()
+        member.code: member for member in (await session.execute(select(TeamMember))).scalars()
     }
+    new_team: List[dict] = []
     for d in SEED_TEAM:
-        member = team_existing.get(d["code"])
+        member = team_existing.get(d.code)
         if not member:
-            session.add(
-                TeamMember(
-                    code=d["code"],
-                    name=d["name"],
-                    base_income_per_min=d["base_income_per_min"],
-                    base_cost=d["base_cost"],
-                    min_level=d.get("min_level", 1),
-                )
-            )
+            new_team.append(d._asdict())
         else:
-            member.min_level = d.get("min_level", member.min_level)
-    # Предметы
-    existing_items = {
-        code: iid for code, iid in (await session.execute(select(Item.code, Item.id))).all()
-    }
-    for d in SEED_ITEMS:
-        if d["code"] not in existing_items:
-            session.add(
-                Item(
-                    code=d["code"],
-                    name=d["name"],
-                    slot=d["slot"],
-                    tier=d["tier"],
-                    bonus_type=d["bonus_type"],
-                    bonus_value=d["bonus_value"],
-                    price=d["price"],
-                    min_level=d["min_level"],
-                    obtain=d.get("obtain"),
-                )
-            )
+            member.min_level = d.min_level
+    await _seed_insert_missing(session, TeamMember, new_team)
+    # Предметы: существующие коды отсекает ON CONFLICT, отдельный SELECT не нужен.
+    await _seed_insert_missing(session, Item, [d._asdict() for d in SEED_ITEMS])
     # Достижения
-    cnt = (await session.execute(select(func.count()).select_from(Achievement))).scalar_one()
-    if cnt == 0:
-        for d in SEED_ACHIEVEMENTS:
-            session.add(
-                Achievement(
-                    code=d["code"],
-                    name=d["name"],
-                    description=d["description"],
-                    trigger=d["trigger"],
-                    threshold=d["threshold"],
-                    icon=d["icon"],
-                )
-            )
+    await _seed_insert_missing(session, Achievement, [d._asdict() for d in SEED_ACHIEVEMENTS])
     # Случайные события
     existing_events = {
-        code: event
-        for event, code in (
-            await session.execute(select(RandomEvent, RandomEvent.code))
-        ).all()
+        event.code: event for event in (await session.execute(select(RandomEvent))).scalars()
     }
+    new_events: List[dict] = []
     for d in SEED_RANDOM_EVENTS:
-        event = existing_events.get(d["code"])
+        event = existing_events.get(d.code)
         if not event:
-            session.add(
-                RandomEvent(
-                    code=d["code"],
-                    title=d["title"],
-                    kind=d["kind"],
-                    amount=d["amount"],
-                    duration_sec=d["duration_sec"],
-                    weight=d["weight"],
-                    min_level=d["min_level"],
-                    interactive=bool(d.get("interactive", False)),
-                )
-            )
-        else:
-            if event.interactive != bool(d.get("interactive", False)):
-                event.interactive = bool(d.get("interactive", False))
+            new_events.append(d._asdict())
+        elif event.interactive != d.interactive:
+            event.interactive = d.interactive
+    await _seed_insert_missing(session, RandomEvent, new_events)
     # Навыки
-    cnt = (await session.execute(select(func.count()).select_from(Skill))).scalar_one()
-    if cnt == 0:
-        for d in SEED_SKILLS:
-            session.add(
-                Skill(
-                    code=d["code"],
-                    name=d["name"],
-                    branch=d["branch"],
-                    effect=d["effect"],
-                    min_level=d["min_level"],
-                )
-            )
-    # Санируем старые записи user_orders без снимка множителя
-    await session.execute(
-        update(UserOrder)
-        .where(UserOrder.reward_snapshot_mul <= 0)
-        .values(reward_snapshot_mul=1.0)
-    )
+    await _seed_insert_missing(session, Skill, [d._asdict() for d in SEED_SKILLS])
+
+
+# Справочники из сидов неизменны во время работы: держим их в памяти процесса.
+CATALOG_MODELS: Tuple[type, ...] = (Boost, TeamMember, Item, Achievement, RandomEvent, Skill, Order)
+_CATALOG_BY_ID: Dict[type, Dict[int, Any]] = {}
+# Только для справочников с колонкой code (у заказов её нет).
+_CATALOG_BY_CODE: Dict[type, Dict[str, Any]] = {}
+
+
+# Предметы каталога в порядке (слот, тир) — для витрины следующих тиров.
+_ITEMS_BY_SLOT_TIER: List[Item] = []
+# Статовые эффекты навыков из каталога: код -> ((ключ, значение), ...) без нулевых ключей.
+_SKILL_STAT_EFFECTS: Dict[str, Tuple[Tuple[str, float], ...]] = {}
+# Достижения каталога по триггеру (в порядке id) — evaluate_achievements не сканирует весь каталог.
+_ACHIEVEMENTS_BY_TRIGGER: Dict[str, Tuple[Achievement, ...]] = {}
+# Заказы в порядке (min_level, id) и их min_level — срез доступных берётся bisect'ом.
+_ORDERS_BY_LEVEL: List[Order] = []
+_ORDER_MIN_LEVELS: List[int] = []
+
+
+async def load_catalog(session: AsyncSession) -> None:
+    """Load immutable seed tables into process-local dicts (called from prepare_database)."""
+    for model in CATALOG_MODELS:
+        rows = (await session.execute(select(model).order_by(model.id))).scalars().all()
+        _CATALOG_BY_ID[model] = {row.id: row for row in rows}
+        if hasattr(model, "code"):
+            _CATALOG_BY_CODE[model] = {row.code: row for row in rows}
+    _ITEMS_BY_SLOT_TIER[:] = sorted(catalog_all(Item), key=lambda it: (it.slot, it.tier))
+    _ORDERS_BY_LEVEL[:] = sorted(catalog_all(Order), key=lambda order: (order.min_level, order.id))
+    _ORDER_MIN_LEVELS[:] = [order.min_level for order in _ORDERS_BY_LEVEL]
+    _SKILL_STAT_EFFECTS.clear()
+    for skill in catalog_all(Skill):
+        effect = skill.effect or {}
+        _SKILL_STAT_EFFECTS[skill.code] = tuple(
+            (key, effect[key]) for key in _SKILL_STAT_KEYS if effect.get(key)
+        )
+    by_trigger: Dict[str, List[Achievement]] = defaultdict(list)
+    for ach in catalog_all(Achievement):
+        by_trigger[ach.trigger].append(ach)
+    _ACHIEVEMENTS_BY_TRIGGER.clear()
+    _ACHIEVEMENTS_BY_TRIGGER.update((trigger, tuple(achs)) for trigger, achs in by_trigger.items())
+    _random_event_table.cache_clear()
+
+
+def catalog_all(model: type) -> List[Any]:
+    """Return every cached row of a seed table ordered by id."""
+    return list(_CATALOG_BY_ID.get(model, {}).values())
+
+
+def catalog_get(model: type, row_id: Optional[int]) -> Optional[Any]:
+    """Return a cached seed row by primary key."""
+    return _CATALOG_BY_ID.get(model, {}).get(row_id)
+
+
+def catalog_orders_up_to_level(level: int) -> List[Order]:
+    """Return cached orders with ``min_level <= level`` ordered by (min_level, id)."""
+    return _ORDERS_BY_LEVEL[: bisect_right(_ORDER_MIN_LEVELS, level)]
+
+
+def catalog_by_code(model: type, code: Optional[str]) -> Optional[Any]:
+    """Return a cached seed row by its unique code."""
+    return _CATALOG_BY_CODE.get(model, {}).get(code)
 
 
 TREND_STATE_KEY = "trend_order"
@@ -2492,24 +3235,16 @@ async def roll_new_trend(
     session: AsyncSession, user_level_hint: Optional[int] = None
 ) -> dict:
     level_cap = max(1, user_level_hint or 1)
-    orders = (
-        await session.execute(
-            select(Order)
-            .where(Order.is_special.is_(False), Order.min_level <= level_cap)
-            .order_by(Order.id)
-        )
-    ).scalars().all()
+    orders = [o for o in catalog_all(Order) if not o.is_special and o.min_level <= level_cap]
     if not orders:
-        orders = (
-            await session.execute(select(Order).where(Order.is_special.is_(False)))
-        ).scalars().all()
+        orders = [o for o in catalog_all(Order) if not o.is_special]
     if not orders:
         raise RuntimeError("No orders available to roll trend")
     current = await get_trend(session)
     candidates = [o for o in orders if not current or o.id != current.get("order_id")]
     if not candidates:
         candidates = orders
-    order = random.choice(candidates)
+    order = _rand_choice(candidates)
     valid_until = utcnow() + timedelta(hours=TREND_DURATION_HOURS)
     reward_mul = TREND_REWARD_MUL
     await set_trend(session, order.id, valid_until, reward_mul)
@@ -2532,10 +3267,52 @@ def xp_to_level(n: int) -> int:
     return 100 * n * n
 
 
+def xp_total_for_level(n: int) -> int:
+    """Total XP spent to reach level ``n`` from level 1: 100 * (1² + … + (n-1)²)."""
+
+    m = n - 1
+    return 100 * m * (m + 1) * (2 * m + 1) // 6
+
+
+def level_for_total_xp(total: int) -> int:
+    """Highest level whose cumulative XP cost fits into ``total`` (inverse of xp_total_for_level)."""
+
+    # Сумма квадратов ≈ m³/3: кубический корень даёт оценку, целые шаги её уточняют.
+    level = int((3 * max(0, total) / 100) ** (1 / 3)) + 1
+    while level > 1 and xp_total_for_level(level) > total:
+        level -= 1
+    while xp_total_for_level(level + 1) <= total:
+        level += 1
+    return level
+
+
+# Степени множителей роста цен считаются один раз: на рендере магазина и команды
+# вместо возведения в степень — индекс в кортеже. Значения совпадают с ** бит в бит.
+GROWTH_POWER_TABLE_SIZE = 256
+_BOOST_GROWTH_POWERS: Tuple[float, ...] = tuple(
+    BOOST_COST_GROWTH ** i for i in range(GROWTH_POWER_TABLE_SIZE)
+)
+_TEAM_GROWTH_POWERS: Tuple[float, ...] = tuple(
+    TEAM_UPGRADE_GROWTH ** i for i in range(GROWTH_POWER_TABLE_SIZE)
+)
+
+
+def team_growth_power(level: int) -> float:
+    """Return TEAM_UPGRADE_GROWTH ** level (level clamped at 0)."""
+
+    if level <= 0:
+        return 1.0
+    if level < GROWTH_POWER_TABLE_SIZE:
+        return _TEAM_GROWTH_POWERS[level]
+    return TEAM_UPGRADE_GROWTH ** level
+
+
 def upgrade_cost(base: int, growth: float, n: int) -> int:
     """Unified exponential cost progression for boost upgrades."""
 
     level_index = max(0, n - 1)
+    if level_index < GROWTH_POWER_TABLE_SIZE:
+        return int(round(base * _BOOST_GROWTH_POWERS[level_index]))
     return int(round(base * (BOOST_COST_GROWTH ** level_index)))
 
 
@@ -2548,6 +3325,7 @@ def base_reward_from_required(req: int, reward_mul: float = 1.0) -> int:
 
 
 async def calc_total_earned(session: AsyncSession, user: User) -> float:
+    await flush_queued_writes(session)
     earning_types = {"order_finish", "quest_reward", "campaign_reward"}
     stmt = (
         select(
@@ -2581,161 +3359,267 @@ async def calc_prestige_gain(
     return int(floor(sqrt(total / PRESTIGE_GAIN_DIVISOR)))
 
 
-async def get_user_stats(session: AsyncSession, user: User) -> dict:
-    """Return aggregated user stats from boosts, экипировки, навыков и баффов."""
+# Тип буста/бонуса -> ключ аккумулятора в get_user_stats (event_shield считается отдельно).
+_BOOST_STAT_KEYS: Dict[str, str] = {
+    "reward": "reward_add",
+    "passive": "passive_add",
+    "xp": "xp_pct",
+    "event_protection": "negative_event_reduction",
+    "team_income": "team_income_pct",
+    "req_clicks": "req_clicks_pct_boost",
+    "free_order": "free_order_chance",
+    "team_discount": "team_discount_pct",
+    "offline_cap": "offline_cap_bonus",
+    "rush_reward": "rush_reward_pct",
+    "equipment_eff": "equipment_eff_pct",
+    "night_passive": "night_passive_pct",
+    "shop_discount": "shop_discount_pct",
+    "high_order_reward": "high_order_reward_pct",
+}
+_ITEM_STAT_KEYS: Dict[str, str] = {
+    "passive_pct": "passive_pct",
+    "req_clicks_pct": "req_clicks_pct",
+    "reward_pct": "reward_pct",
+}
+_BUFF_STAT_KEYS = ("reward_pct", "passive_pct", "req_clicks_pct", "xp_pct", "free_order_chance")
+_SKILL_STAT_KEYS = ("reward_pct", "passive_pct", "req_clicks_pct", "xp_pct")
 
-    rows = (
-        await session.execute(
-            select(Boost.code, Boost.type, UserBoost.level, Boost.step_value)
-            .select_from(UserBoost)
-            .join(Boost, Boost.id == UserBoost.boost_id)
-            .where(UserBoost.user_id == user.id)
+
+# Всё, от чего зависит get_user_stats: изменение этих строк сбрасывает кэш статов.
+_STATS_SOURCE_MODELS: Tuple[type, ...] = (UserBoost, UserEquipment, UserSkill, UserBuff, UserPrestige)
+_STATS_USER_ATTRS = ("reward_mul", "passive_mul")
+
+# Статы между сессиями: user_id -> (unix-время, до которого значение верно; статы).
+# Запись живёт не дольше TTL и не переживает ближайшее истечение баффа; коммит,
+# меняющий источники статов игрока, удаляет её сразу.
+USER_STATS_TTL_SECONDS = 60
+USER_STATS_CACHE_MAX = 10_000
+_USER_STATS_CACHE: "OrderedDict[int, Tuple[float, dict]]" = OrderedDict()
+# Растёт при каждой инвалидации: сессия, начатая до неё, не кладёт в кэш свой снимок.
+_USER_STATS_GENERATION = 0
+
+
+def _stats_inputs_pending(session: Session | AsyncSession) -> bool:
+    """True if unflushed changes in the session affect get_user_stats."""
+
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, _STATS_SOURCE_MODELS):
+            return True
+        if isinstance(obj, User):
+            attrs = inspect(obj).attrs
+            if any(attrs[name].history.has_changes() for name in _STATS_USER_ATTRS):
+                return True
+    return False
+
+
+def _stats_changed_user_ids(session: Session) -> Set[Optional[int]]:
+    """Return ids of users whose stat sources have unflushed changes."""
+
+    changed: Set[Optional[int]] = set()
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, _STATS_SOURCE_MODELS):
+            changed.add(obj.user_id)
+        elif isinstance(obj, User):
+            attrs = inspect(obj).attrs
+            if any(attrs[name].history.has_changes() for name in _STATS_USER_ATTRS):
+                changed.add(obj.id)
+    return changed
+
+
+def _user_stats_cacheable(session: Session | AsyncSession, user_id: int) -> bool:
+    """True if this session sees only committed stat sources of the user."""
+
+    changed = session.info.get("stats_changed_uids", ())
+    return user_id not in changed and None not in changed
+
+
+@event.listens_for(Session, "after_begin")
+def _remember_stats_generation(session: Session, _transaction, _connection) -> None:
+    session.info["stats_generation"] = _USER_STATS_GENERATION
+
+
+@event.listens_for(Session, "after_flush")
+def _drop_user_stats_after_flush(session: Session, _flush_context) -> None:
+    changed = _stats_changed_user_ids(session)
+    if changed:
+        session.info.pop("user_stats", None)
+        session.info.setdefault("stats_changed_uids", set()).update(changed)
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _drop_user_stats_on_dml(orm_execute_state) -> None:
+    """Bulk insert/update/delete мимо unit of work тоже инвалидирует статы.
+
+    Игрока можно указать через ``execution_options(user_id=...)``, иначе при
+    коммите сбрасывается кэш статов всех игроков.
+    """
+
+    if orm_execute_state.is_select or orm_execute_state.execution_options.get("keeps_session_memos"):
+        return
+    mapper = orm_execute_state.bind_mapper
+    if mapper is not None and (mapper.class_ is User or mapper.class_ in _STATS_SOURCE_MODELS):
+        info = orm_execute_state.session.info
+        info.pop("user_stats", None)
+        info.setdefault("stats_changed_uids", set()).add(
+            orm_execute_state.execution_options.get("user_id")
         )
-    ).all()
-    reward_add = 0.0
-    passive_add = 0.0
-    xp_pct = 0.0
-    req_clicks_pct_boost = 0.0
-    team_income_pct = 0.0
-    free_order_chance = 0.0
-    team_discount_pct = 0.0
-    offline_cap_bonus = 0.0
-    rush_reward_pct = 0.0
-    equipment_eff_pct = 0.0
-    night_passive_pct = 0.0
-    shop_discount_pct = 0.0
-    high_order_reward_pct = 0.0
-    negative_event_reduction = 0.0
+
+
+@event.listens_for(Session, "after_commit")
+def _drop_committed_user_stats(session: Session) -> None:
+    global _USER_STATS_GENERATION
+    changed = session.info.pop("stats_changed_uids", None)
+    if not changed:
+        return
+    _USER_STATS_GENERATION += 1
+    if None in changed:
+        _USER_STATS_CACHE.clear()
+        return
+    for user_id in changed:
+        _USER_STATS_CACHE.pop(user_id, None)
+
+
+async def get_user_stats(session: AsyncSession, user: User) -> dict:
+    """Return aggregated user stats from boosts, экипировки, навыков и баффов.
+
+    The result is memoized per session and, for committed data, per process
+    in ``_USER_STATS_CACHE``; any write to the source tables drops it.
+    """
+
+    cache: Dict[int, dict] = session.info.setdefault("user_stats", {})
+    cached = cache.get(user.id)
+    pending = _stats_inputs_pending(session)
+    if cached is not None and not pending:
+        return cached
+    if not pending and _user_stats_cacheable(session, user.id):
+        entry = _USER_STATS_CACHE.get(user.id)
+        if entry is not None and time.time() < entry[0]:
+            cache[user.id] = entry[1]
+            return entry[1]
+    generation = session.info.get("stats_generation")
+    stats, valid_until = await _compute_user_stats(session, user)
+    session.info.setdefault("user_stats", {})[user.id] = stats
+    if (
+        generation == _USER_STATS_GENERATION
+        and not _stats_inputs_pending(session)
+        and _user_stats_cacheable(session, user.id)
+    ):
+        _USER_STATS_CACHE.pop(user.id, None)
+        if len(_USER_STATS_CACHE) >= USER_STATS_CACHE_MAX:
+            _USER_STATS_CACHE.popitem(last=False)
+        _USER_STATS_CACHE[user.id] = (valid_until, stats)
+    return stats
+
+
+async def _compute_user_stats(session: AsyncSession, user: User) -> Tuple[dict, float]:
+    """Aggregate stats from the DB; also return the unix time they stay valid until."""
+
+    boosts: List[Tuple[Boost, int]] = []
+    items: List[Item] = []
+    skills: List[Skill] = []
+    for kind, ref_id, ref_code, lvl in await session.execute(
+        SELECT_USER_STAT_SOURCES, {"uid": user.id}
+    ):
+        if kind == "boost":
+            boost = catalog_get(Boost, ref_id)
+            # Нулевые уровни отсекает SQL; нулевой шаг известен только каталогу.
+            if boost is not None and boost.step_value != 0:
+                boosts.append((boost, lvl))
+        elif kind == "item":
+            item = catalog_get(Item, ref_id)
+            if item is not None:
+                items.append(item)
+        else:
+            skill = catalog_by_code(Skill, ref_code)
+            if skill is not None:
+                skills.append(skill)
+    acc: Dict[str, float] = defaultdict(float)
     event_shield_charges = 0
-    for _code, btype, lvl, step in rows:
-        if lvl <= 0 or step == 0:
-            continue
-        value = lvl * step
-        if btype == "reward":
-            reward_add += value
-        elif btype == "passive":
-            passive_add += value
-        elif btype == "xp":
-            xp_pct += value
-        elif btype == "event_protection":
-            negative_event_reduction += value
-        elif btype == "team_income":
-            team_income_pct += value
-        elif btype == "req_clicks":
-            req_clicks_pct_boost += value
-        elif btype == "free_order":
-            free_order_chance += value
-        elif btype == "team_discount":
-            team_discount_pct += value
-        elif btype == "offline_cap":
-            offline_cap_bonus += value
-        elif btype == "rush_reward":
-            rush_reward_pct += value
-        elif btype == "equipment_eff":
-            equipment_eff_pct += value
-        elif btype == "night_passive":
-            night_passive_pct += value
-        elif btype == "shop_discount":
-            shop_discount_pct += value
-        elif btype == "high_order_reward":
-            high_order_reward_pct += value
+    for boost, lvl in boosts:
+        btype = boost.type
+        key = _BOOST_STAT_KEYS.get(btype)
+        if key is not None:
+            acc[key] += lvl * boost.step_value
         elif btype == "event_shield":
             event_shield_charges += int(lvl)
 
+    equipment_eff_pct = acc["equipment_eff_pct"]
     equipment_multiplier = 1.0 + equipment_eff_pct
-    items = (
-        await session.execute(
-            select(Item.bonus_type, Item.bonus_value)
-            .join(UserEquipment, UserEquipment.item_id == Item.id)
-            .where(UserEquipment.user_id == user.id, UserEquipment.item_id.is_not(None))
-        )
-    ).all()
-    passive_pct = 0.0
-    req_clicks_pct = 0.0
-    reward_pct = 0.0
-    for btype, val in items:
-        boosted_val = val * equipment_multiplier
-        if btype == "passive_pct":
-            passive_pct += boosted_val
-        elif btype == "req_clicks_pct":
-            req_clicks_pct += boosted_val
-        elif btype == "reward_pct":
-            reward_pct += boosted_val
+    for item in items:
+        key = _ITEM_STAT_KEYS.get(item.bonus_type)
+        if key is not None:
+            acc[key] += item.bonus_value * equipment_multiplier
 
-    now = utcnow()
-    active_buffs = (
-        await session.execute(
-            select(UserBuff).where(UserBuff.user_id == user.id)
-        )
-    ).scalars().all()
+    now_ts = to_epoch(utcnow())
+    valid_until = float(now_ts + USER_STATS_TTL_SECONDS)
     expired_ids: List[int] = []
-    for buff in active_buffs:
-        expires = ensure_naive(buff.expires_at)
-        if expires and expires <= now:
-            expired_ids.append(buff.id)
+    for buff_id, expires_ts, expired, effect_key, effect_value, payload in await session.execute(
+        SELECT_USER_BUFF_EFFECTS, {"uid": user.id, "now_ts": now_ts}
+    ):
+        if expired:
+            expired_ids.append(buff_id)
+            continue
+        valid_until = min(valid_until, float(expires_ts))
+        if effect_key is not None:
+            if effect_key in _BUFF_STAT_KEYS:
+                acc[effect_key] += effect_value
             continue
-        payload = buff.payload or {}
-        reward_pct += payload.get("reward_pct", 0.0)
-        passive_pct += payload.get("passive_pct", 0.0)
-        req_clicks_pct += payload.get("req_clicks_pct", 0.0)
-        xp_pct += payload.get("xp_pct", 0.0)
-        free_order_chance += payload.get("free_order_chance", 0.0)
+        payload = payload or {}
+        for key in _BUFF_STAT_KEYS:
+            acc[key] += payload.get(key, 0.0)
+    # DELETE только если что-то истекло: безусловный DELETE брал бы блокировку записи
+    # SQLite на каждом чтении статов.
     if expired_ids:
-        await session.execute(delete(UserBuff).where(UserBuff.id.in_(expired_ids)))
-
-    skills = (
         await session.execute(
-            select(Skill.effect)
-            .join(UserSkill, UserSkill.skill_code == Skill.code)
-            .where(UserSkill.user_id == user.id)
+            delete(UserBuff).where(UserBuff.id.in_(expired_ids)),
+            execution_options={"user_id": user.id},
         )
-    ).scalars().all()
-    for effect in skills:
-        if not effect:
-            continue
-        reward_pct += effect.get("reward_pct", 0.0)
-        passive_pct += effect.get("passive_pct", 0.0)
-        req_clicks_pct += effect.get("req_clicks_pct", 0.0)
-        xp_pct += effect.get("xp_pct", 0.0)
 
-    prestige = await session.scalar(select(UserPrestige).where(UserPrestige.user_id == user.id))
+    for skill in skills:
+        for key, value in _SKILL_STAT_EFFECTS.get(skill.code, ()):
+            acc[key] += value
+
+    prestige = await get_prestige_entry(session, user)
     prestige_pct = 0.0
     if prestige:
         prestige_pct = max(0.0, prestige.reputation * 0.01)
-        reward_pct += prestige_pct
-        passive_pct += prestige_pct
+        acc["reward_pct"] += prestige_pct
+        acc["passive_pct"] += prestige_pct
 
     negative_event_weight_mul = max(
         0.0,
-        min(1.0, 1.0 - min(NEGATIVE_EVENT_REDUCTION_CAP, max(0.0, negative_event_reduction))),
+        min(1.0, 1.0 - min(NEGATIVE_EVENT_REDUCTION_CAP, max(0.0, acc["negative_event_reduction"]))),
+    )
+    req_clicks_pct_total = acc["req_clicks_pct"] + min(
+        REQ_CLICKS_REDUCTION_CAP, max(0.0, acc["req_clicks_pct_boost"])
     )
-    req_clicks_pct_total = req_clicks_pct + min(REQ_CLICKS_REDUCTION_CAP, max(0.0, req_clicks_pct_boost))
     req_clicks_pct_total = max(0.0, min(0.95, req_clicks_pct_total))
-    team_discount_pct = max(0.0, min(TEAM_DISCOUNT_CAP, team_discount_pct))
-    shop_discount_pct = max(0.0, min(SHOP_DISCOUNT_CAP, shop_discount_pct))
-    free_order_chance = max(0.0, min(0.95, free_order_chance))
+    team_discount_pct = max(0.0, min(TEAM_DISCOUNT_CAP, acc["team_discount_pct"]))
+    shop_discount_pct = max(0.0, min(SHOP_DISCOUNT_CAP, acc["shop_discount_pct"]))
+    free_order_chance = max(0.0, min(0.95, acc["free_order_chance"]))
 
-    reward_mul_total = 1.0 + user.reward_mul + reward_add + reward_pct
-    passive_mul_total = 1.0 + user.passive_mul + passive_add + passive_pct
-    return {
+    reward_mul_total = 1.0 + user.reward_mul + acc["reward_add"] + acc["reward_pct"]
+    passive_mul_total = 1.0 + user.passive_mul + acc["passive_add"] + acc["passive_pct"]
+    stats = {
         "cp": 1,
         "reward_mul_total": max(0.0, reward_mul_total),
         "passive_mul_total": max(0.0, passive_mul_total),
         "req_clicks_pct": req_clicks_pct_total,
-        "xp_pct": max(0.0, xp_pct),
+        "xp_pct": max(0.0, acc["xp_pct"]),
         "prestige_pct": prestige_pct,
-        "team_income_pct": max(0.0, team_income_pct),
+        "team_income_pct": max(0.0, acc["team_income_pct"]),
         "free_order_chance": free_order_chance,
         "team_upgrade_discount_pct": team_discount_pct,
-        "offline_cap_bonus": max(0.0, offline_cap_bonus),
-        "rush_reward_pct": max(0.0, rush_reward_pct),
+        "offline_cap_bonus": max(0.0, acc["offline_cap_bonus"]),
+        "rush_reward_pct": max(0.0, acc["rush_reward_pct"]),
         "equipment_eff_pct": max(0.0, equipment_eff_pct),
-        "night_passive_pct": max(0.0, night_passive_pct),
+        "night_passive_pct": max(0.0, acc["night_passive_pct"]),
         "shop_discount_pct": shop_discount_pct,
-        "high_order_reward_pct": max(0.0, high_order_reward_pct),
+        "high_order_reward_pct": max(0.0, acc["high_order_reward_pct"]),
         "negative_event_weight_mul": negative_event_weight_mul,
         "event_shield_charges": max(0, event_shield_charges),
     }
+    return stats, valid_until
 
 
 def team_income_per_min(base_per_min: float, level: int) -> float:
@@ -2746,12 +3630,24 @@ def team_income_per_min(base_per_min: float, level: int) -> float:
     return base_per_min * (1 + 0.25 * (level - 1))
 
 
+# (monotonic-время, до которого флаг верен; флаг). Ночь меняется только на границе часа.
+_NIGHT_CACHE: Tuple[float, bool] = (0.0, False)
+
+
 def is_night_now(now: Optional[datetime] = None) -> bool:
     """Return True if current local time is considered night (22:00-08:00)."""
 
-    now = now or datetime.now()
-    hour = now.hour
-    return hour >= 22 or hour < 8
+    global _NIGHT_CACHE
+    if now is not None:
+        return now.hour >= 22 or now.hour < 8
+    tick = time.monotonic()
+    if tick < _NIGHT_CACHE[0]:
+        return _NIGHT_CACHE[1]
+    now = datetime.now()
+    value = now.hour >= 22 or now.hour < 8
+    seconds_to_next_hour = 3600 - now.minute * 60 - now.second - now.microsecond / 1_000_000
+    _NIGHT_CACHE = (tick + seconds_to_next_hour, value)
+    return value
 
 
 async def calc_passive_income_rate(session: AsyncSession, user: User, stats: Dict[str, Any]) -> float:
@@ -2783,14 +3679,7 @@ async def calc_passive_income_rate(session: AsyncSession, user: User, stats: Dic
 async def calc_team_progress_rate(session: AsyncSession, user: User, stats: Dict[str, Any]) -> float:
     """Return automated order progress per second based on team performance."""
 
-    rows = (
-        await session.execute(
-            select(TeamMember.base_income_per_min, UserTeam.level)
-            .join(UserTeam, TeamMember.id == UserTeam.member_id)
-            .where(UserTeam.user_id == user.id)
-        )
-    ).all()
-    per_min = sum(team_income_per_min(b, lvl) for b, lvl in rows)
+    per_min = (await session.execute(SELECT_TEAM_INCOME_PER_MIN, {"uid": user.id})).scalar_one()
     team_bonus = 1.0 + stats.get("team_income_pct", 0.0)
     passive_mul_total = stats.get("passive_mul_total", 1.0)
     rate = (per_min / 60.0) * passive_mul_total * team_bonus
@@ -2844,12 +3733,20 @@ async def process_offline_income(
     *,
     message: Optional[Message] = None,
     state: Optional[FSMContext] = None,
+    min_step: float = OFFLINE_INCOME_MIN_STEP_SECONDS,
 ) -> IdleIncomeResult:
-    """Apply passive income and automated progress accumulated since the last action."""
+    """Apply passive income and automated progress accumulated since the last action.
+
+    Gaps shorter than ``min_step`` seconds are left to accumulate until a later call.
+    """
 
     now = utcnow()
     last_seen = ensure_naive(user.last_seen) or now
     delta_raw = max(0.0, (now - last_seen).total_seconds())
+    if user.last_seen is not None and delta_raw < min_step:
+        # last_seen не трогаем: доля секунды учтётся при следующем вызове,
+        # а полный пересчёт статов на каждом быстром клике не нужен.
+        return IdleIncomeResult()
     stats = await get_user_stats(session, user)
     offline_cap = MAX_OFFLINE_SECONDS + stats.get("offline_cap_bonus", 0.0)
     delta = min(delta_raw, offline_cap)
@@ -2876,14 +3773,15 @@ async def process_offline_income(
     if amount > 0:
         user.balance += amount
         user.passive_income_collected += amount
-        session.add(
+        queue_write(
+            session,
             EconomyLog(
                 user_id=user.id,
                 type="passive",
                 amount=amount,
                 meta={"sec": int(delta), "sec_raw": int(delta_raw)},
                 created_at=now,
-            )
+            ),
         )
         logger.debug("Offline income for user %s: +%s", user.tg_id, amount)
         achievements.extend(
@@ -2927,7 +3825,7 @@ async def handle_idle_completion(
         summary_line = f"{summary_line} · {' '.join(badges)}"
     summary_lines.append(summary_line)
     await message.answer("\n".join(summary_lines))
-    await daily_task_on_event(message, session, user, "daily_orders")
+    await daily_task_on_event(message, session, user, DAILY_TASK_ORDERS)
     await maybe_prompt_skill_choice(
         session, message, state, user, completion.prev_level, completion.levels_gained
     )
@@ -2963,7 +3861,7 @@ async def apply_order_completion(
 ) -> OrderCompletionResult:
     """Finalize an order, applying rewards and returning summary data."""
 
-    order_entity = await session.scalar(select(Order).where(Order.id == active.order_id))
+    order_entity = catalog_get(Order, active.order_id)
     reward = finish_order_reward(active.required_clicks, active.reward_snapshot_mul)
     high_bonus_pct = 0.0
     if order_entity and order_entity.min_level >= HIGH_ORDER_MIN_LEVEL:
@@ -3000,14 +3898,15 @@ async def apply_order_completion(
     if getattr(active, "trend_applied", False):
         reward_meta["trend"] = True
         reward_meta["trend_mul"] = round(getattr(active, "trend_multiplier", 1.0), 4)
-    session.add(
+    queue_write(
+        session,
         EconomyLog(
             user_id=user.id,
             type="order_finish",
             amount=reward,
             meta=reward_meta,
             created_at=now,
-        )
+        ),
     )
     logger.info(
         "Order finished",
@@ -3047,26 +3946,64 @@ async def apply_order_completion(
     )
 
 
+def _orders_pending(session: Session | AsyncSession) -> bool:
+    """True if the session holds unflushed UserOrder changes."""
+
+    return any(isinstance(obj, UserOrder) for obj in chain(session.new, session.dirty, session.deleted))
+
+
+@event.listens_for(Session, "after_flush")
+def _drop_active_orders_after_flush(session: Session, _flush_context) -> None:
+    if "active_order" in session.info and _orders_pending(session):
+        session.info.pop("active_order", None)
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _drop_active_orders_on_dml(orm_execute_state) -> None:
+    if orm_execute_state.is_select or "active_order" not in orm_execute_state.session.info:
+        return
+    if orm_execute_state.execution_options.get("keeps_session_memos"):
+        return
+    mapper = orm_execute_state.bind_mapper
+    if mapper is not None and mapper.class_ is UserOrder:
+        orm_execute_state.session.info.pop("active_order", None)
+
+
+async def add_click_progress(
+    session: AsyncSession, user: User, active: Optional[UserOrder], cp: int
+) -> None:
+    """Atomically add ``cp`` clicks to the user (and the active order, if given).
+
+    The new values come back via RETURNING and are set as committed state, so
+    the ORM neither re-reads nor re-writes these columns.
+    """
+
+    set_committed_value(
+        user, "clicks_total", await session.scalar(ADD_USER_CLICKS, {"uid": user.id, "cp": cp})
+    )
+    if active is not None:
+        set_committed_value(
+            active,
+            "progress_clicks",
+            await session.scalar(ADD_ORDER_PROGRESS, {"order_row_id": active.id, "cp": cp}),
+        )
+
+
 async def ensure_no_active_order(session: AsyncSession, user: User) -> bool:
     """Check that user does not have unfinished order."""
 
-    stmt = select(UserOrder).where(
-        UserOrder.user_id == user.id,
-        UserOrder.finished.is_(False),
-        UserOrder.canceled.is_(False),
-    )
-    return (await session.scalar(stmt)) is None
+    return (await get_active_order(session, user)) is None
 
 
 async def get_active_order(session: AsyncSession, user: User) -> Optional[UserOrder]:
-    """Return current active order for user if any."""
+    """Return current active order for user if any (memoized per session)."""
 
-    stmt = select(UserOrder).where(
-        UserOrder.user_id == user.id,
-        UserOrder.finished.is_(False),
-        UserOrder.canceled.is_(False),
-    )
-    return await session.scalar(stmt)
+    cache: Dict[int, Optional[UserOrder]] = session.info.setdefault("active_order", {})
+    if user.id in cache and not _orders_pending(session):
+        return cache[user.id]
+    active = await session.scalar(SELECT_ACTIVE_ORDER, {"uid": user.id})
+    session.info.setdefault("active_order", {})[user.id] = active
+    return active
 
 
 async def add_xp_and_levelup(user: User, xp_gain: int) -> int:
@@ -3077,10 +4014,11 @@ async def add_xp_and_levelup(user: User, xp_gain: int) -> int:
 
     start_level = user.level
     user.xp += xp_gain
-    lvl = user.level
-    while user.xp >= xp_to_level(lvl):
-        user.xp -= xp_to_level(lvl)
-        lvl += 1
+    if user.xp < xp_to_level(start_level):
+        return 0
+    total = xp_total_for_level(start_level) + user.xp
+    lvl = level_for_total_xp(total)
+    user.xp = total - xp_total_for_level(lvl)
     user.level = lvl
     return lvl - start_level
 
@@ -3110,12 +4048,7 @@ async def get_pending_event_buff(
     )
 
 
-def is_negative_event(event: RandomEvent) -> bool:
-    """Heuristic to classify events with penalties."""
-
-    effect = RANDOM_EVENT_EFFECTS.get(event.code, {})
-    if not effect:
-        return event.kind == "penalty"
+def _effect_is_negative(effect: Dict[str, Any]) -> bool:
     if effect.get("balance", 0) < 0 or effect.get("balance_pct", 0) < 0:
         return True
     if effect.get("xp", 0) < 0 or effect.get("xp_pct", 0) < 0:
@@ -3131,43 +4064,52 @@ def is_negative_event(event: RandomEvent) -> bool:
                 return True
             if choice_effect.get("xp", 0) < 0 or choice_effect.get("xp_pct", 0) < 0:
                 return True
-    if event.kind == "penalty":
-        return True
     return False
 
 
+# RANDOM_EVENT_EFFECTS статичен — разбор эффектов делается один раз при импорте.
+_NEGATIVE_EVENT_CODES: frozenset = frozenset(
+    code for code, effect in RANDOM_EVENT_EFFECTS.items() if effect and _effect_is_negative(effect)
+)
+
+
+def is_negative_event(event: RandomEvent) -> bool:
+    """Heuristic to classify events with penalties."""
+
+    return event.code in _NEGATIVE_EVENT_CODES or event.kind == "penalty"
+
+
+@lru_cache(maxsize=64)
+def _random_event_table(
+    level: int, negative_mul: float
+) -> Tuple[Tuple[RandomEvent, ...], Tuple[float, ...]]:
+    """Events available at ``level`` and their cumulative weights (cache is reset by load_catalog)."""
+
+    events = tuple(e for e in catalog_all(RandomEvent) if e.min_level <= level)
+    cum_weights: List[float] = []
+    total_weight = 0.0
+    for ev in events:
+        weight = float(max(1, ev.weight))
+        if is_negative_event(ev):
+            weight *= negative_mul
+        total_weight += weight
+        cum_weights.append(total_weight)
+    return events, tuple(cum_weights)
+
+
 async def pick_random_event(
     session: AsyncSession, user: User, stats: Optional[Dict[str, Any]] = None
 ) -> Optional[RandomEvent]:
     """Weighted random selection of event matching user level."""
 
-    events = (
-        await session.execute(
-            select(RandomEvent).where(RandomEvent.min_level <= user.level)
-        )
-    ).scalars().all()
-    if not events:
-        return None
     negative_mul = 1.0
     if stats:
         negative_mul = stats.get("negative_event_weight_mul", 1.0)
-    weights = []
-    total_weight = 0.0
-    for event in events:
-        weight = float(max(1, event.weight))
-        if is_negative_event(event):
-            weight *= negative_mul
-        weights.append(weight)
-        total_weight += weight
-    if total_weight <= 0:
+    events, cum_weights = _random_event_table(user.level, negative_mul)
+    if not events or cum_weights[-1] <= 0:
         return None
-    pick = random.uniform(0, total_weight)
-    upto = 0.0
-    for event, weight in zip(events, weights):
-        upto += weight
-        if pick <= upto:
-            return event
-    return events[-1]
+    pick = _rand_uniform(0, cum_weights[-1])
+    return events[min(bisect_left(cum_weights, pick), len(events) - 1)]
 
 
 async def apply_event_effect(
@@ -3200,14 +4142,15 @@ async def apply_event_effect(
         user.balance = new_balance
         balance_meta = {**meta_base, "balance": balance_delta}
         log_type = "event_bonus" if balance_delta >= 0 else "event_penalty"
-        session.add(
+        queue_write(
+            session,
             EconomyLog(
                 user_id=user.id,
                 type=log_type,
                 amount=balance_delta,
                 meta=balance_meta,
                 created_at=now,
-            )
+            ),
         )
     if "xp_pct" in effect:
         pct = float(effect["xp_pct"])
@@ -3229,36 +4172,40 @@ async def apply_event_effect(
             user.xp = max(0, user.xp + xp_delta)
         xp_meta = {**meta_base, "xp": xp_delta}
         log_type = "event_bonus" if xp_delta >= 0 else "event_penalty"
-        session.add(
+        queue_write(
+            session,
             EconomyLog(
                 user_id=user.id,
                 type=log_type,
                 amount=0.0,
                 meta=xp_meta,
                 created_at=now,
-            )
+            ),
         )
     if "buff" in effect:
         payload = effect["buff"] or {}
         duration = event.duration_sec or 600
         expires = now + timedelta(seconds=duration)
-        session.add(
-            UserBuff(
-                user_id=user.id,
-                code=event.code,
-                title=event.title,
-                expires_at=expires,
-                payload=payload,
-            )
+        buff = UserBuff(
+            user_id=user.id,
+            code=event.code,
+            expires_at=expires,
+            payload={},
         )
-        session.add(
+        if len(payload) == 1:
+            ((buff.effect_key, buff.effect_value),) = payload.items()
+        else:
+            buff.payload = payload
+        session.add(buff)
+        queue_write(
+            session,
             EconomyLog(
                 user_id=user.id,
                 type="event_buff",
                 amount=0.0,
                 meta={**meta_base, "buff": payload, "duration": duration},
                 created_at=now,
-            )
+            ),
         )
         message = "\n".join(
             [
@@ -3300,14 +4247,14 @@ async def apply_random_event(session: AsyncSession, user: User, event: RandomEve
             delete(UserBuff).where(
                 UserBuff.user_id == user.id,
                 UserBuff.code == f"{PENDING_EVENT_PREFIX}{event.code}",
-            )
+            ),
+            execution_options={"user_id": user.id},
         )
         expires = utcnow() + timedelta(hours=12)
         session.add(
             UserBuff(
                 user_id=user.id,
                 code=f"{PENDING_EVENT_PREFIX}{event.code}",
-                title=event.title,
                 expires_at=expires,
                 payload={"event": event.code, "trigger": trigger, "options": interactive},
             )
@@ -3330,7 +4277,7 @@ async def trigger_random_event(
 ) -> Optional[Tuple[str, Optional[InlineKeyboardMarkup]]]:
     """Roll random event with probability and return announcement if triggered."""
 
-    if random.random() > probability:
+    if _rand() > probability:
         return None
     if await has_pending_interactive_event(session, user):
         return None
@@ -3346,11 +4293,19 @@ async def trigger_random_event(
     return await apply_random_event(session, user, event, trigger)
 
 
+# Процентные ключи эффектов и их подписи — считаются один раз, а не на каждый вывод.
+_EFFECT_PCT_LABELS: Dict[str, str] = {
+    key: key.replace("_", " ")
+    for key in ("reward_pct", "passive_pct", "req_clicks_pct", "xp_pct", "balance_pct")
+}
+
+
 def describe_effect(effect: Dict[str, Any]) -> str:
     parts = []
     for key, value in effect.items():
-        if key in {"reward_pct", "passive_pct", "req_clicks_pct", "xp_pct", "balance_pct"}:
-            parts.append(f"{key.replace('_', ' ')} {int(value * 100)}%")
+        label = _EFFECT_PCT_LABELS.get(key)
+        if label is not None:
+            parts.append(f"{label} {int(value * 100)}%")
         else:
             parts.append(f"{key}: {value}")
     return ", ".join(parts)
@@ -3363,13 +4318,10 @@ async def get_available_skills(session: AsyncSession, user: User) -> List[Skill]
         )
     ).scalars().all()
     taken_codes = set(taken)
-    skills = (
-        await session.execute(
-            select(Skill)
-            .where(Skill.min_level <= user.level)
-            .order_by(Skill.min_level, Skill.id)
-        )
-    ).scalars().all()
+    skills = sorted(
+        (s for s in catalog_all(Skill) if s.min_level <= user.level),
+        key=lambda s: (s.min_level, s.id),
+    )
     return [s for s in skills if s.code not in taken_codes]
 
 
@@ -3392,7 +4344,7 @@ async def maybe_prompt_skill_choice(
                 return
             if not message or not state:
                 return
-            choices = random.sample(available, min(3, len(available)))
+            choices = _rand_sample(available, min(3, len(available)))
             lines = [RU.SKILL_PROMPT]
             for idx, skill in enumerate(choices, 1):
                 lines.append(f"[{idx}] {skill.name} — {describe_effect(skill.effect)}")
@@ -3406,15 +4358,17 @@ async def maybe_send_trend_hint(message: Message, session: AsyncSession, user: U
     trend = await get_trend(session)
     if not trend:
         return
-    order = await session.scalar(select(Order).where(Order.id == trend.get("order_id")))
+    order = catalog_get(Order, trend.get("order_id"))
     if not order:
         return
     payload = ensure_tutorial_payload(user)
-    today_key = utcnow().date().isoformat()
+    now = utcnow()
+    today_key = now.date().isoformat()
     if payload.get("trend_hint_date") == today_key:
         return
     payload["trend_hint_date"] = today_key
-    user.updated_at = utcnow()
+    flag_modified(user, "tutorial_payload")
+    user.updated_at = now
     mul_text = format_stat(float(trend.get("reward_mul", TREND_REWARD_MUL)))
     await message.answer(RU.SPECIAL_ORDER_HINT.format(title=order.title, mul=mul_text))
 
@@ -3476,14 +4430,27 @@ async def update_campaign_progress(session: AsyncSession, user: User, event: str
         if "team_level" in goal:
             members_needed = goal["team_level"].get("members", 1)
             level_needed = goal["team_level"].get("level", 1)
-            team_count = (
-                await session.execute(
-                    select(func.count())
-                    .select_from(UserTeam)
-                    .where(UserTeam.user_id == user.id, UserTeam.level >= level_needed)
-                )
-            ).scalar_one()
-            data["team_level"] = int(team_count)
+            counted = data.get("team_level")
+            from_level = payload.get("from_level")
+            to_level = payload.get("to_level")
+            if counted is not None and counted >= members_needed:
+                return
+            if counted is not None and from_level is not None and to_level is not None:
+                # Счётчик главы уже посчитан, а уровни команды только растут
+                # (сброс престижа обнуляет прогресс): он меняется, лишь когда
+                # апгрейд пересёк порог, — COUNT не нужен.
+                if not from_level < level_needed <= to_level:
+                    return
+                data["team_level"] = counted + 1
+            else:
+                team_count = (
+                    await session.execute(
+                        select(func.count())
+                        .select_from(UserTeam)
+                        .where(UserTeam.user_id == user.id, UserTeam.level >= level_needed)
+                    )
+                ).scalar_one()
+                data["team_level"] = int(team_count)
     elif event == "item_purchase":
         data["items_bought"] = data.get("items_bought", 0) + 1
     progress.progress = data
@@ -3505,6 +4472,23 @@ def describe_campaign_goal(goal: dict) -> str:
     return "Прогресс неизвестен"
 
 
+def _escape_format(value: Any) -> str:
+    return str(value).replace("{", "{{").replace("}", "}}")
+
+
+# Строка статуса главы меняется только в части прогресса — собираем заранее.
+CAMPAIGN_STATUS_BY_CHAPTER: Dict[int, str] = {
+    chapter["chapter"]: RU.CAMPAIGN_STATUS.format(
+        chapter=chapter["chapter"],
+        total=len(CAMPAIGN_CHAPTERS),
+        title=_escape_format(chapter["title"]),
+        goal=_escape_format(describe_campaign_goal(chapter.get("goal", {}))),
+        progress="{progress}",
+    )
+    for chapter in CAMPAIGN_CHAPTERS
+}
+
+
 async def claim_campaign_reward(session: AsyncSession, user: User) -> Optional[Tuple[str, int, int]]:
     progress = await get_campaign_progress_entry(session, user)
     definition = get_campaign_definition(progress.chapter)
@@ -3523,14 +4507,15 @@ async def claim_campaign_reward(session: AsyncSession, user: User) -> Optional[T
     if reward.get("passive_pct"):
         user.passive_mul += reward["passive_pct"]
     now = utcnow()
-    session.add(
+    queue_write(
+        session,
         EconomyLog(
             user_id=user.id,
             type="campaign_reward",
             amount=rub,
             meta={"chapter": progress.chapter, "xp": xp_gain},
             created_at=now,
-        )
+        ),
     )
     progress.chapter += 1
     progress.is_done = False
@@ -3549,29 +4534,91 @@ async def get_or_create_quest(session: AsyncSession, user: User, code: str) -> U
     return quest
 
 
+async def load_user_quests_bulk(
+    session: AsyncSession, user: User, codes: Sequence[str]
+) -> Dict[str, UserQuest]:
+    """Fetch the user's quest rows for ``codes`` in one query, keyed by quest code."""
+
+    if not codes:
+        return {}
+    rows = (
+        await session.execute(
+            select(UserQuest).where(UserQuest.user_id == user.id, UserQuest.quest_code.in_(codes))
+        )
+    ).scalars()
+    return {quest.quest_code: quest for quest in rows}
+
+
+# Ключи прогресса статичных квестов: id(определения) -> кортеж payload_keys.
+_QUEST_PAYLOAD_KEYS: Dict[int, Tuple[str, ...]] = {
+    id(definition): tuple(definition.get("payload_keys", ()))
+    for definition in QUEST_DEFINITIONS.values()
+}
+
+
+def quest_payload_keys(definition: Dict[str, Any]) -> Tuple[str, ...]:
+    """Return payload keys tracked by the quest, as a tuple."""
+
+    keys = _QUEST_PAYLOAD_KEYS.get(id(definition))
+    if keys is None:
+        keys = tuple(definition.get("payload_keys", ()))
+    return keys
+
+
 def quest_get_stage_payload(quest: UserQuest, definition: Dict[str, Any]) -> Dict[str, int]:
     payload = quest.payload or {}
-    for key in definition.get("payload_keys", []):
+    for key in quest_payload_keys(definition):
         payload.setdefault(key, 0)
-    quest.payload = payload
+    if payload is quest.payload:
+        flag_modified(quest, "payload")
+    else:
+        quest.payload = payload
     return payload
 
 
 def quest_choose_reward_key(payload: Dict[str, int], definition: Dict[str, Any]) -> str:
-    best_key = "default"
-    best_value = -999
-    keys = definition.get("payload_keys", [])
-    for key in keys:
-        if payload.get(key, 0) > best_value:
-            best_value = payload.get(key, 0)
-            best_key = key
-    return best_key if best_value > 0 else "default"
+    keys = quest_payload_keys(definition)
+    if not keys:
+        return "default"
+    # max() отдаёт первый из равных — как и прежний перебор со строгим «>».
+    best_key = max(keys, key=lambda key: payload.get(key, 0))
+    return best_key if payload.get(best_key, 0) > 0 else "default"
+
+
+# Квесты по возрастанию min_level (порядок внутри уровня — как в QUEST_DEFINITIONS):
+# перебор в меню останавливается на первом недоступном.
+QUESTS_BY_MIN_LEVEL: Tuple[Tuple[int, str, Dict[str, Any]], ...] = tuple(
+    sorted(
+        ((int(definition.get("min_level", 1)), code, definition) for code, definition in QUEST_DEFINITIONS.items()),
+        key=lambda entry: entry[0],
+    )
+)
+# Уровень, с которого открывается первый квест (2 — если квестов нет).
+QUEST_MIN_LEVEL = QUESTS_BY_MIN_LEVEL[0][0] if QUESTS_BY_MIN_LEVEL else 2
+
+# Порядок этапов статичных квестов: id(определения) -> (ключи этапов, ключ -> индекс).
+# Только для QUEST_DEFINITIONS: чужие словари считаются на лету (id может переиспользоваться).
+_QUEST_STAGE_INDEX: Dict[int, Tuple[Tuple[str, ...], Dict[str, int]]] = {
+    id(definition): (
+        tuple(definition.get("flow", {})),
+        {key: idx for idx, key in enumerate(definition.get("flow", {}))},
+    )
+    for definition in QUEST_DEFINITIONS.values()
+}
 
 
-def quest_stage_keys(definition: Dict[str, Any]) -> List[str]:
-    """Return ordered list of stage keys for quest flow."""
+def _quest_stage_index_entry(definition: Dict[str, Any]) -> Tuple[Tuple[str, ...], Dict[str, int]]:
+    entry = _QUEST_STAGE_INDEX.get(id(definition))
+    if entry is None:
+        keys = tuple(definition.get("flow", {}))
+        entry = (keys, {key: idx for idx, key in enumerate(keys)})
+    return entry
 
-    return list(definition.get("flow", {}).keys())
+
+def quest_stage_keys(definition: Dict[str, Any]) -> Sequence[str]:
+    """Return ordered stage keys for quest flow."""
+
+    return _quest_stage_index_entry(definition)[0]
 
 
 def quest_current_stage_key(quest: UserQuest, definition: Dict[str, Any]) -> Optional[str]:
@@ -3586,11 +4633,7 @@ def quest_current_stage_key(quest: UserQuest, definition: Dict[str, Any]) -> Opt
 def quest_stage_index(definition: Dict[str, Any], stage_key: str) -> Optional[int]:
     """Return index of stage key within quest flow."""
 
-    keys = quest_stage_keys(definition)
-    try:
-        return keys.index(stage_key)
-    except ValueError:
-        return None
+    return _quest_stage_index_entry(definition)[1].get(stage_key)
 
 
 async def finalize_quest(
@@ -3615,14 +4658,15 @@ async def finalize_quest(
     now = utcnow()
     quest.is_done = True
     quest.stage = 999
-    session.add(
+    queue_write(
+        session,
         EconomyLog(
             user_id=user.id,
             type="quest_reward",
             amount=rub,
             meta={"quest": quest.quest_code, "reward_key": reward_key, "xp": xp_gain},
             created_at=now,
-        )
+        ),
     )
     await message.answer(
         RU.QUEST_FINISH.format(rub=rub, xp=xp_gain),
@@ -3633,21 +4677,23 @@ async def finalize_quest(
         await notify_level_up_message(message, session, user, prev_level, levels_gained)
     reward_item = reward_data.get("item_code")
     if reward_item:
-        item = await session.scalar(select(Item).where(Item.code == reward_item))
+        item = catalog_by_code(Item, reward_item)
         if item:
-            has_item = await session.scalar(
-                select(UserItem).where(UserItem.user_id == user.id, UserItem.item_id == item.id)
+            # Каталог уже в памяти, так что владение проверяет сам uq_user_item.
+            await session.execute(
+                sqlite_insert(UserItem)
+                .values(user_id=user.id, item_id=item.id)
+                .on_conflict_do_nothing(index_elements=["user_id", "item_id"])
             )
-            if not has_item:
-                session.add(UserItem(user_id=user.id, item_id=item.id))
-            session.add(
+            queue_write(
+                session,
                 EconomyLog(
                     user_id=user.id,
                     type="quest_reward",
                     amount=0.0,
                     meta={"quest": quest.quest_code, "item": item.code},
                     created_at=now,
-                )
+                ),
             )
             template = reward_data.get("item_template", "trophy")
             if template == "client_talisman":
@@ -3667,7 +4713,7 @@ async def send_quest_step(message: Message, quest_code: str, stage_key: str) ->
     step = definition.get("flow", {}).get(stage_key)
     if not step:
         return
-    options = [opt["text"] for opt in step.get("options", [])]
+    options = tuple(opt["text"] for opt in step.get("options", []))
     await message.answer(
         RU.QUEST_STEP.format(text=step["text"]),
         reply_markup=kb_quest_options(options),
@@ -3680,34 +4726,28 @@ async def present_quest_selection(
     """Show quest selection menu and return True if options were presented."""
 
     available: List[Tuple[str, Dict[str, Any]]] = []
-    unlocked_any = False
-    min_required: Optional[int] = None
-    for code, definition in QUEST_DEFINITIONS.items():
-        min_level = int(definition.get("min_level", 1))
+    unlocked: List[Tuple[str, Dict[str, Any]]] = []
+    for min_level, code, definition in QUESTS_BY_MIN_LEVEL:
         if user.level < min_level:
-            if min_required is None or min_level < min_required:
-                min_required = min_level
-            continue
-        unlocked_any = True
-        quest = await get_or_create_quest(session, user, code)
-        if quest.is_done:
+            break
+        unlocked.append((code, definition))
+    # Строку квеста создаёт get_or_create_quest при выборе; для меню нужен только is_done.
+    quests = await load_user_quests_bulk(session, user, [code for code, _ in unlocked])
+    for code, definition in unlocked:
+        quest = quests.get(code)
+        if quest is not None and quest.is_done:
             continue
         available.append((code, definition))
     if available:
-        options = [definition.get("name", code) for code, definition in available]
+        options = tuple(definition.get("name", code) for code, definition in available)
         mapping = {definition.get("name", code): code for code, definition in available}
         await state.set_state(QuestState.selecting)
         await state.update_data(quest_choices=mapping, active_quest=None)
         await message.answer(RU.QUEST_SELECT, reply_markup=kb_quest_options(options))
         return True
-    fallback_lvl = min(
-        (int(defn.get("min_level", 1)) for defn in QUEST_DEFINITIONS.values()),
-        default=2,
-    )
     markup = await main_menu_for_message(message, session=session, user=user)
-    if not unlocked_any:
-        lvl = min_required or fallback_lvl or 2
-        await message.answer(RU.QUEST_LOCKED.format(lvl=lvl), reply_markup=markup)
+    if not unlocked:
+        await message.answer(RU.QUEST_LOCKED.format(lvl=QUEST_MIN_LEVEL), reply_markup=markup)
     else:
         await message.answer(RU.QUEST_ALL_DONE, reply_markup=markup)
     await state.clear()
@@ -3715,14 +4755,31 @@ async def present_quest_selection(
 
 
 async def get_prestige_entry(session: AsyncSession, user: User) -> UserPrestige:
+    cache: Dict[int, UserPrestige] = session.info.setdefault("prestige", {})
+    prestige = cache.get(user.id)
+    if prestige is not None:
+        return prestige
     prestige = await session.scalar(select(UserPrestige).where(UserPrestige.user_id == user.id))
     if not prestige:
         prestige = UserPrestige(user_id=user.id, reputation=0, resets=0)
         session.add(prestige)
         await session.flush()
+    cache[user.id] = prestige
     return prestige
 
 
+# Строки забега, которые престиж удаляет целиком.
+PRESTIGE_RESET_MODELS: Tuple[type, ...] = (
+    UserBoost,
+    UserTeam,
+    UserItem,
+    UserBuff,
+    UserSkill,
+    UserOrder,
+    UserQuest,
+)
+
+
 async def perform_prestige_reset(
     session: AsyncSession, user: User, gain: int, total_earned: float
 ) -> None:
@@ -3731,14 +4788,15 @@ async def perform_prestige_reset(
     prestige.reputation += max(0, gain)
     prestige.resets += 1
     prestige.last_reset_at = now
-    session.add(
+    queue_write(
+        session,
         EconomyLog(
             user_id=user.id,
             type="prestige_reset",
             amount=0.0,
             meta={"gain": gain, "total_earned": round(total_earned, 2)},
             created_at=now,
-        )
+        ),
     )
     logger.info(
         "Prestige reset",
@@ -3760,23 +4818,19 @@ async def perform_prestige_reset(
     user.passive_income_collected = 0
     user.tutorial_free_boost_used = False
     user.updated_at = now
-    await session.execute(delete(UserBoost).where(UserBoost.user_id == user.id))
-    await session.execute(delete(UserTeam).where(UserTeam.user_id == user.id))
-    await session.execute(delete(UserItem).where(UserItem.user_id == user.id))
-    await session.execute(delete(UserBuff).where(UserBuff.user_id == user.id))
-    await session.execute(delete(UserSkill).where(UserSkill.user_id == user.id))
-    await session.execute(delete(UserOrder).where(UserOrder.user_id == user.id))
+    for model in PRESTIGE_RESET_MODELS:
+        await session.execute(
+            delete(model).where(model.user_id == user.id), execution_options={"user_id": user.id}
+        )
     await session.execute(delete(UserAchievement).where(UserAchievement.user_id == user.id, UserAchievement.unlocked_at.is_(None)))
-    await session.execute(delete(UserEquipment).where(UserEquipment.user_id == user.id))
-    for slot in ["laptop", "phone", "tablet", "monitor", "chair", "charm"]:
-        session.add(UserEquipment(user_id=user.id, slot=slot, item_id=None))
-    await session.execute(delete(UserQuest).where(UserQuest.user_id == user.id))
-    progress = await session.scalar(select(CampaignProgress).where(CampaignProgress.user_id == user.id))
-    if progress:
-        progress.chapter = 1
-        progress.is_done = False
-        progress.progress = {}
-
+    # Слоты не удаляем и не создаём заново: upsert очищает все шесть одним запросом.
+    await init_user_equipment(session, user.id)
+    # UPDATE вместо SELECT + изменения ORM-объекта: один запрос, строки может и не быть.
+    await session.execute(
+        update(CampaignProgress)
+        .where(CampaignProgress.user_id == user.id)
+        .values(chapter=1, is_done=False, progress={})
+    )
 
 
 def project_next_item_params(item: Item) -> Tuple[float, int]:
@@ -3795,59 +4849,58 @@ def project_next_item_params(item: Item) -> Tuple[float, int]:
 async def get_next_items_for_user(session: AsyncSession, user: User) -> List[Item]:
     """Return only the next tier items per slot available for purchase."""
 
-    items = (
-        await session.execute(
-            select(Item).where(Item.min_level <= user.level).order_by(Item.slot, Item.tier)
-        )
-    ).scalars().all()
-    owned_ids = {
-        row[0]
-        for row in (
-            await session.execute(select(UserItem.item_id).where(UserItem.user_id == user.id))
-        ).all()
-    }
+    owned_ids = set(
+        (await session.execute(select(UserItem.item_id).where(UserItem.user_id == user.id))).scalars()
+    )
+    # Каталог уже упорядочен по (slot, tier): первый подходящий предмет слота и есть следующий.
     result: List[Item] = []
-    grouped: Dict[str, List[Item]] = defaultdict(list)
-    for item in items:
-        grouped[item.slot].append(item)
-    for slot_items in grouped.values():
-        slot_items.sort(key=lambda x: x.tier)
-        for item in slot_items:
-            if item.id not in owned_ids:
-                result.append(item)
-                break
-    result.sort(key=lambda it: (it.slot, it.tier))
+    taken_slots: Set[str] = set()
+    for item in _ITEMS_BY_SLOT_TIER:
+        if item.slot in taken_slots or item.min_level > user.level or item.id in owned_ids:
+            continue
+        taken_slots.add(item.slot)
+        result.append(item)
     return result
 
 
-async def get_achievement_progress_value(
-    session: AsyncSession, user: User, trigger: str
-) -> int:
-    """Resolve current progress for the given achievement trigger."""
-
-    if trigger == "clicks":
-        return user.clicks_total
-    if trigger == "orders":
-        return user.orders_completed
-    if trigger == "level":
-        return user.level
-    if trigger == "balance":
-        return user.balance
-    if trigger == "passive_income":
-        return user.passive_income_collected
-    if trigger == "team":
-        value = await session.scalar(
-            select(func.count()).select_from(UserTeam).where(UserTeam.user_id == user.id, UserTeam.level > 0)
-        )
-        return int(value or 0)
-    if trigger == "items":
-        value = await session.scalar(
-            select(func.count()).select_from(UserItem).where(UserItem.user_id == user.id)
-        )
-        return int(value or 0)
-    if trigger == "daily":
-        return user.daily_bonus_claims
-    return 0
+# Триггеры достижений, прогресс которых уже лежит в строке User: триггер -> атрибут.
+ACHIEVEMENT_USER_ATTRS: Dict[str, str] = {
+    "clicks": "clicks_total",
+    "orders": "orders_completed",
+    "level": "level",
+    "balance": "balance",
+    "passive_income": "passive_income_collected",
+    "daily": "daily_bonus_claims",
+}
+
+# Триггеры достижений, которые считаются в БД: триггер -> скалярный подзапрос по :uid.
+ACHIEVEMENT_COUNT_SUBQUERIES = {
+    "team": select(func.count())
+    .select_from(UserTeam)
+    .where(UserTeam.user_id == bindparam("uid"), UserTeam.level > 0)
+    .scalar_subquery(),
+    "items": select(func.count())
+    .select_from(UserItem)
+    .where(UserItem.user_id == bindparam("uid"))
+    .scalar_subquery(),
+}
+
+
+async def fetch_achievement_counts(
+    session: AsyncSession, user: User, triggers: Set[str]
+) -> Dict[str, int]:
+    """Compute every DB-backed trigger from ``triggers`` in a single SELECT."""
+
+    wanted = [trigger for trigger in ACHIEVEMENT_COUNT_SUBQUERIES if trigger in triggers]
+    if not wanted:
+        return {}
+    row = (
+        await session.execute(
+            select(*(ACHIEVEMENT_COUNT_SUBQUERIES[trigger].label(trigger) for trigger in wanted)),
+            {"uid": user.id},
+        )
+    ).one()
+    return {trigger: int(value or 0) for trigger, value in zip(wanted, row)}
 
 
 async def evaluate_achievements(
@@ -3857,66 +4910,52 @@ async def evaluate_achievements(
 
     if not triggers:
         return []
-    achievements = (
-        await session.execute(
-            select(Achievement)
-            .where(Achievement.trigger.in_(list(triggers)))
-            .order_by(Achievement.id)
-        )
-    ).scalars().all()
-    if not achievements:
+    needed = {trigger for trigger in triggers if trigger in _ACHIEVEMENTS_BY_TRIGGER}
+    if not needed:
         return []
-    existing = {
+    achievements = sorted(
+        chain.from_iterable(_ACHIEVEMENTS_BY_TRIGGER[trigger] for trigger in needed),
+        key=lambda ach: ach.id,
+    )
+    # Все значения прогресса — до цикла: счётчики из БД одним запросом, остальное из User.
+    progress_cache = await fetch_achievement_counts(session, user, needed)
+    for trigger in needed - progress_cache.keys():
+        attr = ACHIEVEMENT_USER_ATTRS.get(trigger)
+        progress_cache[trigger] = getattr(user, attr) if attr is not None else 0
+    now = utcnow()
+    rows: List[Dict[str, Any]] = []
+    for ach in achievements:
+        progress_value = progress_cache[ach.trigger]
+        rows.append(
+            {
+                "user_id": user.id,
+                "achievement_id": ach.id,
+                "progress": progress_value,
+                "unlocked_at": now if progress_value >= ach.threshold else None,
+                "notified": False,
+            }
+        )
+    # Один upsert вместо SELECT + UPDATE/INSERT на каждую строку. RETURNING отдаёт
+    # ORM-объекты (populate_existing обновляет уже загруженные в сессию).
+    stmt = sqlite_insert(UserAchievement).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["user_id", "achievement_id"],
+        set_={
+            "progress": stmt.excluded.progress,
+            "unlocked_at": func.coalesce(UserAchievement.unlocked_at, stmt.excluded.unlocked_at),
+        },
+    ).returning(UserAchievement)
+    saved = {
         ua.achievement_id: ua
         for ua in (
-            await session.execute(
-                select(UserAchievement).where(
-                    UserAchievement.user_id == user.id,
-                    UserAchievement.achievement_id.in_([ach.id for ach in achievements]),
-                )
-            )
-        ).scalars()
+            await session.scalars(stmt, execution_options={"populate_existing": True})
+        )
     }
     unlocked: List[Tuple[Achievement, UserAchievement]] = []
-    progress_cache: Dict[str, int] = {}
-
-    async def _progress(trigger: str) -> int:
-        if trigger not in progress_cache:
-            progress_cache[trigger] = await get_achievement_progress_value(session, user, trigger)
-        return progress_cache[trigger]
-
     for ach in achievements:
-        ua = existing.get(ach.id)
-        progress_value = await _progress(ach.trigger)
-        if ua:
-            ua.progress = progress_value
-        if progress_value >= ach.threshold:
-            if not ua:
-                ua = UserAchievement(
-                    user_id=user.id,
-                    achievement_id=ach.id,
-                    progress=progress_value,
-                    unlocked_at=utcnow(),
-                    notified=False,
-                )
-                session.add(ua)
-            else:
-                if ua.unlocked_at is None:
-                    ua.unlocked_at = utcnow()
-                ua.notified = ua.notified and ua.unlocked_at is not None
-            if ua and not ua.notified:
-                unlocked.append((ach, ua))
-        else:
-            if not ua:
-                session.add(
-                    UserAchievement(
-                        user_id=user.id,
-                        achievement_id=ach.id,
-                        progress=progress_value,
-                        unlocked_at=None,
-                        notified=False,
-                    )
-                )
+        ua = saved.get(ach.id)
+        if ua and progress_cache[ach.trigger] >= ach.threshold and not ua.notified:
+            unlocked.append((ach, ua))
     return unlocked
 
 
@@ -3990,7 +5029,10 @@ def _income_components() -> Tuple[Any, Any]:
 def format_money(value: float) -> str:
     """Format ruble values with spaces as thousands separators."""
 
-    return f"{int(round(value)):,}".replace(",", " ")
+    amount = round(value)  # round() без ndigits уже возвращает int
+    if -1000 < amount < 1000:
+        return str(amount)
+    return f"{amount:,}".replace(",", " ")
 
 
 def format_price(value: float) -> str:
@@ -4002,13 +5044,14 @@ def format_price(value: float) -> str:
 def apply_percentage_discount(value: float, pct: float, *, cap: Optional[float] = None) -> int:
     """Return integer price after applying percentage discount with optional cap."""
 
-    if cap is not None:
-        pct = min(pct, cap)
-    pct = max(0.0, min(0.99, pct))
-    discounted = int(round(value * (1 - pct)))
     if value <= 0:
         return int(round(value))
-    return max(1, discounted)
+    if cap is not None and pct > cap:
+        pct = cap
+    # Один round() на float-произведении: целочисленный fixed-point сдвигает
+    # цены на монету на точных половинках, поэтому остаёмся на float.
+    discounted = round(value * (1 - max(0.0, min(0.99, pct))))
+    return discounted if discounted > 1 else 1
 
 
 def format_stat(value: float) -> str:
@@ -4022,11 +5065,16 @@ def format_stat(value: float) -> str:
 def rank_for(level: int, reputation: int) -> str:
     """Return rank title for given level and reputation."""
 
+    return _rank_title(level, reputation > 0)
+
+
+@lru_cache(maxsize=256)
+def _rank_title(level: int, has_reputation: bool) -> str:
     title = RANK_THRESHOLDS[0][1]
     for lvl, name in RANK_THRESHOLDS:
         if level >= lvl:
             title = name
-    if level >= 20 and reputation > 0:
+    if level >= 20 and has_reputation:
         title = PRESTIGE_RANK
     return title
 
@@ -4042,6 +5090,13 @@ def describe_reward(reward: Dict[str, int]) -> str:
     return " и ".join(parts) if parts else "бонус"
 
 
+@lru_cache(maxsize=64)
+def _progress_bar_table(filled_char: str, empty_char: str, length: int) -> Tuple[str, ...]:
+    """Return every rendering of a bar of given length, indexed by filled cells."""
+
+    return tuple(filled_char * i + empty_char * (length - i) for i in range(length + 1))
+
+
 def render_progress_bar(
     current: float,
     total: float,
@@ -4062,7 +5117,7 @@ def render_progress_bar(
     if filled == 0 and ratio > 0.0:
         filled = 1
     filled = max(0, min(length, filled))
-    return f"{filled_char * filled}{empty_char * (length - filled)}"
+    return _progress_bar_table(filled_char, empty_char, length)[filled]
 
 
 def percentage(current: float, total: float) -> int:
@@ -4097,6 +5152,8 @@ ORDER_ICON_KEYWORDS: Tuple[Tuple[str, str], ...] = (
 )
 
 
+# Заголовки заказов берутся из сидов — их немного, иконку достаточно подобрать один раз.
+@lru_cache(maxsize=256)
 def pick_order_icon(title: str) -> str:
     """Pick a representative emoji for an order title."""
 
@@ -4108,8 +5165,9 @@ def pick_order_icon(title: str) -> str:
 
 
 async def fetch_average_income_rows(session: AsyncSession) -> List[Tuple[int, str, float]]:
-    """Return per-user average income composed of passive and active totals."""
+    """Return (user id, display name, income) for every user, highest income first."""
 
+    await flush_queued_writes(session)
     passive_sum, active_sum = _income_components()
     income_agg = (
         select(
@@ -4121,30 +5179,24 @@ async def fetch_average_income_rows(session: AsyncSession) -> List[Tuple[int, st
         .subquery()
     )
 
-    rows = (
-        await session.execute(
-            select(
-                User.id,
-                User.first_name,
-                func.coalesce(income_agg.c.passive_total, 0.0),
-                func.coalesce(income_agg.c.active_total, 0.0),
-            )
-            .outerjoin(income_agg, income_agg.c.user_id == User.id)
-            .order_by(User.id)
-        )
-    ).all()
-
-    result: List[Tuple[int, str, float]] = []
-    for uid, name, passive_total, active_total in rows:
-        total = float(passive_total or 0.0) + float(active_total or 0.0)
-        display_name = name or f"Игрок {uid}"
-        result.append((uid, display_name, total))
-    return result
+    total = (
+        func.coalesce(income_agg.c.passive_total, 0.0) + func.coalesce(income_agg.c.active_total, 0.0)
+    ).label("total")
+    display_name = func.coalesce(
+        func.nullif(User.first_name, ""), "Игрок " + cast(User.id, String)
+    )
+    rows = await session.execute(
+        select(User.id, display_name, total)
+        .outerjoin(income_agg, income_agg.c.user_id == User.id)
+        .order_by(total.desc(), User.id)
+    )
+    return list(rows.tuples())
 
 
 async def fetch_user_average_income(session: AsyncSession, user_id: int) -> float:
     """Calculate a single user's combined passive and active income."""
 
+    await flush_queued_writes(session)
     passive_sum, active_sum = _income_components()
     row = await session.execute(
         select(
@@ -4186,21 +5238,40 @@ class TutorialGateMiddleware(BaseMiddleware):
 
 
 class RateLimiter:
-    """Sliding-window rate limiter per Telegram user."""
+    """Sliding-window rate limiter per Telegram user.
+
+    Keeps a ring of the last accepted timestamps per user: an event is allowed
+    when the ``limit``-th most recent of them is more than a second old. Only
+    the ``MAX_USERS`` most recently active users are tracked.
+    """
+
+    HISTORY = 100
+    MAX_USERS = 10_000
 
     def __init__(self) -> None:
-        self._events: Dict[int, Deque[float]] = defaultdict(lambda: deque(maxlen=100))
+        # tg_id -> [кольцо из HISTORY отметок времени, индекс следующей записи];
+        # порядок ключей — LRU, вытесненный пользователь просто начнёт с чистого окна.
+        self._events: "OrderedDict[int, List[Any]]" = OrderedDict()
 
     def allow(self, user_id: int, limit_per_sec: int, now: Optional[float] = None) -> bool:
         """Return True if event allowed under given rate, False otherwise."""
 
+        if limit_per_sec <= 0:
+            return False
         t = time.monotonic() if now is None else now
-        dq = self._events[user_id]
-        while dq and t - dq[0] > 1.0:
-            dq.popleft()
-        if len(dq) >= limit_per_sec:
+        events = self._events
+        state = events.get(user_id)
+        if state is None:
+            if len(events) >= self.MAX_USERS:
+                events.popitem(last=False)
+            state = events[user_id] = [[float("-inf")] * self.HISTORY, 0]
+        else:
+            events.move_to_end(user_id)
+        ring, idx = state
+        if limit_per_sec <= self.HISTORY and t - ring[idx - limit_per_sec] <= 1.0:
             return False
-        dq.append(t)
+        ring[idx] = t
+        state[1] = idx + 1 if idx + 1 < self.HISTORY else 0
         return True
 
 
@@ -4228,11 +5299,8 @@ class RateLimitMiddleware(BaseMiddleware):
 async def get_user_click_limit(tg_id: int) -> int:
     """Возвращает базовый лимит кликов."""
 
-    async with session_scope() as session:
-        user = await session.scalar(select(User).where(User.tg_id == tg_id))
-        if not user:
-            return BASE_CLICK_LIMIT
-        await get_user_stats(session, user)
+    # Лимит пока не зависит от статов игрока, поэтому сессия здесь не открывается:
+    # иначе каждый клик ходил бы в БД ещё до проверки лимита.
     return BASE_CLICK_LIMIT
 
 
@@ -4299,7 +5367,7 @@ async def get_or_create_user(
     """Fetch existing user or create a new record. Returns referral info if applied."""
 
     async with session_scope() as session:
-        user = await session.scalar(select(User).where(User.tg_id == tg_id))
+        user = await get_user_by_tg(session, tg_id)
         created = False
         referral_payload: Optional[Dict[str, Any]] = None
         if not user:
@@ -4327,41 +5395,42 @@ async def get_or_create_user(
                     "Race while creating user", extra={"tg_id": tg_id}
                 )
                 return await get_or_create_user(tg_id, first_name, referrer_tg_id=referrer_tg_id)
-            for slot in ["laptop", "phone", "tablet", "monitor", "chair", "charm"]:
-                session.add(UserEquipment(user_id=user.id, slot=slot, item_id=None))
+            await init_user_equipment(session, user.id)
             session.add(UserPrestige(user_id=user.id))
             session.add(CampaignProgress(user_id=user.id, chapter=1, is_done=False, progress={}))
             logger.info("New user created", extra={"tg_id": tg_id, "user_id": user.id})
             if referrer_tg_id and referrer_tg_id != tg_id:
-                referrer = await session.scalar(select(User).where(User.tg_id == referrer_tg_id))
+                referrer = await get_user_by_tg(session, referrer_tg_id)
                 if referrer and referrer.id != user.id:
                     now = utcnow()
                     user.referred_by = referrer.id
                     user.balance += REFERRAL_BONUS_RUB
                     user.updated_at = now
                     user_bonus_levels = await add_xp_and_levelup(user, REFERRAL_BONUS_XP)
-                    session.add(
+                    queue_write(
+                        session,
                         EconomyLog(
                             user_id=user.id,
                             type="referral_bonus",
                             amount=REFERRAL_BONUS_RUB,
                             meta={"from": referrer.tg_id},
                             created_at=now,
-                        )
+                        ),
                     )
                     referrer_prev_level = referrer.level
                     referrer.balance += REFERRAL_BONUS_RUB
                     referrer.updated_at = now
                     referrer.referrals_count += 1
                     referrer_bonus_levels = await add_xp_and_levelup(referrer, REFERRAL_BONUS_XP)
-                    session.add(
+                    queue_write(
+                        session,
                         EconomyLog(
                             user_id=referrer.id,
                             type="referral_bonus",
                             amount=REFERRAL_BONUS_RUB,
                             meta={"new_user": tg_id},
                             created_at=now,
-                        )
+                        ),
                     )
                     referral_payload = {
                         "referrer_tg_id": referrer.tg_id,
@@ -4376,9 +5445,61 @@ async def get_or_create_user(
 
 
 async def get_user_by_tg(session: AsyncSession, tg_id: int) -> Optional[User]:
-    """Load user entity by Telegram identifier."""
+    """Load user entity by Telegram identifier (memoized for the session)."""
+
+    cache: Dict[int, User] = session.info.setdefault("users_by_tg", {})
+    user = cache.get(tg_id)
+    if user is not None:
+        return user
+    user = await session.scalar(SELECT_USER_BY_TG, {"tg_id": tg_id})
+    if user is not None:
+        cache[tg_id] = user
+    return user
+
+
+async def get_user_and_has_active(
+    session: AsyncSession, tg_id: int
+) -> Tuple[Optional[User], bool]:
+    """Load user by Telegram id together with an active-order flag in one query."""
+
+    has_active = (
+        exists()
+        .where(
+            UserOrder.user_id == User.id,
+            UserOrder.finished.is_(False),
+            UserOrder.canceled.is_(False),
+        )
+        .correlate(User)
+        .label("has_active")
+    )
+    row = (await session.execute(select(User, has_active).where(User.tg_id == tg_id))).first()
+    if row is None:
+        return None, False
+    session.info.setdefault("users_by_tg", {})[tg_id] = row[0]
+    if not row[1]:
+        # Активного заказа точно нет — get_active_order не будет переспрашивать БД.
+        session.info.setdefault("active_order", {})[row[0].id] = None
+    return row[0], bool(row[1])
+
+
+async def get_user_with_active_order(
+    session: AsyncSession, tg_id: int
+) -> Tuple[Optional[User], Optional[UserOrder]]:
+    """Load user by Telegram id and their active order in one query.
+
+    Both are stored in the session memos used by get_user_by_tg/get_active_order.
+    """
 
-    return await session.scalar(select(User).where(User.tg_id == tg_id))
+    user = session.info.get("users_by_tg", {}).get(tg_id)
+    if user is not None:
+        return user, await get_active_order(session, user)
+    row = (await session.execute(SELECT_USER_WITH_ACTIVE_ORDER, {"tg_id": tg_id})).first()
+    if row is None:
+        return None, None
+    user, active = row
+    session.info.setdefault("users_by_tg", {})[tg_id] = user
+    session.info.setdefault("active_order", {})[user.id] = active
+    return user, active
 
 
 async def get_user_boost_by_code(
@@ -4392,14 +5513,25 @@ async def get_user_boost_by_code(
 
 
 async def ensure_user_loaded(
-    session: AsyncSession, message: Message, *, tg_id: Optional[int] = None
+    session: AsyncSession,
+    message: Message,
+    *,
+    tg_id: Optional[int] = None,
+    with_active_order: bool = False,
 ) -> Optional[User]:
-    """Return user for message or notify user to start the bot."""
+    """Return user for message or notify user to start the bot.
+
+    With ``with_active_order`` the active order is fetched in the same query and
+    memoized, so the following get_active_order does not hit the DB.
+    """
 
     target_id = tg_id or (message.from_user.id if message.from_user else None)
     if target_id is None:
         return None
-    user = await get_user_by_tg(session, target_id)
+    if with_active_order:
+        user, _active = await get_user_with_active_order(session, target_id)
+    else:
+        user = await get_user_by_tg(session, target_id)
     if not user:
         await message.answer(
             "Нажмите /start",
@@ -4490,9 +5622,10 @@ async def tutorial_skip(message: Message, state: FSMContext):
         if not user:
             await state.clear()
             return
+        now = utcnow()
         user.tutorial_stage = TUTORIAL_STAGE_DONE
-        user.tutorial_completed_at = utcnow()
-        user.updated_at = utcnow()
+        user.tutorial_completed_at = now
+        user.updated_at = now
         user.tutorial_payload = {}
         session.add(user)
         await session.flush()
@@ -4545,7 +5678,7 @@ async def handle_event_choice_callback(callback: CallbackQuery, state: FSMContex
             await callback.answer("Некорректный выбор.")
             return
         option = options[choice_idx]
-        event = await session.scalar(select(RandomEvent).where(RandomEvent.code == event_code))
+        event = catalog_by_code(RandomEvent, event_code)
         if not event:
             await callback.answer("Событие не найдено.")
             return
@@ -4597,18 +5730,23 @@ async def back_to_menu(message: Message):
 @safe_handler
 async def handle_click(message: Message, state: FSMContext):
     async with session_scope() as session:
-        user = await ensure_user_loaded(session, message)
+        user = await ensure_user_loaded(session, message, with_active_order=True)
         if not user:
             return
         achievements: List[Tuple[Achievement, UserAchievement]] = []
         idle_result = await process_offline_income(
-            session, user, achievements, message=message, state=state
+            session,
+            user,
+            achievements,
+            message=message,
+            state=state,
+            min_step=OFFLINE_INCOME_CLICK_STEP_SECONDS,
         )
         await handle_idle_completion(message, session, user, state, idle_result)
         stats = await get_user_stats(session, user)
         cp = max(1, int(stats.get("cp", 1)))
         # Обновлено: учитываем фактическую силу клика в задании дня даже без активного заказа.
-        await daily_task_on_event(message, session, user, "daily_clicks", amount=cp)
+        await daily_task_on_event(message, session, user, DAILY_TASK_CLICKS, amount=cp)
         active = await get_active_order(session, user)
         if not active:
             await message.answer(
@@ -4617,7 +5755,9 @@ async def handle_click(message: Message, state: FSMContext):
             )
             return
         order_completed = False
-        user.clicks_total += cp
+        # Прогресс заказа пишется тем же шагом: между ним и проверкой ниже никто
+        # его не читает, а случайное событие и туториал смотрят только на clicks_total.
+        await add_click_progress(session, user, active, cp)
         achievements.extend(await evaluate_achievements(session, user, {"clicks"}))
         if await tutorial_on_event(message, session, user, "click"):
             await state.clear()
@@ -4626,17 +5766,15 @@ async def handle_click(message: Message, state: FSMContext):
             event_payload = await trigger_random_event(
                 session, user, "click", RANDOM_EVENT_CLICK_PROB, stats
             )
-        prev = active.progress_clicks
-        active.progress_clicks = min(active.required_clicks, active.progress_clicks + cp)
         progress_lines: List[str] = []
         progress_markup: Optional[ReplyKeyboardMarkup] = None
         extra_phrase: Optional[str] = None
-        if random.random() < CLICK_EXTRA_PHRASE_CHANCE:
+        if _rand() < CLICK_EXTRA_PHRASE_CHANCE:
             last_extra = _extra_phrase_last_sent.get(user.id, 0.0)
             now_extra = time.monotonic()
             if now_extra - last_extra >= CLICK_EXTRA_PHRASE_COOLDOWN:
-                extra_phrase = random.choice(CLICK_EXTRA_PHRASES)
-                _extra_phrase_last_sent[user.id] = now_extra
+                extra_phrase = _rand_choice(CLICK_EXTRA_PHRASES)
+                _remember_extra_phrase(user.id, now_extra)
         pct = int(round(100 * active.progress_clicks / active.required_clicks))
         progress_lines.append(
             RU.CLICK_PROGRESS.format(cur=active.progress_clicks, req=active.required_clicks, pct=pct)
@@ -4662,7 +5800,7 @@ async def handle_click(message: Message, state: FSMContext):
                 trigger_events=True,
             )
             menu_markup = await main_menu_for_message(message, session=session, user=user)
-            extra_line = random.choice(ORDER_DONE_EXTRA) if ORDER_DONE_EXTRA else ""
+            extra_line = _rand_choice(ORDER_DONE_EXTRA) if ORDER_DONE_EXTRA else ""
             summary_lines = [
                 RU.ORDER_DONE.format(rub=completion_result.reward, xp=completion_result.xp_gain)
             ]
@@ -4696,7 +5834,7 @@ async def handle_click(message: Message, state: FSMContext):
                     completion_result.prev_level,
                     completion_result.levels_gained,
                 )
-            await daily_task_on_event(message, session, user, "daily_orders")
+            await daily_task_on_event(message, session, user, DAILY_TASK_ORDERS)
             if completion_result.event_payload:
                 text_event, event_markup = completion_result.event_payload
                 if text_event and text_event.strip():
@@ -4743,7 +5881,7 @@ async def leave_order_to_menu(message: Message):
 @safe_handler
 async def resume_order_work(message: Message):
     async with session_scope() as session:
-        user = await ensure_user_loaded(session, message)
+        user = await ensure_user_loaded(session, message, with_active_order=True)
         if not user:
             return
         achievements: List[Tuple[Achievement, UserAchievement]] = []
@@ -4757,7 +5895,7 @@ async def resume_order_work(message: Message):
                 reply_markup=await build_main_menu_markup(tg_id=message.from_user.id),
             )
             return
-        order_entity = await session.scalar(select(Order).where(Order.id == active.order_id))
+        order_entity = catalog_get(Order, active.order_id)
         title = order_entity.title if order_entity else "заказ"
         pct = int(100 * active.progress_clicks / active.required_clicks)
         progress_line = RU.CLICK_PROGRESS.format(
@@ -4794,17 +5932,15 @@ def fmt_orders(
         title = o.title
         difficulty = ORDER_DIFFICULTY_LABELS.get(getattr(o, "difficulty", ""), o.difficulty)
         estimated = int(getattr(o, "estimated_minutes", 30))
-        reward_mul = float(getattr(o, "reward_multiplier", 1.0))
-        preview = int(
-            getattr(
-                o,
-                "reward_preview",
-                base_reward_from_required(
-                    required_clicks(o.base_clicks, max(user_level, o.min_level)),
-                    reward_mul,
-                ),
+        # Предпросмотр посчитан при сидировании; формулу гоняем только для строк без него
+        # (default в getattr вычислялся бы для каждой строки списка).
+        preview = getattr(o, "reward_preview", None)
+        if preview is None:
+            preview = base_reward_from_required(
+                required_clicks(o.base_clicks, max(user_level, o.min_level)),
+                float(getattr(o, "reward_multiplier", 1.0)),
             )
-        )
+        preview = int(preview)
         if getattr(o, "is_special", False):
             preview = int(round(preview * SPECIAL_ORDER_REWARD_MUL))
         detail_parts = [
@@ -4883,13 +6019,7 @@ async def _render_orders_page(message: Message, state: FSMContext):
         achievements: List[Tuple[Achievement, UserAchievement]] = []
         idle_result = await process_offline_income(session, user, achievements)
         await handle_idle_completion(message, session, user, state, idle_result)
-        all_orders = (
-            await session.execute(
-                select(Order)
-                .where(Order.min_level <= user.level)
-                .order_by(Order.min_level, Order.id)
-            )
-        ).scalars().all()
+        all_orders = catalog_orders_up_to_level(user.level)
         data = await state.get_data()
         rolled_rares: Optional[List[int]] = data.get("rolled_rares")  # type: ignore[arg-type]
         if rolled_rares is None:
@@ -4897,7 +6027,7 @@ async def _render_orders_page(message: Message, state: FSMContext):
             for order in all_orders:
                 if order.rarity in {"rare", "holiday"}:
                     chance = max(0.0, min(1.0, float(getattr(order, "appearance_weight", 0.0))))
-                    if chance > 0 and random.random() < chance:
+                    if chance > 0 and _rand() < chance:
                         rolled_rares.append(order.id)
             await state.update_data(rolled_rares=rolled_rares)
         special_orders = [o for o in all_orders if o.is_special]
@@ -4951,7 +6081,7 @@ async def choose_order(message: Message, state: FSMContext):
         if not await ensure_no_active_order(session, user):
             await message.answer(RU.ORDER_ALREADY)
             return
-        order = await session.scalar(select(Order).where(Order.id == order_id))
+        order = catalog_get(Order, order_id)
         if not order:
             await message.answer("Заказ не найден.")
             await _render_orders_page(message, state)
@@ -4999,12 +6129,12 @@ async def take_order(message: Message, state: FSMContext):
             await state.clear()
             return
         stats = await get_user_stats(session, user)
-        order = await session.scalar(select(Order).where(Order.id == order_id))
+        order = catalog_get(Order, order_id)
         is_special_order = bool(order and order.is_special)
         initial_progress = 0
         free_chance = stats.get("free_order_chance", 0.0)
         free_triggered = False
-        if free_chance > 0 and random.random() < free_chance:
+        if free_chance > 0 and _rand() < free_chance:
             initial_progress = min(
                 req,
                 max(1, int(round(req * FREE_ORDER_PROGRESS_PCT))),
@@ -5252,14 +6382,12 @@ async def resolve_free_shop_offer(
     discount_pct = stats.get("shop_discount_pct", 0.0)
 
     if boosts is None:
-        boosts = (await session.execute(select(Boost).order_by(Boost.base_cost))).scalars().all()
+        boosts = sorted(catalog_all(Boost), key=lambda b: b.base_cost)
     if boost_levels is None:
         boost_levels = {
             boost_id: level
             for boost_id, level in (
-                await session.execute(
-                    select(UserBoost.boost_id, UserBoost.level).where(UserBoost.user_id == user.id)
-                )
+                await session.execute(SELECT_USER_BOOST_LEVELS, {"uid": user.id})
             ).all()
         }
 
@@ -5309,12 +6437,12 @@ async def tutorial_prepare_shop_hint(
         payload = ensure_tutorial_payload(user)
     offer = await resolve_free_shop_offer(session, user)
     if not offer:
-        payload.pop("shop_hint", None)
-        user.tutorial_payload = payload
+        if payload.pop("shop_hint", None) is not None:
+            flag_modified(user, "tutorial_payload")
         return
     hint: Dict[str, Any] = {"kind": offer.kind}
     if offer.kind == "boost":
-        boost = await session.scalar(select(Boost).where(Boost.id == offer.target_id))
+        boost = catalog_get(Boost, offer.target_id)
         if boost:
             category = _boost_category(boost)
             hint.update(
@@ -5329,10 +6457,11 @@ async def tutorial_prepare_shop_hint(
         else:
             hint["name"] = "улучшение"
     else:
-        item = await session.scalar(select(Item).where(Item.id == offer.target_id))
+        item = catalog_get(Item, offer.target_id)
         hint["name"] = item.name if item else "предмет"
-    payload["shop_hint"] = hint
-    user.tutorial_payload = payload
+    if payload.get("shop_hint") != hint:
+        payload["shop_hint"] = hint
+        flag_modified(user, "tutorial_payload")
 
 
 def fmt_boosts(
@@ -5596,15 +6725,11 @@ async def render_boosts(
         idle_result = await process_offline_income(session, user, achievements)
         await handle_idle_completion(message, session, user, state, idle_result)
         stats = await get_user_stats(session, user)
-        boosts = (
-            await session.execute(select(Boost).order_by(Boost.id))
-        ).scalars().all()
+        boosts = catalog_all(Boost)
         levels = {
             b_id: lvl
             for b_id, lvl in (
-                await session.execute(
-                    select(UserBoost.boost_id, UserBoost.level).where(UserBoost.user_id == user.id)
-                )
+                await session.execute(SELECT_USER_BOOST_LEVELS, {"uid": user.id})
             ).all()
         }
         data = await state.get_data()
@@ -5729,7 +6854,7 @@ async def _handle_boost_selection(
         if not user:
             await state.clear()
             return
-        boost = await session.scalar(select(Boost).where(Boost.id == boost_id))
+        boost = catalog_get(Boost, boost_id)
         if not boost:
             await message.answer("Усиление не найдено.")
             await state.set_state(ShopState.boosts)
@@ -5810,7 +6935,7 @@ async def _handle_passive_shop_selection(
             return
         success = await _purchase_passive_source(session, user, source, message)
         if success:
-            await daily_task_on_event(message, session, user, "daily_shop")
+            await daily_task_on_event(message, session, user, DAILY_TASK_SHOP)
             await tutorial_on_event(message, session, user, "upgrade_purchase")
     await render_boosts(message, state)
 
@@ -5910,7 +7035,7 @@ async def shop_buy_boost(message: Message, state: FSMContext):
         achievements: List[Tuple[Achievement, UserAchievement]] = []
         idle_result = await process_offline_income(session, user, achievements)
         await handle_idle_completion(message, session, user, state, idle_result)
-        boost = await session.scalar(select(Boost).where(Boost.id == bid))
+        boost = catalog_get(Boost, bid)
         if not boost:
             await message.answer("Усиление не найдено.")
             await state.set_state(ShopState.boosts)
@@ -5943,7 +7068,8 @@ async def shop_buy_boost(message: Message, state: FSMContext):
                 session.add(UserBoost(user_id=user.id, boost_id=bid, level=1))
             else:
                 user_boost.level += 1
-            session.add(
+            queue_write(
+                session,
                 EconomyLog(
                     user_id=user.id,
                     type="buy_boost",
@@ -5954,7 +7080,7 @@ async def shop_buy_boost(message: Message, state: FSMContext):
                         **({"tutorial_free": True} if free_available else {}),
                     },
                     created_at=now,
-                )
+                ),
             )
             logger.info(
                 "Boost upgraded",
@@ -5973,7 +7099,7 @@ async def shop_buy_boost(message: Message, state: FSMContext):
             feedback = BOOST_PURCHASE_FEEDBACK.get(boost.type)
             if feedback:
                 await message.answer(feedback)
-            await daily_task_on_event(message, session, user, "daily_shop")
+            await daily_task_on_event(message, session, user, DAILY_TASK_SHOP)
             await tutorial_on_event(message, session, user, "upgrade_purchase")
         await notify_new_achievements(message, achievements)
     await state.set_state(ShopState.boosts)
@@ -6038,14 +7164,15 @@ async def shop_upgrade_passive(message: Message, state: FSMContext):
         user.balance -= cost
         user.updated_at = now
         entry.level = next_level
-        session.add(
+        queue_write(
+            session,
             EconomyLog(
                 user_id=user.id,
                 type="passive_upgrade",
                 amount=-cost,
                 meta={"source": source["code"], "level": next_level},
                 created_at=now,
-            )
+            ),
         )
         logger.info(
             "Passive source upgraded",
@@ -6064,7 +7191,7 @@ async def shop_upgrade_passive(message: Message, state: FSMContext):
                 income=format_money(source["income_per_min"] * next_level),
             )
         )
-        await daily_task_on_event(message, session, user, "daily_shop")
+        await daily_task_on_event(message, session, user, DAILY_TASK_SHOP)
         await tutorial_on_event(message, session, user, "upgrade_purchase")
         await notify_new_achievements(message, achievements)
     await state.set_state(ShopState.boosts)
@@ -6179,7 +7306,7 @@ async def shop_choose_item(message: Message, state: FSMContext):
         if not user:
             await state.clear()
             return
-        it = await session.scalar(select(Item).where(Item.id == item_id))
+        it = catalog_get(Item, item_id)
         if not it:
             await message.answer("Предмет не найден.")
             await render_items(message, state)
@@ -6231,7 +7358,7 @@ async def shop_buy_item(message: Message, state: FSMContext):
         achievements: List[Tuple[Achievement, UserAchievement]] = []
         idle_result = await process_offline_income(session, user, achievements)
         await handle_idle_completion(message, session, user, state, idle_result)
-        item = await session.scalar(select(Item).where(Item.id == item_id))
+        item = catalog_get(Item, item_id)
         if not item:
             await message.answer("Предмет не найден.")
             await state.set_state(ShopState.equipment)
@@ -6263,7 +7390,8 @@ async def shop_buy_item(message: Message, state: FSMContext):
                 user.tutorial_free_boost_used = True
             user.updated_at = now
             session.add(UserItem(user_id=user.id, item_id=item_id))
-            session.add(
+            queue_write(
+                session,
                 EconomyLog(
                     user_id=user.id,
                     type="buy_item",
@@ -6273,7 +7401,7 @@ async def shop_buy_item(message: Message, state: FSMContext):
                         **({"tutorial_free": True} if free_available else {}),
                     },
                     created_at=now,
-                )
+                ),
             )
             logger.info(
                 "Item purchased",
@@ -6286,8 +7414,13 @@ async def shop_buy_item(message: Message, state: FSMContext):
             )
             await update_campaign_progress(session, user, "item_purchase", {})
             achievements.extend(await evaluate_achievements(session, user, {"items"}))
-            next_item = await session.scalar(
-                select(Item).where(Item.slot == item.slot, Item.tier == item.tier + 1)
+            next_item = next(
+                (
+                    it
+                    for it in catalog_all(Item)
+                    if it.slot == item.slot and it.tier == item.tier + 1
+                ),
+                None,
             )
             if next_item:
                 next_hint = (
@@ -6304,7 +7437,7 @@ async def shop_buy_item(message: Message, state: FSMContext):
                 )
             main_text = RU.TUTORIAL_FREE_UPGRADE_DONE if free_available else RU.PURCHASE_OK
             await message.answer(f"{main_text}\n{next_hint}")
-            await daily_task_on_event(message, session, user, "daily_shop")
+            await daily_task_on_event(message, session, user, DAILY_TASK_SHOP)
             await tutorial_on_event(message, session, user, "upgrade_purchase")
         await notify_new_achievements(message, achievements)
     await state.set_state(ShopState.equipment)
@@ -6374,14 +7507,15 @@ async def _purchase_passive_source(
             purchased_at=now,
         )
     )
-    session.add(
+    queue_write(
+        session,
         EconomyLog(
             user_id=user.id,
             type="passive_purchase",
             amount=-price,
             meta={"source": source["code"]},
             created_at=now,
-        )
+        ),
     )
     income_display = format_money(source["income_per_min"])
     await message.answer(
@@ -6446,7 +7580,7 @@ async def passive_buy(message: Message, state: FSMContext):
         success = await _purchase_passive_source(session, user, source, message)
         if not success:
             return
-        await daily_task_on_event(message, session, user, "daily_shop")
+        await daily_task_on_event(message, session, user, DAILY_TASK_SHOP)
         await tutorial_on_event(message, session, user, "upgrade_purchase")
         owned = await get_user_passive_levels(session, user)
         await message.answer(render_passive_sources(owned))
@@ -6491,7 +7625,7 @@ def compute_team_upgrade_options(
     cost_x100: Optional[int] = None
     max_cost: Optional[int] = None
     next_cost: Optional[int] = None
-    raw_cost = member.base_cost * (TEAM_UPGRADE_GROWTH ** max(0, current_level))
+    raw_cost = member.base_cost * team_growth_power(current_level)
     for step in range(1, limit + 1):
         step_cost = apply_percentage_discount(
             raw_cost, discount_pct, cap=TEAM_DISCOUNT_CAP
@@ -6510,7 +7644,7 @@ def compute_team_upgrade_options(
         raw_cost *= TEAM_UPGRADE_GROWTH
     if next_cost is None:
         next_cost = apply_percentage_discount(
-            member.base_cost * (TEAM_UPGRADE_GROWTH ** max(0, current_level)),
+            member.base_cost * team_growth_power(current_level),
             discount_pct,
             cap=TEAM_DISCOUNT_CAP,
         )
@@ -6528,7 +7662,7 @@ def team_upgrade_total_cost(
 ) -> int:
     if steps <= 0:
         return 0
-    raw_cost = member.base_cost * (TEAM_UPGRADE_GROWTH ** max(0, current_level))
+    raw_cost = member.base_cost * team_growth_power(current_level)
     total = 0
     for _ in range(steps):
         step_cost = apply_percentage_discount(
@@ -6589,9 +7723,7 @@ async def render_team(message: Message, state: FSMContext):
         idle_result = await process_offline_income(session, user, achievements)
         await handle_idle_completion(message, session, user, state, idle_result)
         stats = await get_user_stats(session, user)
-        members_all = (
-            await session.execute(select(TeamMember).order_by(TeamMember.base_cost, TeamMember.id))
-        ).scalars().all()
+        members_all = sorted(catalog_all(TeamMember), key=lambda m: (m.base_cost, m.id))
         members = [m for m in members_all if user.level >= max(1, m.min_level)]
         if not members:
             await state.clear()
@@ -6614,7 +7746,7 @@ async def render_team(message: Message, state: FSMContext):
         costs = {}
         for m in members:
             lvl = max(0, levels.get(m.id, 0))
-            base_cost = m.base_cost * (TEAM_UPGRADE_GROWTH ** lvl)
+            base_cost = m.base_cost * team_growth_power(lvl)
             costs[m.id] = apply_percentage_discount(base_cost, discount_pct, cap=TEAM_DISCOUNT_CAP)
         page = int((await state.get_data()).get("page", 0))
         sub, has_prev, has_next = slice_page(members, page, 5)
@@ -6658,7 +7790,7 @@ async def team_choose(message: Message, state: FSMContext):
         if not user:
             await state.clear()
             return
-        member = await session.scalar(select(TeamMember).where(TeamMember.id == mid))
+        member = catalog_get(TeamMember, mid)
         if not member:
             await message.answer("Сотрудник не найден.")
             await render_team(message, state)
@@ -6720,7 +7852,7 @@ async def team_upgrade(message: Message, state: FSMContext):
         achievements: List[Tuple[Achievement, UserAchievement]] = []
         idle_result = await process_offline_income(session, user, achievements)
         await handle_idle_completion(message, session, user, state, idle_result)
-        member = await session.scalar(select(TeamMember).where(TeamMember.id == mid))
+        member = catalog_get(TeamMember, mid)
         if not member:
             await message.answer("Сотрудник не найден.")
             await state.set_state(TeamState.browsing)
@@ -6785,7 +7917,8 @@ async def team_upgrade(message: Message, state: FSMContext):
             user.updated_at = now
             new_level = team_entry.level
             final_level = new_level
-            session.add(
+            queue_write(
+                session,
                 EconomyLog(
                     user_id=user.id,
                     type="team_upgrade",
@@ -6798,7 +7931,7 @@ async def team_upgrade(message: Message, state: FSMContext):
                         "count": steps,
                     },
                     created_at=now,
-                )
+                ),
             )
             logger.info(
                 "Team upgraded",
@@ -6810,7 +7943,9 @@ async def team_upgrade(message: Message, state: FSMContext):
                     "count": steps,
                 },
             )
-            await update_campaign_progress(session, user, "team_upgrade", {})
+            await update_campaign_progress(
+                session, user, "team_upgrade", {"from_level": lvl, "to_level": new_level}
+            )
             achievements.extend(await evaluate_achievements(session, user, {"team"}))
             await message.answer(
                 f"{RU.UPGRADE_OK}\nПолучено уровней: +{steps} (до {new_level})."
@@ -6913,7 +8048,7 @@ async def wardrobe_choose(message: Message, state: FSMContext):
         if not user:
             await state.clear()
             return
-        it = await session.scalar(select(Item).where(Item.id == item_id))
+        it = catalog_get(Item, item_id)
         if not it:
             await message.answer("Предмет не найден.")
             await render_inventory(message, state)
@@ -6923,7 +8058,7 @@ async def wardrobe_choose(message: Message, state: FSMContext):
             select(UserEquipment).where(UserEquipment.user_id == user.id, UserEquipment.slot == it.slot)
         )
         if current_eq:
-            equipped_item = await session.scalar(select(Item).where(Item.id == current_eq.item_id))
+            equipped_item = catalog_get(Item, current_eq.item_id)
         prompt = format_item_equip_prompt(it, equipped_item)
         await message.answer(prompt, reply_markup=kb_confirm(RU.BTN_EQUIP))
     await state.set_state(WardrobeState.equip_confirm)
@@ -6958,7 +8093,7 @@ async def wardrobe_equip(message: Message, state: FSMContext):
         achievements: List[Tuple[Achievement, UserAchievement]] = []
         idle_result = await process_offline_income(session, user, achievements)
         await handle_idle_completion(message, session, user, state, idle_result)
-        item = await session.scalar(select(Item).where(Item.id == item_id))
+        item = catalog_get(Item, item_id)
         if not item:
             await message.answer("Предмет не найден.")
             await state.set_state(WardrobeState.browsing)
@@ -7001,6 +8136,7 @@ async def wardrobe_equip_cancel(message: Message, state: FSMContext):
 @router.message(F.text == RU.BTN_PROFILE)
 @safe_handler
 async def profile_show(message: Message, state: FSMContext):
+    await drain_economy_log_buffer()
     async with session_scope() as session:
         user = await ensure_user_loaded(session, message)
         if not user:
@@ -7015,7 +8151,7 @@ async def profile_show(message: Message, state: FSMContext):
         display_name = user.first_name or message.from_user.full_name or f"Игрок {user.id}"
         order_str = "нет активных заказов"
         if active:
-            ord_row = await session.scalar(select(Order).where(Order.id == active.order_id))
+            ord_row = catalog_get(Order, active.order_id)
             if ord_row:
                 order_bar = render_progress_bar(active.progress_clicks, active.required_clicks)
                 order_str = (
@@ -7024,7 +8160,9 @@ async def profile_show(message: Message, state: FSMContext):
         now = utcnow()
         buffs = (
             await session.execute(
-                select(UserBuff).where(UserBuff.user_id == user.id, UserBuff.expires_at > now)
+                select(UserBuff).where(
+                    UserBuff.user_id == user.id, UserBuff.expires_at_ts > to_epoch(now)
+                )
             )
         ).scalars().all()
         buffs_text = (
@@ -7141,14 +8279,15 @@ async def profile_daily(message: Message):
         user.balance += SETTINGS.DAILY_BONUS_RUB
         user.daily_bonus_claims += 1
         user.updated_at = now
-        session.add(
+        queue_write(
+            session,
             EconomyLog(
                 user_id=user.id,
                 type="daily_bonus",
                 amount=SETTINGS.DAILY_BONUS_RUB,
                 meta=None,
                 created_at=now,
-            )
+            ),
         )
         logger.info("Daily bonus collected", extra={"tg_id": user.tg_id, "user_id": user.id})
         await message.answer(
@@ -7170,16 +8309,15 @@ async def show_daily_tasks_menu(message: Message):
         achievements: List[Tuple[Achievement, UserAchievement]] = []
         idle_result = await process_offline_income(session, user, achievements)
         await handle_idle_completion(message, session, user, None, idle_result)
-        state = ensure_daily_task_state(user)
+        progress_by_task, done_mask = unpack_daily_state(ensure_daily_task_state(user))
         lines = [RU.DAILIES_HEADER, ""]
         all_done = True
-        for task in DAILY_TASKS:
-            entry = state.get(task["code"], {"progress": 0, "done": False})
-            done = bool(entry.get("done"))
+        for idx, task in enumerate(DAILY_TASKS):
+            done = bool(done_mask & (1 << idx))
             if not done:
                 all_done = False
             status = "✅" if done else "🔸"
-            progress = int(entry.get("progress", 0))
+            progress = progress_by_task[idx]
             lines.append(
                 RU.DAILIES_TASK_ROW.format(
                     status=status,
@@ -7351,7 +8489,7 @@ async def quest_playing(message: Message, state: FSMContext):
         payload = quest_get_stage_payload(quest, definition)
         for key, delta in (choice.get("delta") or {}).items():
             payload[key] = payload.get(key, 0) + int(delta)
-        quest.payload = payload
+        flag_modified(quest, "payload")
         next_stage = choice.get("next")
         if next_stage == "finale":
             await state.update_data(active_quest=None)
@@ -7416,6 +8554,7 @@ async def show_skills_menu(message: Message):
 @router.message(F.text == RU.BTN_STATS)
 @safe_handler
 async def show_global_stats(message: Message):
+    await drain_economy_log_buffer()
     async with session_scope() as session:
         user = await ensure_user_loaded(session, message)
         if not user:
@@ -7430,17 +8569,16 @@ async def show_global_stats(message: Message):
         has_active_order=bool(active),
         category=RU.BTN_PROFILE_CAT_SOCIAL,
     )
-    ordered = sorted(rows, key=lambda entry: entry[2], reverse=True)
-    total_players = len(ordered)
+    total_players = len(rows)
     lines = [RU.STATS_HEADER, ""]
     for idx in range(1, 6):
         if idx <= total_players:
-            _, name, income = ordered[idx - 1]
+            _, name, income = rows[idx - 1]
             lines.append(RU.STATS_ROW.format(idx=idx, name=name, value=format_money(income)))
         else:
             lines.append(RU.STATS_EMPTY_ROW.format(idx=idx))
     player_rank = next(
-        (idx for idx, (uid, _, _) in enumerate(ordered, start=1) if uid == user.id),
+        (idx for idx, (uid, _, _) in enumerate(rows, start=1) if uid == user.id),
         None,
     )
     lines.append("")
@@ -7530,13 +8668,7 @@ async def show_campaign(message: Message, state: FSMContext):
         lines = [
             RU.CAMPAIGN_HEADER,
             "",
-            RU.CAMPAIGN_STATUS.format(
-                chapter=definition["chapter"],
-                total=len(CAMPAIGN_CHAPTERS),
-                title=definition["title"],
-                goal=describe_campaign_goal(goal),
-                progress=pct,
-            ),
+            CAMPAIGN_STATUS_BY_CHAPTER[definition["chapter"]].format(progress=pct),
         ]
         if progress.is_done:
             lines.append("")
@@ -7580,6 +8712,7 @@ async def claim_campaign_handler(message: Message, state: FSMContext):
 @router.message(F.text == RU.BTN_STUDIO)
 @safe_handler
 async def show_studio(message: Message, state: FSMContext):
+    await drain_economy_log_buffer()
     async with session_scope() as session:
         user = await ensure_user_loaded(session, message)
         if not user:
@@ -7626,6 +8759,8 @@ async def confirm_studio(message: Message, state: FSMContext):
     data = await state.get_data()
     gain = int(data.get("gain", 0))
     stored_total = data.get("total_earned")
+    if stored_total is None:
+        await drain_economy_log_buffer()
     async with session_scope() as session:
         user = await ensure_user_loaded(session, message)
         if not user:
@@ -7673,7 +8808,7 @@ async def admin_roll_trend(message: Message):
         user = await get_user_by_tg(session, message.from_user.id)
         level_hint = user.level if user else None
         trend = await roll_new_trend(session, user_level_hint=level_hint)
-        order = await session.scalar(select(Order).where(Order.id == trend["order_id"]))
+        order = catalog_get(Order, trend["order_id"])
     title = order.title if order else f"#{trend['order_id']}"
     expires = trend["valid_until"].strftime("%d.%m %H:%M")
     await message.answer(
@@ -7698,7 +8833,7 @@ async def admin_give_shield(message: Message):
         user = await ensure_user_loaded(session, message)
         if not user:
             return
-        boost = await session.scalar(select(Boost).where(Boost.code == EVENT_SHIELD_CODE))
+        boost = catalog_by_code(Boost, EVENT_SHIELD_CODE)
         if not boost:
             await message.answer("Усиление страховки не найдено.")
             return
@@ -7779,14 +8914,15 @@ async def admin_give_money(message: Message):
         meta: Dict[str, Any] = {"source": "admin_command", "admin_tg_id": message.from_user.id}
         if comment:
             meta["comment"] = comment
-        session.add(
+        queue_write(
+            session,
             EconomyLog(
                 user_id=target.id,
                 type="admin_grant",
                 amount=amount,
                 meta=meta,
                 created_at=now,
-            )
+            ),
         )
         achievements.extend(await evaluate_achievements(session, target, {"balance"}))
         admin_reply = (
@@ -7935,7 +9071,7 @@ async def admin_test_event_choice(message: Message):
         user = await ensure_user_loaded(session, message)
         if not user:
             return
-        event = await session.scalar(select(RandomEvent).where(RandomEvent.code == "spill_choice"))
+        event = catalog_by_code(RandomEvent, "spill_choice")
         if not event:
             await message.answer("Интерактивное событие не найдено.")
             return
@@ -7951,6 +9087,7 @@ async def admin_test_event_choice(message: Message):
 async def admin_prestige_preview(message: Message):
     if not _is_base_admin(message):
         return
+    await drain_economy_log_buffer()
     async with session_scope() as session:
         user = await ensure_user_loaded(session, message)
         if not user:
@@ -7981,7 +9118,7 @@ async def pick_skill(message: Message, state: FSMContext):
         if not user:
             await state.clear()
             return
-        skill = await session.scalar(select(Skill).where(Skill.code == code))
+        skill = catalog_by_code(Skill, code)
         if not skill:
             await message.answer(
                 "Навык не найден.",
@@ -7998,15 +9135,17 @@ async def pick_skill(message: Message, state: FSMContext):
                 reply_markup=await build_main_menu_markup(tg_id=message.from_user.id),
             )
         else:
-            session.add(UserSkill(user_id=user.id, skill_code=code, taken_at=utcnow()))
-            session.add(
+            now = utcnow()
+            session.add(UserSkill(user_id=user.id, skill_code=code, taken_at=now))
+            queue_write(
+                session,
                 EconomyLog(
                     user_id=user.id,
                     type="skill_pick",
                     amount=0.0,
                     meta={"skill": code},
-                    created_at=utcnow(),
-                )
+                    created_at=now,
+                ),
             )
             await message.answer(
                 RU.SKILL_PICKED.format(name=skill.name),
@@ -8238,7 +9377,14 @@ async def main() -> None:
 
     await bot.delete_webhook(drop_pending_updates=True)
     logger.info("Bot started", extra={"event": "startup"})
-    await dp.start_polling(bot)
+    log_flusher = asyncio.create_task(economy_log_flusher())
+    try:
+        await dp.start_polling(bot)
+    finally:
+        log_flusher.cancel()
+        with suppress(asyncio.CancelledError):
+            await log_flusher
+        await drain_economy_log_buffer()
 
 
 if __name__ == "__main__":